@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Bulk writes, many create/update calls pipelined under the rate budget"""
+
+from __future__ import print_function
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import requests
+from rate_budget import RateBudget
+from util import thread_map
+
+
+class BulkWriter(object):
+
+    """
+    Send a stream of create/update operations through one Shopify object.
+    Operations are dicts: method ('post' or 'put'), call (API path), data
+    (dict or json string) and an optional key (defaults to "method call" plus
+    a hash of the data, so two creates on one endpoint are two keys).
+    Calls run on a few threads sharing pooled connections and a RateBudget,
+    transient failures (429, 5xx, connection errors) are retried with
+    backoff and every outcome is appended to a journal (one json line per
+    attempt result). Running again with the same journal skips the keys
+    already written, so an interrupted push resumes where it stopped.
+    """
+
+    methods = ('post', 'put')
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, shopify, journal_path, workers=4, rate_budget=None, max_retries=5,
+                 backoff=1.0):
+        """
+        :param shopify: Shopify, required, a writable object (not an extract job, those are read only)
+        :param journal_path: string, required, journal file (json lines), created if missing
+        :param workers: int, optional, concurrent calls
+        :param rate_budget: RateBudget, optional, defaults to the object's or a new standard one
+        :param max_retries: int, optional, retries per operation for transient failures
+        :param backoff: float, optional, seconds before the first retry, doubled each time
+        :return: void
+        """
+        if shopify.read_only:
+            raise ValueError(
+                'BulkWriter needs a Shopify object that may write, %s is read only' %
+                type(shopify).__name__
+            )
+        self.shopify = shopify
+        if rate_budget is not None:
+            shopify.rate_budget = rate_budget
+        elif shopify.rate_budget is None:
+            shopify.rate_budget = RateBudget()
+        shopify.pool_size = max(shopify.pool_size, workers)
+        self.journal_path = journal_path
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+
+    @classmethod
+    def operation_key(cls, operation):
+        """
+        :param operation: dict
+        :return: string, journal key
+        """
+        if operation.get('key'):
+            return operation['key']
+        data = operation.get('data')
+        if not isinstance(data, (str, bytes)):
+            data = json.dumps(data, sort_keys=True)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return '%s %s %s' % (
+            operation['method'].lower(), operation['call'], hashlib.sha1(data).hexdigest()
+        )
+
+    def completed(self):
+        """
+        Keys whose last journal entry is ok
+        :return: set
+        """
+        last = {}
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path) as journal:
+                for line in journal:
+                    if line.strip():
+                        entry = json.loads(line)
+                        last[entry['key']] = entry['status']
+        return set(key for key, status in last.items() if status == 'ok')
+
+    def run(self, operations):
+        """
+        Send every operation not already in the journal as ok
+        :param operations: iterable of operation dicts (a generator is fine)
+        :return: dict of counts (ok, failed, skipped) and seconds
+        """
+        started = time.time()
+        done = self.completed()
+        counts = dict(ok=0, failed=0, skipped=0)
+
+        def pending():
+            for operation in operations:
+                if self.operation_key(operation) in done:
+                    counts['skipped'] += 1
+                    continue
+                yield operation
+
+        with open(self.journal_path, 'a') as journal:
+            for operation, result, error in thread_map(self.send, pending(), self.workers):
+                if error is not None:
+                    result = dict(
+                        key=self.operation_key(operation), status='failed', error=repr(error)
+                    )
+                counts[result['status']] += 1
+                result['at'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+                journal.write(json.dumps(result) + '\n')
+                journal.flush()
+                if result['status'] != 'ok':
+                    logging.warning('Bulk write %s failed: %s', result['key'], result.get('error'))
+
+        counts['seconds'] = time.time() - started
+        logging.info(
+            'Bulk write complete: %s ok, %s failed, %s skipped (already written) in %.1fs',
+            counts['ok'], counts['failed'], counts['skipped'], counts['seconds']
+        )
+        return counts
+
+    def send(self, operation):
+        """
+        One operation with retries, runs on a worker thread
+        :param operation: dict
+        :return: dict journal entry (key, status, code, attempts, id or error)
+        """
+        key = self.operation_key(operation)
+        method = operation['method'].lower()
+        if method not in self.methods:
+            return dict(key=key, status='failed', error='method %s is not a create/update' % method)
+        data = operation.get('data')
+        if data is not None and not isinstance(data, str):
+            data = json.dumps(data)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            code = None
+            try:
+                req = self.shopify.shopify_request(
+                    method, operation['call'], data=data,
+                    headers={'Content-Type': 'application/json'},
+                )
+            except requests.exceptions.RequestException as e:
+                error = repr(e)
+            else:
+                if req is None:
+                    return dict(key=key, status='failed', attempts=attempt, error='forbidden')
+                code = req.status_code
+                if code in (200, 201):
+                    return dict(
+                        key=key, status='ok', code=code, attempts=attempt, id=self.created_id(req)
+                    )
+                error = req.text[:500]
+            if attempt > self.max_retries or (code is not None and code not in self.retry_statuses):
+                return dict(key=key, status='failed', code=code, attempts=attempt, error=error)
+            # 429s also pause the shared budget, this only spaces out this operation
+            time.sleep(self.backoff * 2 ** (attempt - 1))
+
+    @classmethod
+    def created_id(cls, req):
+        """
+        id of the object in a {"product": {"id": ...}} style response
+        :param req: requests.Response
+        :return: int or None
+        """
+        try:
+            body = json.loads(req.content)
+        except ValueError:
+            return None
+        for value in body.values():
+            if isinstance(value, dict):
+                return value.get('id')
+        return None
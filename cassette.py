@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Record/replay of HTTP traffic into gzipped json cassettes, offline tests and benchmarks"""
+
+import base64
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+try:
+    from urllib.parse import urlsplit, urlunsplit
+except ImportError:  # Python 2
+    from urlparse import urlsplit, urlunsplit
+import requests
+from requests.structures import CaseInsensitiveDict
+from util import atomic_write
+
+# replay only (a request not on the cassette raises), record (always the network,
+# the cassette is rewritten) or once (replay an existing cassette, else record one)
+modes = ('replay', 'record', 'once')
+
+
+class CassetteError(Exception):
+
+    """A request that is not on the cassette while replaying"""
+
+
+def request_key(method, url, params=None, data=None):
+    """
+    What identifies a request on a cassette: method, URL without credentials
+    (query sorted, params merged in) and a hash of the body
+    :param method: string
+    :param url: string
+    :param params: optional dict of query params
+    :param data: optional body, string/bytes/dict
+    :return: tuple (method, url, body sha1 or None)
+    """
+    prepared = requests.Request(method.upper(), url, params=params).prepare()
+    parts = urlsplit(prepared.url)
+    query = '&'.join(sorted(parts.query.split('&'))) if parts.query else ''
+    clean_url = urlunsplit((parts.scheme, parts.netloc.rpartition('@')[2], parts.path, query, ''))
+    if data is None:
+        return method.upper(), clean_url, None
+    if isinstance(data, dict):
+        data = json.dumps(data, sort_keys=True)
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return method.upper(), clean_url, hashlib.sha1(data).hexdigest()
+
+
+def encode_body(content):
+    """
+    :param content: bytes
+    :return: tuple (text, encoding) utf-8 text where it decodes, else base64
+    """
+    try:
+        return content.decode('utf-8'), 'utf-8'
+    except UnicodeDecodeError:
+        return base64.b64encode(content).decode('ascii'), 'base64'
+
+
+def decode_body(text, encoding):
+    """
+    :param text: string, as written by encode_body()
+    :param encoding: string, utf-8 or base64
+    :return: bytes
+    """
+    if encoding == 'base64':
+        return base64.b64decode(text)
+    return text.encode('utf-8')
+
+
+class Cassette(object):
+
+    """
+    Stands in for a requests.Session: set it as Shopify.cassette (or hand it
+    to anything calling session.get()/request()) and every request is served
+    from, or recorded onto, a gzipped json file. Responses keep their status,
+    headers, body and elapsed time; with latency set a replay sleeps for the
+    recorded time (times latency) so benchmarks see realistic waits.
+    Identical requests replay in recorded order, the last one repeats.
+    """
+
+    version = 1
+
+    def __init__(self, path, mode='replay', latency=0.0, session=None):
+        """
+        :param path: string, required, cassette file (.json.gz)
+        :param mode: string, optional, see modes
+        :param latency: float, optional, replay sleeps recorded elapsed * latency, 0 no sleep
+        :param session: requests.Session, optional, used to record (default a new one)
+        :return: void
+        """
+        if mode not in modes:
+            raise ValueError('Cassette mode "%s" is not one of %s' % (mode, ', '.join(modes)))
+        self.path = path
+        self.latency = latency
+        self.session = session
+        self.lock = threading.Lock()
+        self.interactions = []
+        self.played = {}  # key: replays so far
+        self.dirty = False
+        if mode == 'once':
+            mode = 'replay' if os.path.isfile(path) else 'record'
+        self.recording = mode == 'record'
+        self.recorded = {}  # key: [interaction]
+        if not self.recording:
+            self.load()
+
+    def load(self):
+        """
+        :return: void, reads the cassette, a missing file is an error while replaying
+        """
+        if not os.path.isfile(self.path):
+            raise CassetteError('No cassette at %s, record it first' % self.path)
+        with gzip.open(self.path, 'rb') as cassette_file:
+            cassette = json.loads(cassette_file.read().decode('utf-8'))
+        self.interactions = cassette['interactions']
+        for interaction in self.interactions:
+            key = (interaction['method'], interaction['url'], interaction['body_sha1'])
+            self.recorded.setdefault(key, []).append(interaction)
+
+    def save(self):
+        """
+        Write what was recorded, gzipped, atomically
+        :return: string, cassette path or None when nothing was recorded
+        """
+        with self.lock:
+            if not self.dirty:
+                return None
+            payload = json.dumps(
+                dict(version=self.version, interactions=self.interactions),
+                sort_keys=True, separators=(',', ':'),
+            ).encode('utf-8')
+            self.dirty = False
+        buf = io.BytesIO()
+        gzip_file = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)  # same bytes for same traffic
+        try:
+            gzip_file.write(payload)
+        finally:
+            gzip_file.close()
+        logging.info('Cassette %s: %s interactions', self.path, len(self.interactions))
+        return atomic_write(self.path, buf.getvalue())
+
+    def request(self, method, url, params=None, data=None, headers=None, timeout=None,
+                stream=False, **kwargs):
+        """
+        session.request() replacement
+        :return: requests.Response
+        """
+        key = request_key(method, url, params, data)
+        if self.recording:
+            return self.record(key, method, url, params, data, headers, timeout, stream, kwargs)
+        return self.replay(key)
+
+    def get(self, url, **kwargs):
+        return self.request('get', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('post', url, data=data, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('put', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('delete', url, **kwargs)
+
+    def record(self, key, method, url, params, data, headers, timeout, stream, kwargs):
+        """
+        Make the real request and keep it, request headers (auth tokens) are never stored
+        :return: requests.Response, body already read
+        """
+        if self.session is None:
+            self.session = requests.Session()
+        interaction = dict(method=key[0], url=key[1], body_sha1=key[2])
+        started = time.time()
+        try:
+            req = self.session.request(
+                method.upper(), url, params=params, data=data, headers=headers,
+                timeout=timeout, stream=stream, **kwargs
+            )
+            content = req.content
+        except requests.exceptions.RequestException as e:
+            interaction.update(
+                error=type(e).__name__, message=str(e), elapsed=time.time() - started
+            )
+            self.add(interaction)
+            raise
+        elapsed = getattr(req, 'elapsed', None)
+        body, encoding = encode_body(content)
+        interaction.update(
+            status_code=req.status_code,
+            reason=getattr(req, 'reason', None),
+            headers=dict(req.headers),
+            body=body,
+            encoding=encoding,
+            elapsed=elapsed.total_seconds() if elapsed is not None else time.time() - started,
+        )
+        self.add(interaction)
+        return req
+
+    def add(self, interaction):
+        """
+        :param interaction: dict
+        :return: void
+        """
+        with self.lock:
+            self.interactions.append(interaction)
+            self.dirty = True
+
+    def replay(self, key):
+        """
+        :param key: tuple, request_key()
+        :return: requests.Response
+        """
+        with self.lock:
+            interactions = self.recorded.get(key)
+            if not interactions:
+                raise CassetteError('%s %s (body %s) is not on cassette %s' % (
+                    key[0], key[1], key[2], self.path
+                ))
+            played = self.played.get(key, 0)
+            self.played[key] = played + 1
+            interaction = interactions[min(played, len(interactions) - 1)]
+        if self.latency:
+            time.sleep(interaction['elapsed'] * self.latency)
+        if 'error' in interaction:
+            raise getattr(
+                requests.exceptions, interaction['error'], requests.exceptions.RequestException
+            )(interaction['message'])
+        return self.build_response(interaction)
+
+    @classmethod
+    def build_response(cls, interaction):
+        """
+        :param interaction: dict, a recorded response
+        :return: requests.Response with the body already in memory
+        """
+        res = requests.Response()
+        res.status_code = interaction['status_code']
+        res.reason = interaction.get('reason')
+        res.headers = CaseInsensitiveDict(interaction['headers'])
+        res.url = interaction['url']
+        res.encoding = 'utf-8' if interaction['encoding'] == 'utf-8' else None
+        res._content = decode_body(interaction['body'], interaction['encoding'])
+        res._content_consumed = True  # iter_content() slices the body
+        res.elapsed = timedelta(seconds=interaction['elapsed'])
+        return res
+
+    def close(self):
+        """
+        :return: void, saves when recording
+        """
+        if self.recording:
+            self.save()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Distributed extraction: plan page/shard tasks onto a work queue, workers claim them"""
+
+from __future__ import print_function
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from jobs.orders import ExtractOrders, to_timestamp
+from output import RunOutput, new_run_id
+from rate_budget import SharedRateBudget
+from shopify import Shopify
+from shopify_creds import ShopifyCreds
+from work_queue import open_queue
+
+# resources planned as page=N tasks, orders are planned as created_at shards
+page_resources = ('products', 'custom_collections', 'smart_collections', 'collects')
+
+
+def plan(queue, run_id, resources, shopify, limit=250):
+    """
+    Turn count.json results into tasks, one per page (or order shard)
+    :param queue: work_queue.SqliteQueue or RedisQueue
+    :param run_id: string, the run the tasks (and their files) belong to
+    :param resources: list, page_resources and/or 'orders'
+    :param shopify: Shopify, read only object used for the count calls
+    :param limit: int, page size of the page tasks
+    :return: dict {resource: tasks planned} or None on fail (writes to shopify.errors)
+    """
+    planned = {}
+    for resource in resources:
+        if resource == 'orders':
+            orders = ExtractOrders(shopify.creds)
+            orders.rate_budget = shopify.rate_budget
+            shards = orders.plan_shards(
+                to_timestamp(orders.created_at_min), int(time.time())
+            )
+            if shards is None:
+                shopify.errors += orders.errors
+                return None
+            for start, end, count in shards:
+                queue.put(run_id, 'orders shard %s %s' % (start, end), dict(
+                    kind='orders_shard', start=start, end=end, count=count,
+                ))
+            planned[resource] = len(shards)
+            continue
+
+        if resource not in page_resources:
+            shopify.errors.append('Can not plan %s, not a page resource or orders' % resource)
+            return None
+        call = 'admin/%s/count.json' % resource
+        res = shopify.shopify_get(call)
+        if res is None:
+            shopify.errors.append('calling %s returned None' % call)
+            return None
+        pages = -(-res.get('count', 0) // limit)
+        for page in range(1, pages + 1):
+            queue.put(run_id, '%s page %s' % (resource, page), dict(
+                kind='page', resource=resource, page=page, limit=limit,
+            ))
+        planned[resource] = pages
+    logging.info('Planned run %s: %s', run_id, planned)
+    return planned
+
+
+class Worker(object):
+
+    """
+    Claims tasks of one run until none are left. A heartbeat thread keeps
+    the lease of the running task alive, a failed task is handed back to the
+    queue (retried later, possibly by another worker) and every API call
+    goes through a SharedRateBudget kept in the queue's store.
+    """
+
+    # seconds between claims while other workers still hold leases
+    poll_interval = 2.0
+
+    def __init__(self, queue, run_id, shopify, worker_id=None, ndjson=False, base_dir=None):
+        """
+        :param queue: work_queue.SqliteQueue or RedisQueue
+        :param run_id: string, required
+        :param shopify: Shopify, object used for page calls (made read only)
+        :param worker_id: string, optional, defaults to host:pid:random
+        :param ndjson: bool, optional, see output.RunOutput
+        :param base_dir: string, optional, runs folder, defaults to json/runs
+        :return: void
+        """
+        self.queue = queue
+        self.run_id = run_id
+        self.shopify = shopify
+        self.shopify.read_only = True
+        if self.shopify.rate_budget is None:
+            self.shopify.rate_budget = SharedRateBudget(queue)
+        self.worker_id = worker_id or '%s:%s:%s' % (
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6]
+        )
+        self.ndjson = ndjson
+        self.base_dir = base_dir
+        self.orders = None
+
+    def run(self):
+        """
+        :return: dict {done, retried, failed, lost} counts for this worker
+        """
+        summary = dict(done=0, retried=0, failed=0, lost=0)
+        while True:
+            task = self.queue.claim(self.worker_id, self.run_id)
+            if task is None:
+                counts = self.queue.counts(self.run_id)
+                if not counts.get('pending') and not counts.get('leased'):
+                    return summary
+                time.sleep(self.poll_interval)  # leased elsewhere or waiting for a retry
+                continue
+
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=self.heartbeat, args=(task, stop))
+            heartbeat.daemon = True
+            heartbeat.start()
+            try:
+                entries = self.execute(task)
+                error = None if entries is not None else 'task returned None'
+            except Exception as e:  # goes back on the queue, the worker carries on
+                logging.exception('Task %s raised', task['key'])
+                entries, error = None, '%r' % e
+            finally:
+                stop.set()
+                heartbeat.join()
+
+            if error is None:
+                finished = self.queue.complete(task, self.worker_id, entries)
+                summary['done' if finished else 'lost'] += 1
+                continue
+            status = self.queue.fail(task, self.worker_id, error)
+            if status is None:
+                summary['lost'] += 1
+            else:
+                summary['retried' if status == 'pending' else 'failed'] += 1
+                logging.warning('Task %s failed (%s), %s', task['key'], error, status)
+
+    def heartbeat(self, task, stop):
+        """
+        Extend the lease every third of it until stop is set
+        :param task: dict
+        :param stop: threading.Event
+        :return: void
+        """
+        while not stop.wait(self.queue.lease_seconds / 3.0):
+            if not self.queue.extend(task, self.worker_id):
+                logging.warning('Lost the lease of %s', task['key'])
+                return
+
+    def execute(self, task):
+        """
+        Fetch and write one task
+        :param task: dict, output of queue.claim()
+        :return: list of manifest entries written or None on fail
+        """
+        payload = task['payload']
+        output = RunOutput(self.run_id, self.base_dir, self.ndjson)
+        if payload['kind'] == 'orders_shard':
+            if self.orders is None:
+                self.orders = ExtractOrders(self.shopify.creds)
+                self.orders.rate_budget = self.shopify.rate_budget
+            self.orders.output = output
+            orders = self.orders.extract_shard((payload['start'], payload['end'], payload['count']))
+            return output.entries if orders is not None else None
+
+        call = 'admin/%s.json?page=%s&limit=%s' % (
+            payload['resource'], payload['page'], payload['limit']
+        )
+        res = self.shopify.shopify_get(call)
+        if res is None:
+            return None
+        self.shopify.output = output
+        self.shopify.write_output(
+            res.get(payload['resource'], []),
+            '%s_page_%s' % (payload['resource'], payload['page']),
+            payload['resource'],
+            RunOutput.page_partition(payload['page']),
+        )
+        return output.entries
+
+
+def finish(queue, run_id, base_dir=None):
+    """
+    Write the run manifest from the entries of the completed tasks
+    :param queue: work_queue.SqliteQueue or RedisQueue
+    :param run_id: string
+    :param base_dir: string, optional, runs folder, defaults to json/runs
+    :return: dict {status: count}
+    """
+    output = RunOutput(run_id, base_dir)
+    tasks = queue.tasks(run_id)
+    for task in tasks:
+        if task['status'] == 'done' and task['result']:
+            output.add_entries(task['result'])
+    counts = queue.counts(run_id)
+    output.write_manifest(
+        tasks=counts,
+        failed=[dict(key=task['key'], error=task['error']) for task in tasks
+                if task['status'] == 'failed'],
+    )
+    return counts
+
+
+def work(queue_url, run_id, ndjson=False):
+    """
+    One worker process, module level so a process pool can run it
+    :param queue_url: string, see work_queue.open_queue()
+    :param run_id: string
+    :param ndjson: bool
+    :return: dict, Worker.run() summary
+    """
+    shopify = Shopify(ShopifyCreds())
+    return Worker(open_queue(queue_url), run_id, shopify, ndjson=ndjson).run()
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    :param argv: list, optional, defaults to sys.argv[1:]
+    :return: int exit code
+    """
+    parser = argparse.ArgumentParser(description='ShopifyETL distributed extraction')
+    parser.add_argument('command', choices=('plan', 'work', 'status', 'finish'))
+    parser.add_argument('resources', nargs='*', help='plan: %s, orders' % ', '.join(page_resources))
+    parser.add_argument(
+        '--queue', default=os.path.dirname(os.path.realpath(__file__)) + '/json/queue.db',
+        help='SQLite file (one host) or redis://host:port/db (several hosts)'
+    )
+    parser.add_argument('--run', help='run id, printed by plan (required for the other commands)')
+    parser.add_argument('--limit', type=int, default=250, help='plan: page size')
+    parser.add_argument('--processes', type=int, default=1, help='work: worker processes')
+    parser.add_argument('--ndjson', action='store_true', help='work: write indexed ndjson')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command != 'plan' and not args.run:
+        parser.error('--run is required for %s' % args.command)
+    queue = open_queue(args.queue)
+
+    if args.command == 'plan':
+        shopify = Shopify(ShopifyCreds())
+        shopify.read_only = True
+        shopify.rate_budget = SharedRateBudget(queue)
+        run_id = args.run or new_run_id()
+        if plan(queue, run_id, args.resources or list(page_resources), shopify, args.limit) is None:
+            logging.error('Planning failed: %s', shopify.errors)
+            return 1
+        print(run_id)
+        return 0
+
+    if args.command == 'work':
+        if args.processes > 1:
+            pool = multiprocessing.Pool(args.processes)
+            try:
+                pending = [
+                    pool.apply_async(work, (args.queue, args.run, args.ndjson))
+                    for _ in range(args.processes)
+                ]
+                summaries = [result.get() for result in pending]
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            summaries = [work(args.queue, args.run, args.ndjson)]
+        logging.info('Workers done: %s', summaries)
+
+    counts = queue.counts(args.run)
+    if args.command == 'finish':
+        finish(queue, args.run)
+    print(' '.join('%s=%s' % item for item in sorted(counts.items())))
+    return 1 if counts.get('failed') else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Memory bounded external sort and dedupe of records by id"""
+
+from __future__ import print_function
+import argparse
+import hashlib
+import heapq
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from ndjson import OFFSET_RECORD, index_path
+from snapshot import iter_json_records
+from transform import source_files
+from util import atomic_write
+
+
+class ExternalSort(object):
+
+    """
+    Sort records by id holding at most memory_bytes of them: full buffers are
+    sorted and spilled to temp files (runs), the runs are k-way merged with
+    heapq (at most max_fan_in open at once, more are merged in passes). With
+    dedupe a repeated id keeps the record read last, the newest fetch.
+    """
+
+    # runs merged at once, bounds the open files
+    max_fan_in = 64
+    # bytes counted per buffered record on top of its json (tuple, int, str headers)
+    record_overhead = 120
+
+    def __init__(self, memory_bytes=64 * 1024 * 1024, temp_dir=None, dedupe=True):
+        """
+        :param memory_bytes: int, optional, json bytes buffered before a run is spilled
+        :param temp_dir: string, optional, where runs go (default the system temp folder)
+        :param dedupe: bool, optional, drop repeated ids
+        :return: void
+        """
+        self.memory_bytes = memory_bytes
+        self.temp_dir = temp_dir
+        self.dedupe = dedupe
+        self.records_in = 0
+        self.records_out = 0
+        self.duplicates = 0
+        self.runs = 0
+
+    def sort(self, records):
+        """
+        :param records: iterable of dicts with an 'id' (a list, or iter_json_records())
+        :return: generator of dicts ordered by id
+        """
+        run_dir = tempfile.mkdtemp(dir=self.temp_dir, prefix='sort-')
+        try:
+            buffered = []
+            size = 0
+            run_paths = []
+            for record in records:
+                line = json.dumps(record, separators=(',', ':'))
+                # the read order breaks ties, so the last copy of an id sorts last
+                buffered.append((record['id'], self.records_in, line))
+                self.records_in += 1
+                size += len(line) + self.record_overhead
+                if size >= self.memory_bytes:
+                    run_paths.append(self.spill(buffered, run_dir))
+                    buffered = []
+                    size = 0
+            buffered.sort()
+            while len(run_paths) >= self.max_fan_in:
+                merged = self.spill(heapq.merge(
+                    *[self.read_run(path) for path in run_paths[:self.max_fan_in]]
+                ), run_dir, presorted=True)
+                for path in run_paths[:self.max_fan_in]:
+                    os.remove(path)
+                run_paths = run_paths[self.max_fan_in:] + [merged]
+            streams = [self.read_run(path) for path in run_paths] + [iter(buffered)]
+
+            previous = None
+            for item in heapq.merge(*streams):
+                if previous is not None:
+                    if self.dedupe and previous[0] == item[0]:
+                        self.duplicates += 1
+                    else:
+                        self.records_out += 1
+                        yield json.loads(previous[2])
+                previous = item
+            if previous is not None:
+                self.records_out += 1
+                yield json.loads(previous[2])
+        finally:
+            shutil.rmtree(run_dir, ignore_errors=True)
+        logging.info(
+            'External sort: %s records in, %s out, %s duplicates dropped, %s runs spilled',
+            self.records_in, self.records_out, self.duplicates, self.runs
+        )
+
+    def spill(self, items, run_dir, presorted=False):
+        """
+        :param items: list (sorted here) or iterator of (id, sequence, json line)
+        :param run_dir: string
+        :param presorted: bool, items already come in order
+        :return: string, run file path
+        """
+        if not presorted:
+            items.sort()
+        self.runs += 1
+        path = os.path.join(run_dir, 'run_%05d' % self.runs)
+        with open(path, 'w') as run_file:
+            for record_id, sequence, line in items:
+                run_file.write('%d\t%d\t%s\n' % (record_id, sequence, line))
+        return path
+
+    @classmethod
+    def read_run(cls, path):
+        """
+        :param path: string, run file
+        :return: generator of (id, sequence, json line)
+        """
+        with open(path) as run_file:
+            for row in run_file:
+                record_id, sequence, line = row.rstrip('\n').split('\t', 2)
+                yield int(record_id), int(sequence), line
+
+
+def write_sorted(records, path, ndjson=False):
+    """
+    Stream id ordered records into a json list (or ndjson with its .idx, which
+    comes out sorted for free) through a temp file renamed into place
+    :param records: iterable of dicts, ordered by id
+    :param path: string, target file
+    :param ndjson: bool, optional
+    :return: dict (records, bytes, sha256, index path or None)
+    """
+    target_dir = os.path.dirname(path)
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    handle, temp_path = tempfile.mkstemp(dir=target_dir, prefix='.tmp-')
+    digest = hashlib.sha256()
+    offsets = []
+    size = count = 0
+    try:
+        with os.fdopen(handle, 'wb') as target_file:
+            for record in records:
+                if ndjson:
+                    chunk = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+                    offsets.append(OFFSET_RECORD.pack(record['id'], size, len(chunk)))
+                else:
+                    chunk = ('[' if not count else ', ').encode('utf-8') + json.dumps(
+                        record).encode('utf-8')
+                target_file.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+                count += 1
+            if not ndjson:
+                chunk = b']' if count else b'[]'
+                target_file.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        os.chmod(temp_path, 0o644)  # mkstemp is owner only
+        os.rename(temp_path, path)
+    except Exception:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        raise
+    index = None
+    if ndjson:
+        index = atomic_write(index_path(path), b''.join(offsets))  # after the data, as always
+    return dict(records=count, bytes=size, sha256=digest.hexdigest(), index=index)
+
+
+def sort_files(paths, path, memory_bytes=64 * 1024 * 1024, ndjson=False, temp_dir=None):
+    """
+    Merge page files into one id ordered file without duplicates
+    :param paths: list of .json/.ndjson page files
+    :param path: string, target file
+    :param memory_bytes: int, optional, see ExternalSort
+    :param ndjson: bool, optional, write ndjson + index instead of a json list
+    :param temp_dir: string, optional, where runs are spilled
+    :return: dict (records, bytes, sha256, index, records_in, duplicates, runs)
+    """
+    sorter = ExternalSort(memory_bytes, temp_dir)
+    written = write_sorted(sorter.sort(iter_json_records(paths)), path, ndjson)
+    written.update(records_in=sorter.records_in, duplicates=sorter.duplicates, runs=sorter.runs)
+    return written
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    :param argv: list, optional, defaults to sys.argv[1:]
+    :return: int exit code
+    """
+    parser = argparse.ArgumentParser(description='Sort and dedupe records by id, memory bounded')
+    parser.add_argument('output', help='target file, .ndjson writes ndjson plus an .idx')
+    parser.add_argument('sources', nargs='+', help='page files or run directories')
+    parser.add_argument(
+        '--resource', default='products', help='resource read from run directories'
+    )
+    parser.add_argument('--memory-mb', type=float, default=64, help='records held before spilling')
+    parser.add_argument('--temp-dir', default=None, help='where sorted runs are spilled')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    paths = []
+    for source in args.sources:
+        paths += source_files(source, args.resource)
+    stats = sort_files(
+        paths, args.output, int(args.memory_mb * 1024 * 1024),
+        args.output.endswith('.ndjson'), args.temp_dir,
+    )
+    print(json.dumps(stats, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Catalog audit statistics over extracted variants, no API calls"""
+
+from __future__ import print_function
+import logging
+from shopify import Shopify
+try:
+    import numpy
+except ImportError:  # optional, only the audit needs it
+    numpy = None
+
+# variant fields loaded into the arrays, in column order
+audit_fields = ('price', 'compare_at_price', 'grams', 'inventory_quantity')
+
+
+def to_float(value):
+    """
+    :param value: string/number/None as found in a variant ("19.99", 0, None, "")
+    :return: float, nan when missing
+    """
+    if value is None or value == '':
+        return float('nan')
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class AuditCatalog(Shopify):
+
+    """Vectorized audit of the variants of extracted products (needs numpy)"""
+
+    # variants loaded per chunk before they become arrays, bounds the python objects alive
+    chunk_size = 100000
+    # modified z-score (median/MAD) above which a price or weight is an outlier
+    outlier_z = 3.5
+    # percentiles reported for every field
+    percentiles = (1, 5, 25, 50, 75, 95, 99)
+    # variant ids listed per flag in the report, the counts are always complete
+    max_ids = 1000
+
+    def __init__(self, creds=None, verbose=False):
+        """
+        Call the super, trust but verify.
+        :return:
+        """
+        super(AuditCatalog, self).__init__(creds, verbose)
+
+    def load_variants(self, products):
+        """
+        Variant columns as arrays, filled chunk_size variants at a time
+        :param products: iterable of products (output of ExtractProducts.extract_product())
+        :return: dict of arrays: product_id, variant_id (int64) and one float64 per audit_fields
+        """
+        chunks = []
+        ids = []
+        values = []
+
+        def flush():
+            chunk = dict(
+                (name, column) for name, column in zip(
+                    ('product_id', 'variant_id'),
+                    numpy.array(ids, dtype=numpy.int64).reshape(-1, 2).T
+                )
+            )
+            table = numpy.array(values, dtype=numpy.float64).reshape(-1, len(audit_fields))
+            for position, name in enumerate(audit_fields):
+                chunk[name] = table[:, position]
+            chunks.append(chunk)
+            del ids[:]
+            del values[:]
+
+        for product in products:
+            for variant in product.get('variants', []):
+                ids.append((product['id'], variant['id']))
+                values.append([to_float(variant.get(name)) for name in audit_fields])
+                if len(ids) >= self.chunk_size:
+                    flush()
+        if ids or not chunks:
+            flush()
+        return dict(
+            (name, numpy.concatenate([chunk[name] for chunk in chunks]))
+            for name in chunks[0]
+        )
+
+    def distribution(self, values):
+        """
+        :param values: float64 array, nan is missing
+        :return: dict (count, missing, min, max, mean, std, percentiles)
+        """
+        present = values[~numpy.isnan(values)]
+        if not present.size:
+            return dict(count=0, missing=int(values.size))
+        return dict(
+            count=int(present.size),
+            missing=int(values.size - present.size),
+            min=float(present.min()),
+            max=float(present.max()),
+            mean=round(float(present.mean()), 4),
+            std=round(float(present.std()), 4),
+            percentiles=dict(
+                ('p%s' % percentile, float(value)) for percentile, value in zip(
+                    self.percentiles, numpy.percentile(present, self.percentiles)
+                )
+            ),
+        )
+
+    def outliers(self, values):
+        """
+        Robust outliers by modified z-score, 0.6745 * |x - median| / MAD
+        :param values: float64 array, nan is missing
+        :return: bool array
+        """
+        present = ~numpy.isnan(values)
+        flagged = numpy.zeros(values.shape, dtype=bool)
+        if not present.any():
+            return flagged
+        median = numpy.median(values[present])
+        mad = numpy.median(numpy.abs(values[present] - median))
+        if not mad:
+            return flagged  # over half the values are identical, nothing stands out
+        flagged[present] = 0.6745 * numpy.abs(values[present] - median) / mad > self.outlier_z
+        return flagged
+
+    def flag(self, variant_ids, mask):
+        """
+        :param variant_ids: int64 array
+        :param mask: bool array
+        :return: dict (count, variant_ids capped at max_ids)
+        """
+        return dict(
+            count=int(mask.sum()),
+            variant_ids=variant_ids[mask][:self.max_ids].tolist(),
+        )
+
+    def collection_rollups(self, variants, product_collections):
+        """
+        Per collection totals. Variants are reduced to one row per product
+        first, then product rows are scattered onto (product, collection) pairs.
+        :param variants: dict of arrays, output of load_variants()
+        :param product_collections: list, output of JoinProductCollections.join_product_collections()
+        :return: list of dicts ordered by collection_id
+        """
+        pairs = numpy.array([
+            (row['product_id'], collection_id)
+            for row in product_collections for collection_id in row['collection_ids']
+        ], dtype=numpy.int64).reshape(-1, 2)
+        if not pairs.size or not variants['product_id'].size:
+            return []
+
+        price = variants['price']
+        inventory = numpy.nan_to_num(variants['inventory_quantity'])
+        priced = ~numpy.isnan(price)
+        product_ids, product_index = numpy.unique(variants['product_id'], return_inverse=True)
+        per_product = dict(
+            variants=numpy.bincount(product_index, minlength=product_ids.size),
+            priced=numpy.bincount(product_index, priced, minlength=product_ids.size),
+            price_sum=numpy.bincount(
+                product_index, numpy.where(priced, price, 0), minlength=product_ids.size
+            ),
+            zero_price=numpy.bincount(product_index, price == 0, minlength=product_ids.size),
+            inventory=numpy.bincount(product_index, inventory, minlength=product_ids.size),
+            inventory_value=numpy.bincount(
+                product_index, numpy.where(priced, price, 0) * inventory,
+                minlength=product_ids.size
+            ),
+        )
+        price_min = numpy.full(product_ids.size, numpy.inf)
+        price_max = numpy.full(product_ids.size, -numpy.inf)
+        numpy.minimum.at(price_min, product_index[priced], price[priced])
+        numpy.maximum.at(price_max, product_index[priced], price[priced])
+
+        # pairs whose product has variants in this extraction
+        position = numpy.searchsorted(product_ids, pairs[:, 0])
+        position[position == product_ids.size] = 0
+        known = product_ids[position] == pairs[:, 0]
+        position = position[known]
+        collection_ids, collection_index = numpy.unique(pairs[known, 1], return_inverse=True)
+        size = collection_ids.size
+
+        totals = dict(
+            (name, numpy.bincount(collection_index, column[position], minlength=size))
+            for name, column in per_product.items()
+        )
+        products = numpy.bincount(collection_index, minlength=size)
+        collection_min = numpy.full(size, numpy.inf)
+        collection_max = numpy.full(size, -numpy.inf)
+        numpy.minimum.at(collection_min, collection_index, price_min[position])
+        numpy.maximum.at(collection_max, collection_index, price_max[position])
+
+        rollups = []
+        for index in range(size):
+            priced_count = totals['priced'][index]
+            rollups.append(dict(
+                collection_id=int(collection_ids[index]),
+                products=int(products[index]),
+                variants=int(totals['variants'][index]),
+                zero_price=int(totals['zero_price'][index]),
+                price_min=float(collection_min[index]) if priced_count else None,
+                price_max=float(collection_max[index]) if priced_count else None,
+                price_mean=round(float(totals['price_sum'][index] / priced_count), 4)
+                if priced_count else None,
+                inventory=int(totals['inventory'][index]),
+                inventory_value=round(float(totals['inventory_value'][index]), 2),
+            ))
+        return rollups
+
+    def audit_catalog(self, products, product_collections=None, write=True):
+        """
+        Distributions, outliers, flags and per collection rollups of variant
+        price, compare_at_price, grams and inventory_quantity
+        :param products: list, required, output of ExtractProducts.extract_product()
+        :param product_collections: list, optional, output of
+            JoinProductCollections.join_product_collections(), no rollups without it
+        :param write: bool, optional, default True (write to /json folder)
+        :return: dict report or None on fail (writes to self.errors)
+        """
+        if numpy is None:
+            msg = 'Catalog audit requires numpy (pip install -r requirements.txt).'
+            logging.error(msg)
+            self.errors.append(msg)
+            return None
+        if products is None:
+            msg = 'Catalog audit requires the products in memory.'
+            logging.error(msg)
+            self.errors.append(msg)
+            return None
+
+        logging.info('\nBeginning Catalog Audit')
+        variants = self.load_variants(products)
+        variant_ids = variants['variant_id']
+        price = variants['price']
+        compare_at = variants['compare_at_price']
+        with numpy.errstate(invalid='ignore'):  # nan compares False
+            flags = dict(
+                zero_price=self.flag(variant_ids, price == 0),
+                missing_price=self.flag(variant_ids, numpy.isnan(price)),
+                # "on sale" for more than the compare at price
+                price_above_compare_at=self.flag(variant_ids, compare_at < price),
+                negative_inventory=self.flag(variant_ids, variants['inventory_quantity'] < 0),
+                zero_weight=self.flag(variant_ids, variants['grams'] == 0),
+                # zeros have their own flags, leave them out of the spread
+                price_outlier=self.flag(variant_ids, self.outliers(
+                    numpy.where(price > 0, price, numpy.nan)
+                )),
+                weight_outlier=self.flag(variant_ids, self.outliers(
+                    numpy.where(variants['grams'] > 0, variants['grams'], numpy.nan)
+                )),
+            )
+
+        audit_results = dict(
+            products=len(numpy.unique(variants['product_id'])),
+            variants=int(variant_ids.size),
+            distributions=dict(
+                (name, self.distribution(variants[name])) for name in audit_fields
+            ),
+            flags=flags,
+        )
+        if product_collections is not None:
+            audit_results['collections'] = self.collection_rollups(variants, product_collections)
+
+        if write:
+            self.write_output(audit_results, 'catalog_audit', 'catalog_audit')
+
+        logging.info('\nEnd Catalog Audit')
+        logging.info(
+            'Job complete: %s Variants audited, %s', variant_ids.size,
+            ', '.join('%s=%s' % (name, flag['count']) for name, flag in sorted(flags.items()))
+        )
+        return audit_results
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Change sets between extractions, no API calls"""
+
+from __future__ import print_function
+import logging
+from shopify import Shopify
+from snapshot import SnapshotDiff
+
+
+class DiffSnapshots(Shopify):
+
+    """Compare fresh extractions with the previous snapshot and write only what changed"""
+
+    # string or None, compare on this field (e.g. 'updated_at') instead of a content hash
+    compare_field = None
+    # int, bytes of new index records held before a sorted run is spilled to disk
+    memory_bytes = 64 * 1024 * 1024
+
+    def __init__(self, creds=None, verbose=False):
+        """
+        Call the super, what changed? Everything, always.
+        :return:
+        """
+        super(DiffSnapshots, self).__init__(creds, verbose)
+
+    def diff_products(self, products, write=True):
+        """
+        Added/changed/deleted products since the last diff
+        :param products: list, required, output of ExtractProducts.extract_product()
+        :param write: bool, optional, default True (write change sets, store the new index)
+        :return: dict of counts + change set path or None on fail (writes to self.errors)
+        """
+        return self.diff_snapshot('products', products, write)
+
+    def diff_snapshot(self, name, records, write=True):
+        """
+        Diff any extraction against the snapshot index of the same name
+        :param name: string, required, snapshot name
+        :param records: iterable of records with an 'id'
+        :param write: bool, optional, default True
+        :return: dict of counts + change set path or None on fail (writes to self.errors).
+            In the run layout the change sets are the <name>_changes resource.
+        """
+        if records is None:
+            msg = (
+                'Snapshot diff of %s requires the extraction results in memory '
+                '(not available when the extraction runs with less_memory).' % name
+            )
+            logging.error(msg)
+            self.errors.append(msg)
+            return None
+        with self.phase('write'):
+            return SnapshotDiff(
+                name, field=self.compare_field, output=self.output, memory_bytes=self.memory_bytes
+            ).diff(records, write=write)
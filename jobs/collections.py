@@ -4,10 +4,9 @@
 """Collection data extraction"""
 
 from __future__ import print_function
-from time import sleep
 import logging
 from shopify import Shopify
-from util import write_json
+from output import RunOutput
 
 
 class ExtractCollectionData(Shopify):
@@ -20,8 +19,13 @@ class ExtractCollectionData(Shopify):
     page = 1
     # pagination default for page size.
     limit = 20
+    # Boolean, when True limit adapts per resource within [10, 250] (see page_size.py)
+    # and pages follow a since_id cursor
+    auto_limit = False
     # Boolean, when True each page of data will write a file with a page number
     chunk = False
+    # extract only, shopify_request() refuses anything but GET
+    read_only = True
     # Boolean, when True a list will not be kept in memory or
     # returned (None instead)
     less_memory = False
@@ -48,35 +52,20 @@ class ExtractCollectionData(Shopify):
             self.errors.append('calling %s returned None' % call)
             return False
 
-        page = self.page
-        limit = self.limit
         collection_starting_count = res.get('count', None)
         collection_results = []
         logging.info('\nBeginning Custom Collection Extraction')
-        while page:
-            logging.info('\n------Page: %s via limit %s', page, limit)
-            call = 'admin/custom_collections.json?page=%s&limit=%s'
-            call = call % (page, limit)
-            res = self.shopify_get(call)
-            if res is None:
-                self.errors.append('The call [%s] returned None.' % call)
-                break
-            this_page = res.get('custom_collections', False)
-            if'custom_collections' not in res or not this_page:
-                page = None
-            else:
-                if self.chunk and write:
-                    write_json(
-                        this_page,
-                        'extract_custom_collection_page_%s' % page,
-                        overwrite_files=self.creds.overwrite_files
-                    )
-                # {u'custom_collections': []} is the return for no results
-                if not self.less_memory:
-                    collection_results += this_page
-                page += 1
-                logging.info('Sleeping for %s', self.sleep_interval)
-                sleep(self.sleep_interval)
+        for page, this_page in self.paginate('custom_collections'):
+            if self.chunk and write:
+                self.write_output(
+                    this_page,
+                    'extract_custom_collection_page_%s' % page,
+                    'custom_collections',
+                    RunOutput.page_partition(page),
+                )
+            # {u'custom_collections': []} is the return for no results
+            if not self.less_memory:
+                collection_results += this_page
 
         logging.info('\nEnd Custom Collection Extraction')
 
@@ -84,7 +73,8 @@ class ExtractCollectionData(Shopify):
             logging.info('\nCustom Collection Extraction has errors')
             return None
 
-        if collection_starting_count != len(collection_results):
+        if collection_starting_count != len(collection_results) or self.has_duplicates(
+                collection_results):
             msg = (
                 'Collection starting count (%s) != number of results'
                 ' pulled from the API (%s).'
@@ -93,15 +83,15 @@ class ExtractCollectionData(Shopify):
                 len(collection_results),
             )
             logging.warning(msg)
-            self.errors.append(msg)
-            return None
+            if self.less_memory:
+                self.errors.append(msg)
+                return None
+            collection_results = self.reconcile('custom_collections', collection_results)
+            if collection_results is None:
+                return None
 
         if write:
-            write_json(
-                collection_results,
-                'custom_collection',
-                overwrite_files=self.creds.overwrite_files
-            )
+            self.write_output(collection_results, 'custom_collection', 'custom_collections')
 
         logging.info(
             'Job complete: %s Custom Collections found', len(
@@ -124,34 +114,19 @@ class ExtractCollectionData(Shopify):
             return False
         collection_starting_count = res.get('count', None)
 
-        page = self.page
-        limit = self.limit
         collection_results = []
         logging.info('\nBeginning Smart Collection Extraction')
-        while page:
-            logging.info('\n------Page: %s via limit %s', page, limit)
-            call = 'admin/smart_collections.json?page=%s&limit=%s'
-            call = call % (page, limit)
-            res = self.shopify_get(call)
-            if res is None:
-                self.errors.append('The call [%s] returned None.' % call)
-                break
-            this_page = res.get('smart_collections', False)
-            if'smart_collections' not in res or not this_page:
-                page = None
-            else:
-                if self.chunk and write:
-                    write_json(
-                        this_page,
-                        'extract_custom_collection_page_%s' % page,
-                        overwrite_files=self.creds.overwrite_files
-                    )
-                # {u'custom_collections': []} is the return for no results
-                if not self.less_memory:
-                    collection_results += this_page
-                page += 1
-                logging.info('Sleeping for %s', self.sleep_interval)
-                sleep(self.sleep_interval)
+        for page, this_page in self.paginate('smart_collections'):
+            if self.chunk and write:
+                self.write_output(
+                    this_page,
+                    'extract_smart_collection_page_%s' % page,
+                    'smart_collections',
+                    RunOutput.page_partition(page),
+                )
+            # {u'custom_collections': []} is the return for no results
+            if not self.less_memory:
+                collection_results += this_page
 
         logging.info('\nEnd Smart Collection Extraction')
 
@@ -159,7 +134,8 @@ class ExtractCollectionData(Shopify):
             logging.info('\nSmart Collection Extraction has errors')
             return None
 
-        if collection_starting_count != len(collection_results):
+        if collection_starting_count != len(collection_results) or self.has_duplicates(
+                collection_results):
             msg = (
                 'Collection starting count (%s) != number of results '
                 'pulled from the API (%s).'
@@ -168,15 +144,15 @@ class ExtractCollectionData(Shopify):
                 len(collection_results),
             )
             logging.warn(msg)
-            self.errors.append(msg)
-            return None
+            if self.less_memory:
+                self.errors.append(msg)
+                return None
+            collection_results = self.reconcile('smart_collections', collection_results)
+            if collection_results is None:
+                return None
 
         if write:
-            write_json(
-                collection_results,
-                'smart_collection',
-                overwrite_files=self.creds.overwrite_files
-            )
+            self.write_output(collection_results, 'smart_collection', 'smart_collections')
 
         logging.info(
             'Job complete: %s Smart Collections found', len(
@@ -199,34 +175,19 @@ class ExtractCollectionData(Shopify):
             return False
         collection_starting_count = res.get('count', None)
 
-        page = self.page
-        limit = self.limit
         collection_results = []
         logging.info('\nBeginning Collect Extraction')
-        while page:
-            logging.info('\n------Page: %s via limit %s', page, limit)
-            call = 'admin/collects.json?page=%s&limit=%s'
-            call = call % (page, limit)
-            res = self.shopify_get(call)
-            if res is None:
-                self.errors.append('The call [%s] returned None.' % call)
-                break
-            this_page = res.get('collects', False)
-            if'collects' not in res or not this_page:
-                page = None
-            else:
-                if self.chunk and write:
-                    write_json(
-                        this_page,
-                        'extract_custom_collection_page_%s' % page,
-                        overwrite_files=self.creds.overwrite_files
-                    )
-                # {u'custom_collections': []} is the return for no results
-                if not self.less_memory:
-                    collection_results += this_page
-                page += 1
-                logging.info('Sleeping for %s', self.sleep_interval)
-                sleep(self.sleep_interval)
+        for page, this_page in self.paginate('collects'):
+            if self.chunk and write:
+                self.write_output(
+                    this_page,
+                    'extract_collect_page_%s' % page,
+                    'collects',
+                    RunOutput.page_partition(page),
+                )
+            # {u'custom_collections': []} is the return for no results
+            if not self.less_memory:
+                collection_results += this_page
 
         logging.info('\nEnd Collect Extraction')
 
@@ -234,22 +195,23 @@ class ExtractCollectionData(Shopify):
             logging.info('\nCustom Collect has errors')
             return None
 
-        if collection_starting_count != len(collection_results):
+        if collection_starting_count != len(collection_results) or self.has_duplicates(
+                collection_results):
             msg = 'Collection starting count (%s) != number of results pulled ' \
                 'from the API (%s).' % (
                     collection_starting_count,
                     len(collection_results),
                 )
             logging.warn(msg)
-            self.errors.append(msg)
-            return None
+            if self.less_memory:
+                self.errors.append(msg)
+                return None
+            collection_results = self.reconcile('collects', collection_results)
+            if collection_results is None:
+                return None
 
         if write:
-            write_json(
-                collection_results,
-                'collect',
-                overwrite_files=self.creds.overwrite_files
-            )
+            self.write_output(collection_results, 'collect', 'collects')
 
         logging.info(
             'Job complete: %s Collect (relationships) found', len(
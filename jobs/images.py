@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Product image mirroring, content addressed"""
+
+from __future__ import print_function
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import requests
+from shopify import Shopify
+from util import atomic_write, thread_map
+
+
+class MirrorImages(Shopify):
+
+    """
+    Download the images of extracted products into json/images/objects/.
+    Files are named by content so an image shared by products (or re-uploaded
+    under a new URL) is stored once, and index.json keeps the ETag and
+    Last-Modified of every URL so later runs only ask "changed?" (304).
+    """
+
+    # int, downloads at once
+    workers = 8
+    # seconds before an image request times out
+    timeout = 60
+    # retries of one image after a connection error or 5xx
+    retries = 2
+    # bytes read per chunk while streaming an image to disk
+    chunk_bytes = 64 * 1024
+    # string, mirror folder (objects/ + index.json), None is json/images
+    mirror_dir = None
+    # extract only, shopify_request() refuses anything but GET
+    read_only = True
+
+    def __init__(self, creds=None, verbose=False):
+        """
+        Call the super, say cheese.
+        :return:
+        """
+        super(MirrorImages, self).__init__(creds, verbose)
+        self.index = {}  # url: dict(sha256, etag, last_modified, extension)
+        self.lock = threading.Lock()
+
+    def get_mirror_dir(self):
+        """
+        :return: string, absolute mirror folder
+        """
+        if self.mirror_dir is None:
+            return os.path.join(
+                os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'json', 'images'
+            )
+        return self.mirror_dir
+
+    def object_path(self, digest, extension):
+        """
+        :param digest: string, sha256 hex
+        :param extension: string, e.g. '.jpg'
+        :return: string, objects/<2 chars>/<digest><extension>
+        """
+        return os.path.join(self.get_mirror_dir(), 'objects', digest[:2], digest + extension)
+
+    def load_index(self):
+        """
+        :return: void, fills self.index from index.json (missing file, empty index)
+        """
+        path = os.path.join(self.get_mirror_dir(), 'index.json')
+        if os.path.isfile(path):
+            with open(path) as index_file:
+                self.index = json.load(index_file)
+
+    def save_index(self):
+        """
+        :return: string, index path
+        """
+        with self.lock:
+            payload = json.dumps(self.index, sort_keys=True)
+        return atomic_write(os.path.join(self.get_mirror_dir(), 'index.json'), payload)
+
+    @classmethod
+    def iter_images(cls, products):
+        """
+        Stream (product_id, image_id, url) from product output, each URL once
+        :param products: iterable of products (output of ExtractProducts.extract_product())
+        :return: generator of tuples
+        """
+        seen = set()
+        for product in products:
+            for image in product.get('images', []):
+                url = image.get('src')
+                if url and url not in seen:
+                    seen.add(url)
+                    yield product['id'], image.get('id'), url
+
+    def mirror_images(self, products, write=True):
+        """
+        Mirror every product image, unchanged ones are skipped by a conditional request
+        :param products: list, required, output of ExtractProducts.extract_product()
+        :param write: bool, optional, default True (write the image table to /json folder)
+        :return: list of [product_id, image_id, url, sha256, status] or None on fail
+            (writes to self.errors). status is downloaded, not_modified or failed.
+        """
+        if products is None:
+            msg = 'Image mirroring requires the products in memory.'
+            logging.error(msg)
+            self.errors.append(msg)
+            return None
+
+        self.pool_size = max(self.pool_size, self.workers)
+        self.load_index()
+        logging.info('\nBeginning Image Mirroring into %s', self.get_mirror_dir())
+
+        image_results = []
+        counts = dict(downloaded=0, not_modified=0, failed=0)
+        try:
+            for image, (digest, status), error in thread_map(
+                    lambda image: self.fetch_image(image[2]), self.iter_images(products),
+                    self.workers):
+                if error is not None:
+                    digest, status = None, 'failed'
+                    self.errors.append('Image %s raised %r' % (image[2], error))
+                elif status == 'failed':
+                    self.errors.append('Image %s could not be downloaded' % image[2])
+                counts[status] += 1
+                image_results.append([image[0], image[1], image[2], digest, status])
+        finally:
+            self.save_index()  # what did download is never fetched again
+
+        logging.info('\nEnd Image Mirroring: %s', counts)
+
+        if self.errors:
+            logging.info('\nImage Mirroring has errors')
+            return None
+
+        image_results.sort(key=lambda row: (row[0], row[1]))
+        if write:
+            self.write_output(image_results, 'product_images', 'product_images')
+
+        logging.info('Job complete: %s Images mirrored', len(image_results))
+        return image_results
+
+    def fetch_image(self, url):
+        """
+        Conditional GET of one image streamed into the content addressed store,
+        runs on a worker thread
+        :param url: string
+        :return: tuple (sha256 or None, status)
+        """
+        with self.lock:
+            known = self.index.get(url)
+        headers = {}
+        stored = known is not None and os.path.isfile(
+            self.object_path(known['sha256'], known['extension'])
+        )
+        if stored:
+            if known.get('etag'):
+                headers['If-None-Match'] = known['etag']
+            if known.get('last_modified'):
+                headers['If-Modified-Since'] = known['last_modified']
+
+        for attempt in range(self.retries + 1):
+            try:
+                with self.phase('request'):
+                    req = self.get_session().get(url, headers=headers, stream=True,
+                                                 timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                logging.warning('Image %s attempt %s: %r', url, attempt + 1, e)
+                continue
+            try:
+                if req.status_code == 304:
+                    return known['sha256'], 'not_modified'
+                if req.status_code >= 500:
+                    logging.warning('Image %s attempt %s: %s', url, attempt + 1, req.status_code)
+                    continue
+                if req.status_code != 200:
+                    logging.error('Image %s answered %s', url, req.status_code)
+                    return None, 'failed'
+                with self.phase('write'):
+                    digest = self.store(url, req)
+            finally:
+                req.close()
+            extension = os.path.splitext(url.split('?')[0])[1].lower()
+            with self.lock:
+                self.index[url] = dict(
+                    sha256=digest,
+                    extension=extension,
+                    etag=req.headers.get('ETag'),
+                    last_modified=req.headers.get('Last-Modified'),
+                )
+            return digest, 'downloaded'
+        return None, 'failed'
+
+    def store(self, url, req):
+        """
+        Stream a response to a temp file while hashing it, then move it to
+        its content address unless that object already exists
+        :param url: string, for the file extension
+        :param req: requests.Response opened with stream=True
+        :return: string, sha256 hex
+        """
+        extension = os.path.splitext(url.split('?')[0])[1].lower()
+        temp_dir = os.path.join(self.get_mirror_dir(), 'objects')
+        if not os.path.isdir(temp_dir):
+            try:
+                os.makedirs(temp_dir)
+            except OSError:  # another worker made it first
+                if not os.path.isdir(temp_dir):
+                    raise
+        digest = hashlib.sha256()
+        handle, temp_path = tempfile.mkstemp(dir=temp_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                for chunk in req.iter_content(self.chunk_bytes):
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+            target = self.object_path(digest.hexdigest(), extension)
+            if os.path.isfile(target):  # shared image, stored once
+                os.remove(temp_path)
+            else:
+                if not os.path.isdir(os.path.dirname(target)):
+                    try:
+                        os.makedirs(os.path.dirname(target))
+                    except OSError:
+                        if not os.path.isdir(os.path.dirname(target)):
+                            raise
+                os.chmod(temp_path, 0o644)
+                os.rename(temp_path, target)
+        except Exception:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+            raise
+        return digest.hexdigest()
+
+    # -----------
+    # Overrides |
+    # -----------
+
+    def shopify_delete(self, call):
+        """
+        Override destructive method
+        :param call:
+        :return:
+        """
+        logging.error('shopify_delete called and forbidden')
+        pass
+
+    def shopify_put(self, call, data=None, headers=None):
+        """
+        Override destructive method
+        :param call:
+        :param data:
+        :param headers:
+        :return:
+        """
+        logging.error('shopify_put called and forbidden')
+        pass
+
+    def shopify_post(self, call, data=None, headers=None):
+        """
+        Override destructive method
+        :param call:
+        :param data:
+        :param headers:
+        :return:
+        """
+        logging.error('shopify_post called and forbidden')
+        pass
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Inventory level extraction"""
+
+from __future__ import print_function
+import logging
+from shopify import Shopify
+from rate_budget import RateBudget
+from util import thread_map
+
+
+class ExtractInventory(Shopify):
+
+    """Extract inventory levels for the variants of extracted products"""
+
+    # inventory_item_ids per call, the most the endpoint accepts
+    batch_size = 50
+    # pagination default for page size (a batch spans every location)
+    limit = 250
+    # int, batches fetched at once, all of them share self.rate_budget
+    workers = 4
+    # extract only, shopify_request() refuses anything but GET
+    read_only = True
+
+    def __init__(self, creds=None, verbose=False):
+        """
+        Call the super, count everything twice.
+        :return:
+        """
+        super(ExtractInventory, self).__init__(creds, verbose)
+
+    @classmethod
+    def inventory_item_ids(cls, products):
+        """
+        Unique inventory_item_id of every variant, in catalog order
+        :param products: iterable of products (output of ExtractProducts.extract_product())
+        :return: list of ints
+        """
+        seen = set()
+        ids = []
+        for product in products:
+            for variant in product.get('variants', []):
+                item_id = variant.get('inventory_item_id')
+                if item_id is not None and item_id not in seen:
+                    seen.add(item_id)
+                    ids.append(item_id)
+        return ids
+
+    def extract_inventory_levels(self, products, write=True):
+        """
+        Inventory levels for every variant of the products, batched by
+        inventory_item_ids and fetched concurrently under the rate budget
+        :param products: list, required, output of ExtractProducts.extract_product()
+        :param write: bool, optional, default True (write to /json folder)
+        :return: list of [inventory_item_id, location_id, available] or None on fail
+            (writes to self.errors)
+        """
+        if products is None:
+            msg = 'Inventory extraction requires the products in memory.'
+            logging.error(msg)
+            self.errors.append(msg)
+            return None
+
+        if self.rate_budget is None:
+            self.rate_budget = RateBudget()
+        self.pool_size = max(self.pool_size, self.workers)
+
+        item_ids = self.inventory_item_ids(products)
+        batches = [
+            item_ids[start:start + self.batch_size]
+            for start in range(0, len(item_ids), self.batch_size)
+        ]
+        logging.info(
+            '\nBeginning Inventory Level Extraction: %s inventory items in %s batches',
+            len(item_ids), len(batches)
+        )
+
+        inventory_results = []
+        for batch, rows, error in thread_map(self.fetch_batch, batches, self.workers):
+            if error is not None:
+                self.errors.append('Inventory batch starting %s raised %r' % (batch[0], error))
+            elif rows is None:
+                self.errors.append('Inventory batch starting %s returned None' % batch[0])
+            else:
+                inventory_results += rows
+
+        logging.info('\nEnd Inventory Level Extraction')
+
+        if self.errors:
+            logging.info('\nInventory Level Extraction has errors')
+            return None
+
+        inventory_results.sort()
+        if write:
+            self.write_output(inventory_results, 'inventory_levels', 'inventory_levels')
+
+        logging.info(
+            'Job complete: %s Inventory levels found for %s items',
+            len(inventory_results), len(item_ids)
+        )
+        return inventory_results
+
+    def fetch_batch(self, item_ids):
+        """
+        Every level of a batch of inventory items, runs on a worker thread
+        :param item_ids: list of ints, at most self.batch_size
+        :return: list of [inventory_item_id, location_id, available] or None on fail
+        """
+        rows = []
+        page = 1
+        while True:
+            call = 'admin/inventory_levels.json?inventory_item_ids=%s&limit=%s&page=%s' % (
+                ','.join(str(item_id) for item_id in item_ids), self.limit, page
+            )
+            res = self.shopify_get(call)
+            if res is None:
+                return None
+            this_page = res.get('inventory_levels', [])
+            rows += [
+                [level['inventory_item_id'], level['location_id'], level['available']]
+                for level in this_page
+            ]
+            if len(this_page) < self.limit:
+                return rows
+            page += 1
+
+    # -----------
+    # Overrides |
+    # -----------
+
+    def shopify_delete(self, call):
+        """
+        Override destructive method
+        :param call:
+        :return:
+        """
+        logging.error('shopify_delete called and forbidden')
+        pass
+
+    def shopify_put(self, call, data=None, headers=None):
+        """
+        Override destructive method
+        :param call:
+        :param data:
+        :param headers:
+        :return:
+        """
+        logging.error('shopify_put called and forbidden')
+        pass
+
+    def shopify_post(self, call, data=None, headers=None):
+        """
+        Override destructive method
+        :param call:
+        :param data:
+        :param headers:
+        :return:
+        """
+        logging.error('shopify_post called and forbidden')
+        pass
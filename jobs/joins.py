@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Joins across extracted data, no API calls"""
+
+from __future__ import print_function
+import logging
+from shopify import Shopify
+
+
+class JoinProductCollections(Shopify):
+
+    """Join products to the collections they belong to via collects"""
+
+    def __init__(self, creds=None, verbose=False):
+        """
+        Call the super, nothing to see here.
+        :return:
+        """
+        super(JoinProductCollections, self).__init__(creds, verbose)
+
+    def join_product_collections(self, products, collects, write=True):
+        """
+        Map every product id to the collection ids it is collected into
+        :param products: list, required, output of ExtractProducts.extract_product()
+        :param collects: list, required, output of ExtractCollectionData.extract_collect_data()
+        :param write: bool, optional, default True (write to /json folder)
+        :return: list of dicts (product_id, collection_ids) or None on fail (writes to self.errors)
+        """
+        if products is None or collects is None:
+            msg = 'Product collection join requires products and collects in memory.'
+            logging.error(msg)
+            self.errors.append(msg)
+            return None
+
+        collections_by_product = {}
+        for collect in collects:
+            collections_by_product.setdefault(collect['product_id'], []).append(
+                collect['collection_id']
+            )
+
+        join_results = [
+            dict(
+                product_id=product['id'],
+                collection_ids=sorted(collections_by_product.get(product['id'], [])),
+            ) for product in products
+        ]
+
+        if write:
+            self.write_output(join_results, 'product_collections', 'product_collections')
+
+        logging.info('Job complete: %s Products joined to collections', len(join_results))
+        return join_results
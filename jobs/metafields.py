@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Metafield extraction, many owners per GraphQL call"""
+
+from __future__ import print_function
+import logging
+from shopify import Shopify
+from rate_budget import RateBudget
+from util import thread_map
+
+# owners per batch by nodes(ids:), the metafields of each owner come back inline
+METAFIELDS_QUERY = '''
+query ($ids: [ID!]!, $first: Int!) {
+  nodes(ids: $ids) {
+    id
+    ... on HasMetafields {
+      metafields(first: $first) {
+        pageInfo { hasNextPage endCursor }
+        edges { node { namespace key value type } }
+      }
+    }
+  }
+}
+'''
+
+# the rest of one owner's metafields when it has more than fit in a batch
+OWNER_METAFIELDS_QUERY = '''
+query ($id: ID!, $first: Int!, $after: String) {
+  node(id: $id) {
+    id
+    ... on HasMetafields {
+      metafields(first: $first, after: $after) {
+        pageInfo { hasNextPage endCursor }
+        edges { node { namespace key value type } }
+      }
+    }
+  }
+}
+'''
+
+
+def to_gid(owner_type, owner_id):
+    """
+    :param owner_type: string, GraphQL type, e.g. 'Product' or 'ProductVariant'
+    :param owner_id: int, REST id
+    :return: string, GraphQL global id
+    """
+    return 'gid://shopify/%s/%s' % (owner_type, owner_id)
+
+
+def from_gid(gid):
+    """
+    :param gid: string, e.g. 'gid://shopify/Product/632910392'
+    :return: int, REST id
+    """
+    return int(gid.rsplit('/', 1)[-1])
+
+
+class ExtractMetafields(Shopify):
+
+    """Extract product (and variant) metafields in batches over GraphQL"""
+
+    # owners per GraphQL call
+    batch_size = 10
+    # metafields fetched inline per owner, owners with more are paged on their own
+    metafields_per_owner = 50
+    # int, batches fetched at once, all of them share self.graphql_budget
+    workers = 4
+    # Boolean, also extract variant metafields (written as variant_metafields)
+    include_variants = False
+    # extract only, shopify_request() refuses anything but GET and GraphQL queries
+    read_only = True
+
+    def __init__(self, creds=None, verbose=False):
+        """
+        Call the super, the fine print matters.
+        :return:
+        """
+        super(ExtractMetafields, self).__init__(creds, verbose)
+        # requested cost of the last batch, the estimate for the next ones
+        self.batch_cost = None
+
+    def extract_product_metafields(self, products, write=True):
+        """
+        Metafields of every product (and with include_variants every variant)
+        :param products: list, required, output of ExtractProducts.extract_product()
+        :param write: bool, optional, default True (write to /json folder)
+        :return: list of [owner_id, namespace, key, value, type] for the products or None on
+            fail (writes to self.errors)
+        """
+        if products is None:
+            msg = 'Metafield extraction requires the products in memory.'
+            logging.error(msg)
+            self.errors.append(msg)
+            return None
+
+        owners = [('Product', 'metafields', [product['id'] for product in products])]
+        if self.include_variants:
+            owners.append(('ProductVariant', 'variant_metafields', [
+                variant['id'] for product in products for variant in product.get('variants', [])
+            ]))
+
+        metafield_results = None
+        for owner_type, resource, ids in owners:
+            rows = self.extract_metafields(owner_type, ids)
+            if rows is None:
+                return None
+            if write:
+                self.write_output(rows, resource, resource)
+            if metafield_results is None:
+                metafield_results = rows
+        return metafield_results
+
+    def extract_metafields(self, owner_type, owner_ids):
+        """
+        Metafields of any owners with metafields, batch_size owners per call
+        fetched concurrently under the GraphQL cost budget
+        :param owner_type: string, GraphQL type, e.g. 'Product', 'ProductVariant', 'Collection'
+        :param owner_ids: list of int REST ids
+        :return: list of [owner_id, namespace, key, value, type] ordered by owner or None on fail
+        """
+        if self.graphql_budget is None:
+            # standard shop: 1000 points, 50 restored per second
+            self.graphql_budget = RateBudget(capacity=1000, leak_rate=50.0, reserve=50)
+        self.pool_size = max(self.pool_size, self.workers)
+
+        batches = [
+            owner_ids[start:start + self.batch_size]
+            for start in range(0, len(owner_ids), self.batch_size)
+        ]
+        logging.info(
+            '\nBeginning %s Metafield Extraction: %s owners in %s batches',
+            owner_type, len(owner_ids), len(batches)
+        )
+
+        metafield_results = []
+        for batch, rows, error in thread_map(
+                lambda batch: self.fetch_batch(owner_type, batch), batches, self.workers):
+            if error is not None:
+                self.errors.append('Metafield batch starting %s raised %r' % (batch[0], error))
+            elif rows is None:
+                self.errors.append('Metafield batch starting %s returned None' % batch[0])
+            else:
+                metafield_results += rows
+
+        logging.info('\nEnd %s Metafield Extraction', owner_type)
+
+        if self.errors:
+            logging.info('\nMetafield Extraction has errors')
+            return None
+
+        metafield_results.sort(key=lambda row: (row[0], row[1], row[2]))
+        logging.info(
+            'Job complete: %s Metafields found for %s %s owners',
+            len(metafield_results), len(owner_ids), owner_type
+        )
+        return metafield_results
+
+    def fetch_batch(self, owner_type, owner_ids):
+        """
+        One nodes(ids:) call, runs on a worker thread
+        :param owner_type: string
+        :param owner_ids: list of int, at most self.batch_size
+        :return: list of rows or None on fail
+        """
+        res = self.shopify_graphql(METAFIELDS_QUERY, dict(
+            ids=[to_gid(owner_type, owner_id) for owner_id in owner_ids],
+            first=self.metafields_per_owner,
+        ), cost=self.batch_cost or len(owner_ids) * (self.metafields_per_owner + 3))
+        if res is None:
+            return None
+        cost = res.get('extensions', {}).get('cost', {}).get('requestedQueryCost')
+        if cost:
+            self.batch_cost = cost
+
+        rows = []
+        for node in res['data']['nodes']:
+            if node is None:  # deleted since the products were extracted
+                continue
+            owner_id = from_gid(node['id'])
+            connection = node.get('metafields')
+            while connection is not None:
+                rows += [
+                    [owner_id, edge['node']['namespace'], edge['node']['key'],
+                     edge['node']['value'], edge['node']['type']]
+                    for edge in connection['edges']
+                ]
+                if not connection['pageInfo']['hasNextPage']:
+                    break
+                page = self.shopify_graphql(OWNER_METAFIELDS_QUERY, dict(
+                    id=node['id'], first=self.metafields_per_owner,
+                    after=connection['pageInfo']['endCursor'],
+                ), cost=self.metafields_per_owner + 3)
+                if page is None:
+                    return None
+                connection = page['data']['node']['metafields']
+        return rows
+
+    # -----------
+    # Overrides |
+    # -----------
+
+    def shopify_delete(self, call):
+        """
+        Override destructive method
+        :param call:
+        :return:
+        """
+        logging.error('shopify_delete called and forbidden')
+        pass
+
+    def shopify_put(self, call, data=None, headers=None):
+        """
+        Override destructive method
+        :param call:
+        :param data:
+        :param headers:
+        :return:
+        """
+        logging.error('shopify_put called and forbidden')
+        pass
+
+    def shopify_post(self, call, data=None, headers=None):
+        """
+        Override destructive method
+        :param call:
+        :param data:
+        :param headers:
+        :return:
+        """
+        logging.error('shopify_post called and forbidden')
+        pass
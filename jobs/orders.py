@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Order extraction, sharded by created_at windows"""
+
+from __future__ import print_function
+import calendar
+import logging
+import time
+from shopify import Shopify
+from rate_budget import RateBudget
+from util import thread_map
+
+
+def to_timestamp(value):
+    """
+    :param value: int epoch seconds or string 'YYYY-MM-DD' / 'YYYY-MM-DDTHH:MM:SSZ' (UTC)
+    :return: int epoch seconds
+    """
+    if isinstance(value, int):
+        return value
+    pattern = '%Y-%m-%dT%H:%M:%SZ' if 'T' in value else '%Y-%m-%d'
+    return calendar.timegm(time.strptime(value, pattern))
+
+
+def to_iso(timestamp):
+    """
+    :param timestamp: int epoch seconds
+    :return: string, ISO 8601 UTC as the API expects
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+class ExtractOrders(Shopify):
+
+    """Extract orders in parallel created_at shards"""
+
+    # window start, int epoch or 'YYYY-MM-DD' (UTC). Default covers every shop
+    created_at_min = '2006-01-01'
+    # window end, None is now
+    created_at_max = None
+    # target orders per shard, bigger windows are split until they fit
+    shard_size = 2500
+    # order status filter, 'any' includes closed and cancelled
+    status = 'any'
+    # pagination default for page size
+    limit = 250
+    # int, shards extracted at once, all of them share self.rate_budget
+    workers = 4
+    # Boolean, when True orders are only written per shard, not kept or returned
+    less_memory = False
+    # extract only, shopify_request() refuses anything but GET
+    read_only = True
+
+    def __init__(self, creds=None, verbose=False):
+        """
+        Call the super, who ordered this?
+        :return:
+        """
+        super(ExtractOrders, self).__init__(creds, verbose)
+
+    def count_orders(self, start, end):
+        """
+        :param start: int epoch seconds, inclusive
+        :param end: int epoch seconds, inclusive
+        :return: int or None on fail
+        """
+        call = 'admin/orders/count.json?status=%s&created_at_min=%s&created_at_max=%s' % (
+            self.status, to_iso(start), to_iso(end)
+        )
+        res = self.shopify_get(call)
+        if res is None:
+            self.errors.append('calling %s returned None' % call)
+            return None
+        return res.get('count', 0)
+
+    def plan_shards(self, start, end, count=None):
+        """
+        Split [start, end] into windows of at most shard_size orders. Each split
+        is sized from the window's count, windows still too big split again.
+        :param start: int epoch seconds, inclusive
+        :param end: int epoch seconds, inclusive
+        :param count: int, optional, known count for the window
+        :return: list of (start, end, count) or None on fail
+        """
+        if count is None:
+            count = self.count_orders(start, end)
+            if count is None:
+                return None
+        if count <= self.shard_size or start >= end:
+            return [(start, end, count)] if count else []
+
+        # split evenly by the count, at least in two so every level makes progress
+        pieces = max(min(-(-count // self.shard_size), end - start + 1), 2)
+        step = (end - start + 1) // pieces
+        shards = []
+        for piece in range(pieces):
+            piece_start = start + piece * step
+            piece_end = end if piece == pieces - 1 else piece_start + step - 1
+            planned = self.plan_shards(piece_start, piece_end)
+            if planned is None:
+                return None
+            shards += planned
+        return shards
+
+    def extract_orders(self, write=True):
+        """
+        Extract all orders between created_at_min and created_at_max
+        :param write: bool, optional, default True (writes one partition per shard)
+        :return: list (or [] with less_memory) on success or None on fail (writes to self.errors)
+        """
+        start = to_timestamp(self.created_at_min)
+        end = to_timestamp(self.created_at_max) if self.created_at_max else int(time.time())
+        if self.rate_budget is None:
+            self.rate_budget = RateBudget()
+        self.pool_size = max(self.pool_size, self.workers)
+
+        logging.info('\nBeginning Order Extraction %s - %s', to_iso(start), to_iso(end))
+        shards = self.plan_shards(start, end)
+        if shards is None:
+            return None
+        planned_count = sum(shard[2] for shard in shards)
+        logging.info('Planned %s shards for %s orders', len(shards), planned_count)
+
+        order_results = []
+        order_count = 0
+        for shard, orders, error in thread_map(
+                lambda shard: self.extract_shard(shard, write), shards, self.workers):
+            if error is not None:
+                self.errors.append('Order shard %s raised %r' % (to_iso(shard[0]), error))
+            elif orders is None:
+                self.errors.append('Order shard %s returned None' % to_iso(shard[0]))
+            else:
+                order_count += len(orders)
+                if not self.less_memory:
+                    order_results += orders
+
+        logging.info('\nEnd Order Extraction')
+
+        if self.errors:
+            logging.info('\nOrder Extraction has errors')
+            return None
+
+        if order_count != planned_count:
+            # orders keep arriving in the newest window while we page
+            logging.warning(
+                'Order planned count (%s) != number of results pulled from the API (%s).',
+                planned_count, order_count
+            )
+
+        order_results.sort(key=lambda order: order['id'])
+        logging.info('Job complete: %s Orders found', order_count)
+        return order_results
+
+    def extract_shard(self, shard, write=True):
+        """
+        Page one created_at window by since_id, runs on a worker thread
+        :param shard: tuple (start, end, count)
+        :param write: bool, write the shard partition
+        :return: list of orders or None on fail
+        """
+        start, end, _ = shard
+        orders = []
+        since_id = 0
+        while True:
+            call = (
+                'admin/orders.json?status=%s&created_at_min=%s&created_at_max=%s'
+                '&limit=%s&since_id=%s'
+            ) % (self.status, to_iso(start), to_iso(end), self.limit, since_id)
+            res = self.shopify_get(call)
+            if res is None:
+                return None
+            this_page = res.get('orders', [])
+            orders += this_page
+            if len(this_page) < self.limit:
+                break
+            since_id = this_page[-1]['id']
+
+        if write:
+            name = '%s_%s' % (
+                time.strftime('%Y%m%dT%H%M%S', time.gmtime(start)),
+                time.strftime('%Y%m%dT%H%M%S', time.gmtime(end)),
+            )
+            self.write_output(orders, 'orders_shard_%s' % name, 'orders', 'shard_%s' % name)
+        logging.info('Order shard %s - %s: %s orders', to_iso(start), to_iso(end), len(orders))
+        return orders
+
+    # -----------
+    # Overrides |
+    # -----------
+
+    def shopify_delete(self, call):
+        """
+        Override destructive method
+        :param call:
+        :return:
+        """
+        logging.error('shopify_delete called and forbidden')
+        pass
+
+    def shopify_put(self, call, data=None, headers=None):
+        """
+        Override destructive method
+        :param call:
+        :param data:
+        :param headers:
+        :return:
+        """
+        logging.error('shopify_put called and forbidden')
+        pass
+
+    def shopify_post(self, call, data=None, headers=None):
+        """
+        Override destructive method
+        :param call:
+        :param data:
+        :param headers:
+        :return:
+        """
+        logging.error('shopify_post called and forbidden')
+        pass
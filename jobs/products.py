@@ -4,10 +4,9 @@
 """Extract products"""
 
 from __future__ import print_function
-from time import sleep
 import logging
 from shopify import Shopify
-from util import write_json
+from output import RunOutput
 
 
 class ExtractProducts(Shopify):
@@ -20,10 +19,20 @@ class ExtractProducts(Shopify):
     page = 1
     # pagination default for page size.
     limit = 20
+    # Boolean, when True limit adapts per resource within [10, 250] (see page_size.py)
+    # and pages follow a since_id cursor
+    auto_limit = False
     # Boolean, when True each page of data will write a file with a page number
     chunk = False
+    # extract only, shopify_request() refuses anything but GET
+    read_only = True
     # Boolean, when True a list will not be kept in memory or returned (None instead)
     less_memory = False
+    # Boolean, with chunk and less_memory the page files are merged into an id ordered,
+    # duplicate free products_all (external_sort.py) instead of the empty list
+    sort_pages = False
+    # int, bytes of records the merge holds before spilling a sorted run to disk
+    sort_memory_bytes = 64 * 1024 * 1024
 
     def __init__(self, creds=None, verbose=False):
         """
@@ -47,38 +56,24 @@ class ExtractProducts(Shopify):
         product_starting_count = res.get('count', None)
 
         # get all of the collection info
-        page = self.page
-        limit = self.limit
         product_results = []
         product_count = 0
+        page_paths = []
         logging.info('\nBeginning Product [all] Extraction')
-        while page:
-            logging.info('\n------Page: %s via limit %s', page, limit)
-            call = 'admin/products.json?page=%s&limit=%s'
-            call = call % (page, limit)
-            res = self.shopify_get(call)
-            if res is None:
-                self.errors.append('The call [%s] returned None.' % call)
-                break
-            this_page = res.get('products', False)
-            if'products' not in res or not this_page:
-                page = None
-            else:
-                # {u'custom_collections': []} is the return for no results
-                if not self.less_memory:
-                    product_results += this_page
-
-                if self.chunk and write:
-                    write_json(
-                        this_page,
-                        'products_all_page_%s' % page,
-                        overwrite_files=self.creds.overwrite_files
-                    )
-
-                page += 1
-                product_count += len(this_page)
-                logging.info('Sleeping for %s', self.sleep_interval)
-                sleep(self.sleep_interval)
+        for page, this_page in self.paginate('products'):
+            # {u'custom_collections': []} is the return for no results
+            if not self.less_memory:
+                product_results += this_page
+
+            if self.chunk and write:
+                page_paths.append(self.write_output(
+                    this_page,
+                    'products_all_page_%s' % page,
+                    'products',
+                    RunOutput.page_partition(page),
+                ))
+
+            product_count += len(this_page)
 
         logging.info('\nEnd Product [all] Extraction')
 
@@ -86,17 +81,36 @@ class ExtractProducts(Shopify):
             logging.info('\nProduct [all] Extraction has errors')
             return None
 
-        if product_starting_count != product_count:
+        merged = None
+        if self.sort_pages and self.chunk and self.less_memory and write:
+            if not all(page_paths):
+                msg = 'Product pages were not all written, can not merge them.'
+                logging.error(msg)
+                self.errors.append(msg)
+                return None
+            merged = self.merge_pages(
+                'products', page_paths, 'products_all', self.sort_memory_bytes
+            )
+            # a product repeated across pages is dropped by the merge, not a count mismatch
+            product_count = merged['records']
+
+        if product_starting_count != product_count or self.has_duplicates(product_results):
             msg = 'Product starting count (%s) != number of results pulled from the API (%s).' % (
                 product_starting_count,
-                len(product_results),
+                product_count,
             )
-            logging.error(msg)
-            self.errors.append(msg)
-            return None
-
-        if write:
-            write_json(product_results, 'products_all', overwrite_files=self.creds.overwrite_files)
+            if self.less_memory:
+                logging.error(msg)
+                self.errors.append(msg)
+                return None
+            # the catalog moved under us, repair the gaps instead of a full rerun
+            logging.warning(msg)
+            product_results = self.reconcile('products', product_results)
+            if product_results is None:
+                return None
+
+        if write and merged is None:
+            self.write_output(product_results, 'products_all', 'products')
 
         logging.info(
             'Job complete: %s Products (all) found', len(
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Smart collection membership from the collection rules, no API calls"""
+
+from __future__ import print_function
+import bisect
+import logging
+from shopify import Shopify
+
+# rule column: product field, compared case insensitively
+product_text_columns = dict(title='title', type='product_type', vendor='vendor', tag='tags')
+# rule column: variant field, a product matches when any of its variants does
+variant_text_columns = dict(variant_title='title')
+variant_number_columns = dict(
+    variant_price='price',
+    variant_compare_at_price='compare_at_price',
+    variant_weight='weight',
+    variant_inventory='inventory_quantity',
+)
+negations = dict(not_equals='equals', not_contains='contains')
+
+
+def split_tags(tags):
+    """
+    :param tags: string, 'a, b' as the REST API returns them (or a list)
+    :return: list of lower case tags
+    """
+    if isinstance(tags, list):
+        return [tag.strip().lower() for tag in tags if tag.strip()]
+    return [tag.strip().lower() for tag in (tags or '').split(',') if tag.strip()]
+
+
+def to_number(value):
+    """
+    :param value: string/number/None
+    :return: float or None
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class RuleIndex(object):
+
+    """
+    Per field indexes of a catalog so that a rule resolves to its set of
+    product ids without a pass over the products: text fields map each lower
+    case value to the products having it (values kept sorted for starts_with),
+    variant numbers are sorted arrays bisected for greater/less than. Rule
+    results are cached, collections sharing a rule resolve it once.
+    """
+
+    def __init__(self, products):
+        """
+        :param products: list, output of ExtractProducts.extract_product()
+        :return: void
+        """
+        self.all_ids = frozenset(product['id'] for product in products)
+        self.text = dict((column, {}) for column in product_text_columns)
+        self.text.update((column, {}) for column in variant_text_columns)
+        numbers = dict((column, []) for column in variant_number_columns)
+        self.price_reduced = set()
+        self.cache = {}
+
+        for product in products:
+            product_id = product['id']
+            for column, field in product_text_columns.items():
+                values = split_tags(product.get(field)) if column == 'tag' else [
+                    (product.get(field) or '').lower()
+                ]
+                for value in values:
+                    self.text[column].setdefault(value, set()).add(product_id)
+            for variant in product.get('variants', []):
+                for column, field in variant_text_columns.items():
+                    self.text[column].setdefault(
+                        (variant.get(field) or '').lower(), set()
+                    ).add(product_id)
+                for column, field in variant_number_columns.items():
+                    value = to_number(variant.get(field))
+                    if value is not None:
+                        numbers[column].append((value, product_id))
+                price = to_number(variant.get('price'))
+                compare_at = to_number(variant.get('compare_at_price'))
+                if price is not None and compare_at is not None and compare_at > price:
+                    self.price_reduced.add(product_id)
+
+        self.keys = dict((column, sorted(values)) for column, values in self.text.items())
+        self.numbers = {}
+        for column, pairs in numbers.items():
+            pairs.sort()
+            self.numbers[column] = ([value for value, _ in pairs], [pid for _, pid in pairs])
+
+    def matches(self, rule):
+        """
+        :param rule: dict (column, relation, condition) of a smart collection
+        :return: frozenset of product ids or None when the rule can not be evaluated locally
+            (metafield definitions, unknown columns/relations)
+        """
+        column, relation = rule.get('column'), rule.get('relation')
+        condition = '%s' % (rule.get('condition') if rule.get('condition') is not None else '')
+        key = (column, relation, condition.lower())
+        if key not in self.cache:
+            self.cache[key] = self.resolve(column, relation, condition)
+        return self.cache[key]
+
+    def resolve(self, column, relation, condition):
+        """
+        :return: frozenset or None, see matches()
+        """
+        if column == 'is_price_reduced':
+            if relation == 'is_set':
+                return frozenset(self.price_reduced)
+            if relation == 'is_not_set':
+                return self.all_ids - self.price_reduced
+            return None
+        if column in variant_number_columns:
+            return self.resolve_number(column, relation, to_number(condition))
+        if column not in self.text:
+            return None
+
+        condition = condition.lower()
+        positive = negations.get(relation, relation)
+        if positive == 'equals':
+            keys = [condition] if condition in self.text[column] else []
+        elif positive == 'starts_with':
+            keys = self.keys[column]
+            keys = keys[bisect.bisect_left(keys, condition):
+                        bisect.bisect_left(keys, condition + u'\uffff')]
+        elif positive == 'ends_with':
+            keys = [value for value in self.keys[column] if value.endswith(condition)]
+        elif positive == 'contains':
+            keys = [value for value in self.keys[column] if condition in value]
+        else:
+            return None
+
+        if relation not in negations:
+            return self.union(column, keys)
+        if column in variant_text_columns:  # any variant whose value does not match
+            excluded = set(keys)
+            return self.union(
+                column, [value for value in self.keys[column] if value not in excluded]
+            )
+        return self.all_ids - self.union(column, keys)
+
+    def union(self, column, keys):
+        """
+        :param column: string, text column
+        :param keys: list of values
+        :return: frozenset of the product ids having any of the values
+        """
+        ids = set()
+        for value in keys:
+            ids.update(self.text[column][value])
+        return frozenset(ids)
+
+    def resolve_number(self, column, relation, condition):
+        """
+        :return: frozenset or None, see matches()
+        """
+        if condition is None:
+            return None
+        values, ids = self.numbers[column]
+        low = bisect.bisect_left(values, condition)
+        high = bisect.bisect_right(values, condition)
+        if relation == 'greater_than':
+            return frozenset(ids[high:])
+        if relation == 'less_than':
+            return frozenset(ids[:low])
+        if relation == 'equals':
+            return frozenset(ids[low:high])
+        if relation == 'not_equals':
+            return frozenset(ids[:low]) | frozenset(ids[high:])
+        return None
+
+
+class EvaluateSmartCollections(Shopify):
+
+    """Compute smart collection membership from the rules instead of paging collects"""
+
+    def __init__(self, creds=None, verbose=False):
+        """
+        Call the super, rules are rules.
+        :return:
+        """
+        super(EvaluateSmartCollections, self).__init__(creds, verbose)
+
+    def evaluate_smart_collections(self, products, smart_collections, write=True):
+        """
+        Membership of every smart collection, all evaluated against one RuleIndex
+        :param products: list, required, output of ExtractProducts.extract_product()
+        :param smart_collections: list, required, output of
+            ExtractCollectionData.extract_smart_collection_data()
+        :param write: bool, optional, default True (write to /json folder)
+        :return: list of dicts (collection_id, product_ids, unsupported_rules) or None on fail
+            (writes to self.errors). product_ids is None for a collection with a rule that
+            can not be evaluated locally, unsupported_rules lists those rules.
+        """
+        if products is None or smart_collections is None:
+            msg = 'Smart collection evaluation requires products and smart collections in memory.'
+            logging.error(msg)
+            self.errors.append(msg)
+            return None
+
+        index = RuleIndex(products)
+        member_results = []
+        for collection in smart_collections:
+            rules = collection.get('rules') or []
+            matched = [(rule, index.matches(rule)) for rule in rules]
+            unsupported = [rule for rule, ids in matched if ids is None]
+            product_ids = None
+            if not unsupported:
+                sets = sorted((ids for _, ids in matched), key=len)
+                if not sets:
+                    members = frozenset()
+                elif collection.get('disjunctive'):
+                    members = frozenset().union(*sets)
+                else:
+                    members = sets[0].intersection(*sets[1:])
+                product_ids = sorted(members)
+            else:
+                logging.warning(
+                    'Smart collection %s has rules that can not be evaluated locally: %s',
+                    collection['id'], unsupported
+                )
+            member_results.append(dict(
+                collection_id=collection['id'],
+                product_ids=product_ids,
+                unsupported_rules=unsupported,
+            ))
+
+        if write:
+            self.write_output(
+                member_results, 'smart_collection_members', 'smart_collection_members'
+            )
+
+        logging.info(
+            'Job complete: %s Smart Collections evaluated (%s distinct rules)',
+            len(member_results), len(index.cache)
+        )
+        return member_results
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Keep the product search index up to date, no API calls"""
+
+from __future__ import print_function
+import logging
+from shopify import Shopify
+from search_index import SearchIndex
+
+
+class IndexProducts(Shopify):
+
+    """Update the SQLite search index (search_index.py) from extracted products"""
+
+    # string, index file, None is json/search.db
+    search_db = None
+
+    def __init__(self, creds=None, verbose=False):
+        """
+        Call the super, seek and ye shall find.
+        :return:
+        """
+        super(IndexProducts, self).__init__(creds, verbose)
+
+    def index_products(self, products, write=True):
+        """
+        Re-index the products that changed since the last update, drop the deleted ones
+        :param products: list, required, output of ExtractProducts.extract_product()
+        :param write: bool, optional, default True (False counts the changes, index untouched)
+        :return: dict (added, changed, deleted, unchanged counts) or None on fail
+            (writes to self.errors)
+        """
+        if products is None:
+            msg = (
+                'Search indexing requires the products in memory '
+                '(not available when products runs with less_memory).'
+            )
+            logging.error(msg)
+            self.errors.append(msg)
+            return None
+
+        with self.phase('write'):
+            with SearchIndex(self.search_db) as index:
+                if not products and len(index):
+                    # a full update would drop every document, most likely a less_memory run
+                    msg = 'Search indexing got no products, refusing to empty %s.' % index.path
+                    logging.error(msg)
+                    self.errors.append(msg)
+                    return None
+                index_results = index.update(products, commit=write)
+                index_results['products'] = len(index)
+
+        logging.info('Job complete: %s Products in the search index', index_results['products'])
+        return index_results
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Logging setup that keeps log I/O off the extraction threads"""
+
+from __future__ import print_function
+import logging
+import multiprocessing
+import os
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:  # Python 2, handlers stay synchronous
+    QueueHandler = QueueListener = None
+
+log_format = '%(asctime)s %(levelname)s %(threadName)s %(message)s'
+
+
+class RateLimitFilter(logging.Filter):
+
+    """
+    Token bucket per call site (file + line) for chatty messages such as the
+    per page lines. Records above max_level (warnings, errors) always pass.
+    """
+
+    def __init__(self, per_second=2.0, burst=20, max_level=logging.INFO):
+        """
+        :param per_second: float, messages a call site may log per second once its burst is spent
+        :param burst: int, messages a call site may log back to back
+        :param max_level: int, records above this level are never dropped
+        :return: void
+        """
+        logging.Filter.__init__(self)
+        self.per_second = float(per_second)
+        self.burst = burst
+        self.max_level = max_level
+        self.buckets = {}  # call site: [tokens, last refill]
+        self.suppressed = {}  # call site: count
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.time()
+        with self.lock:
+            tokens, last = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.per_second)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                return True
+            self.buckets[key] = (tokens, now)
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+        return False
+
+
+class DroppingQueueHandler(QueueHandler or logging.Handler):
+
+    """
+    QueueHandler on a bounded queue that drops (and counts) records below
+    WARNING rather than block, warnings and errors wait for room
+    """
+
+    dropped = 0
+
+    def enqueue(self, record):
+        if record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class PayloadHandler(logging.Handler):
+
+    """
+    Writes the `payload` attached to a record (extra=dict(payload=...)) to its
+    own truncated file, so response dumps stay out of the main log
+    """
+
+    def __init__(self, directory, max_bytes=64 * 1024):
+        """
+        :param directory: string, where dump files go (created on first dump)
+        :param max_bytes: int, bytes kept per dump
+        :return: void
+        """
+        logging.Handler.__init__(self)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.count = 0
+
+    def emit(self, record):
+        payload = getattr(record, 'payload', None)
+        if payload is None:
+            return
+        try:
+            if not isinstance(payload, bytes):
+                payload = ('%s' % payload).encode('utf-8')
+            size = getattr(record, 'payload_size', len(payload))
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self.count += 1
+            path = os.path.join(self.directory, '%s-%05d.txt' % (
+                time.strftime('%Y%m%dT%H%M%S', time.localtime(record.created)), self.count
+            ))
+            with open(path, 'wb') as dump:
+                dump.write(('%s\n\n' % record.getMessage()).encode('utf-8'))
+                dump.write(payload[:self.max_bytes])
+                if size > self.max_bytes:
+                    dump.write(('\n...[truncated, %s bytes total]' % size).encode('utf-8'))
+        except Exception:
+            self.handleError(record)
+
+
+def setup_logging(log_file, level=logging.INFO, payload_dir=None, queue_size=10000,
+                  per_second=2.0, burst=20):
+    """
+    Console + file logging written by a background thread. Threads only put
+    records on a bounded queue (dropped if it is ever full), chatty INFO call
+    sites are rate limited and payload dumps go to their own files.
+    :param log_file: string, required, main log file
+    :param level: int, optional, root level
+    :param payload_dir: string, optional, dump folder, defaults to <log_file folder>/payloads
+    :param queue_size: int, optional, records buffered for the writer thread
+    :param per_second: float, optional, see RateLimitFilter
+    :param burst: int, optional, see RateLimitFilter
+    :return: QueueListener (call stop() to flush) or None on Python 2. Its queue is a
+        multiprocessing queue, pass it to init_worker() in a process pool
+    """
+    if payload_dir is None:
+        payload_dir = os.path.join(os.path.dirname(os.path.realpath(log_file)), 'payloads')
+    formatter = logging.Formatter(log_format)
+    handlers = [logging.StreamHandler(), logging.FileHandler(log_file), PayloadHandler(payload_dir)]
+    for handler in handlers[:2]:
+        handler.setFormatter(formatter)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    if QueueListener is None:
+        for handler in handlers:
+            # a filter each, a shared one would spend a record's token once per handler
+            handler.addFilter(RateLimitFilter(per_second, burst))
+            root.addHandler(handler)
+        return None
+
+    # shared with pool workers (forked or through init_worker()), their records reach the listener
+    log_queue = multiprocessing.Queue(queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(per_second, burst))  # drop before the queue
+    root.addHandler(queue_handler)
+    listener = QueueListener(log_queue, *handlers)
+    listener.start()
+    return listener
+
+
+def init_worker(log_queue, level=logging.INFO, per_second=2.0, burst=20):
+    """
+    Pool initializer: send the worker's records to the parent's listener
+    (multiprocessing.Pool(initializer=init_worker, initargs=(listener.queue,)))
+    :param log_queue: multiprocessing queue of setup_logging()'s listener, None is a no-op
+    :param level: int, optional, root level
+    :param per_second: float, optional, see RateLimitFilter
+    :param burst: int, optional, see RateLimitFilter
+    :return: void
+    """
+    if log_queue is None:
+        return
+    root = logging.getLogger()
+    for handler in list(root.handlers):  # copies of the parent's handlers when forked
+        root.removeHandler(handler)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(per_second, burst))
+    root.addHandler(queue_handler)
+    root.setLevel(level)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""NDJSON output with a sidecar id -> offset index for random access"""
+
+from __future__ import print_function
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+from util import atomic_write
+
+# index record: big endian id, byte offset and length of the line. Sorted by
+# id so the sidecar can be bisected in place, same idea as snapshot.HashIndex.
+OFFSET_RECORD = struct.Struct('>QQI')
+
+
+def index_path(path):
+    """
+    :param path: string, .ndjson file
+    :return: string, its sidecar index (.idx)
+    """
+    return '%s.idx' % os.path.splitext(path)[0]
+
+
+def is_indexable(data):
+    """
+    :param data: mixed, job output
+    :return: bool, True for a list of records with an 'id'
+    """
+    return isinstance(data, list) and all(
+        isinstance(record, dict) and 'id' in record for record in data
+    )
+
+
+def encode_ndjson(records):
+    """
+    :param records: list of dicts with an 'id'
+    :return: tuple (ndjson bytes, index bytes). Every record is written, a repeated id
+        is indexed once, at its last copy (the newest fetch, as external_sort keeps)
+    """
+    lines = []
+    offsets = {}  # id: (offset, length), a later copy replaces an earlier one
+    offset = 0
+    for record in records:
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        offsets[record['id']] = (offset, len(line))
+        lines.append(line)
+        offset += len(line)
+    return b''.join(lines), b''.join(
+        OFFSET_RECORD.pack(record_id, *offsets[record_id]) for record_id in sorted(offsets)
+    )
+
+
+def write_ndjson(path, records):
+    """
+    Atomically write records as NDJSON (one per line) plus the sidecar index,
+    the index goes last so a reader never finds an index ahead of its data
+    :param path: string, required, .ndjson file
+    :param records: list of dicts with an 'id'
+    :return: bytes, the ndjson payload (for sizes/checksums)
+    """
+    payload, index = encode_ndjson(records)
+    atomic_write(path, payload)
+    atomic_write(index_path(path), index)
+    return payload
+
+
+def iter_ndjson(path):
+    """
+    Stream the records of an NDJSON file in file order, no index needed
+    :param path: string
+    :return: generator of dicts
+    """
+    with open(path, 'rb') as ndjson_file:
+        for line in ndjson_file:
+            if line.strip():
+                yield json.loads(line.decode('utf-8'))
+
+
+class NdjsonReader(object):
+
+    """
+    Random access into an indexed NDJSON file. Both files are memory mapped,
+    a lookup bisects the index and decodes just the one line.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: string, required, .ndjson file written by write_ndjson()
+        :return: void
+        """
+        self.path = path
+        self.count = 0
+        self.files = []
+        self.data = self.index = None
+        if os.path.getsize(path):
+            self.data = self.map(path)
+            self.index = self.map(index_path(path))
+            self.count = len(self.index) // OFFSET_RECORD.size
+
+    def map(self, path):
+        """
+        :param path: string
+        :return: read only mmap, the file is closed by close()
+        """
+        handle = open(path, 'rb')
+        self.files.append(handle)
+        return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def entry(self, position):
+        """
+        :param position: int, record number in id order
+        :return: tuple (id, offset, length)
+        """
+        return OFFSET_RECORD.unpack_from(self.index, position * OFFSET_RECORD.size)
+
+    def locate(self, record_id):
+        """
+        Binary search for an id
+        :param record_id: int
+        :return: tuple (id, offset, length) or None
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            entry = self.entry(middle)
+            if entry[0] == record_id:
+                return entry
+            if entry[0] < record_id:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def decode(self, entry):
+        """
+        :param entry: tuple (id, offset, length)
+        :return: dict
+        """
+        _, offset, length = entry
+        return json.loads(self.data[offset:offset + length].decode('utf-8'))
+
+    def get(self, record_id):
+        """
+        :param record_id: int
+        :return: dict or None
+        """
+        entry = self.locate(record_id)
+        return self.decode(entry) if entry is not None else None
+
+    def ids(self):
+        """
+        :return: generator of ids, ascending
+        """
+        for position in range(self.count):
+            yield self.entry(position)[0]
+
+    def __contains__(self, record_id):
+        return self.locate(record_id) is not None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """Records in id order"""
+        for position in range(self.count):
+            yield self.decode(self.entry(position))
+
+    def close(self):
+        for mapped in (self.data, self.index):
+            if mapped is not None:
+                mapped.close()
+        for handle in self.files:
+            handle.close()
+        self.data = self.index = None
+        self.files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def main(argv=None):
+    """
+    Command line lookup, prints the records as json lines
+    :param argv: list, optional, defaults to sys.argv[1:]
+    :return: int exit code, 1 if an id is missing
+    """
+    parser = argparse.ArgumentParser(description='Look up records in an indexed ndjson file')
+    parser.add_argument('path', help='e.g. json/runs/<run_id>/products/all.ndjson')
+    parser.add_argument('ids', nargs='+', type=int)
+    args = parser.parse_args(argv)
+
+    missing = False
+    with NdjsonReader(args.path) as reader:
+        for record_id in args.ids:
+            record = reader.get(record_id)
+            if record is None:
+                print('id %s not found' % record_id, file=sys.stderr)
+                missing = True
+            else:
+                print(json.dumps(record))
+    return 1 if missing else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
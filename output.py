@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Run scoped, partitioned output with a manifest"""
+
+from __future__ import print_function
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from ndjson import is_indexable, index_path, write_ndjson
+from util import atomic_write
+
+
+def new_run_id():
+    """
+    Sortable, collision free run id such as 20261019T161800-3fa2c1
+    :return: string
+    """
+    return '%s-%s' % (time.strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:6])
+
+
+class RunOutput(object):
+
+    """
+    Files for one run live in json/runs/<run_id>/<resource>/<partition>.json.
+    Partition names are deterministic ('all', 'page_00001', 'shard_...') so
+    parallel writers never probe for a free name, every file is written to a
+    temp file and renamed into place, and manifest.json lists each file with
+    its record count and sha256 so loaders never scan the directory.
+    """
+
+    manifest_name = 'manifest.json'
+
+    def __init__(self, run_id=None, base_dir=None, ndjson=False):
+        """
+        :param run_id: string, optional, join an existing run (e.g. from another process)
+        :param base_dir: string, optional, defaults to json/runs
+        :param ndjson: bool, optional, write lists of records as <partition>.ndjson plus an
+            id -> offset index (<partition>.idx) for ndjson.NdjsonReader
+        :return: void
+        """
+        if base_dir is None:
+            base_dir = os.path.dirname(os.path.realpath(__file__)) + '/json/runs'
+        self.base_dir = base_dir
+        self.run_id = run_id or new_run_id()
+        self.run_dir = os.path.join(base_dir, self.run_id)
+        self.ndjson = ndjson
+        self.entries = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def page_partition(cls, page):
+        """
+        :param page: int
+        :return: string, zero padded so partitions sort in page order
+        """
+        return 'page_%05d' % page
+
+    def path(self, resource, partition, extension='json'):
+        """
+        :param resource: string, e.g. 'products'
+        :param partition: string, e.g. 'all' or 'page_00001'
+        :param extension: string, optional, 'json' or 'ndjson'
+        :return: absolute file path
+        """
+        return os.path.join(self.run_dir, resource, '%s.%s' % (partition, extension))
+
+    def write(self, resource, data, partition='all'):
+        """
+        Atomically write one partition and record it for the manifest. With
+        ndjson a list of records (dicts with an id) is written indexed, anything
+        else stays json.
+        :param resource: string, required
+        :param data: list/dict/string, required
+        :param partition: string, optional, default 'all'
+        :return: file path
+        """
+        index = None
+        if self.ndjson and is_indexable(data):
+            target = self.path(resource, partition, 'ndjson')
+            payload = write_ndjson(target, data)
+            index = os.path.relpath(index_path(target), self.run_dir)
+        else:
+            payload = data if isinstance(data, str) else json.dumps(data)
+            target = self.path(resource, partition)
+            atomic_write(target, payload)
+            payload = payload.encode('utf-8')
+        self.add_file(
+            target, resource, partition,
+            len(data) if isinstance(data, (list, dict)) else None,
+            len(payload), hashlib.sha256(payload).hexdigest(), index,
+        )
+        return target
+
+    def add_file(self, target, resource, partition, records, size, sha256, index=None):
+        """
+        Record a partition for the manifest, for files streamed to disk rather than
+        written by write() (e.g. external_sort.write_sorted())
+        :param target: string, absolute file path inside the run directory
+        :param resource: string
+        :param partition: string
+        :param records: int or None
+        :param size: int, bytes
+        :param sha256: string, hex digest of the file
+        :param index: string, optional, ndjson sidecar, relative to the run directory
+        :return: dict, the manifest entry
+        """
+        entry = dict(
+            path=os.path.relpath(target, self.run_dir),
+            resource=resource,
+            partition=partition,
+            format='json' if index is None else 'ndjson',
+            records=records,
+            bytes=size,
+            sha256=sha256,
+        )
+        if index is not None:
+            entry['index'] = index
+        with self.lock:
+            self.entries.append(entry)
+        return entry
+
+    def add_entries(self, entries):
+        """
+        Merge manifest entries written by another RunOutput of the same run (threads/processes)
+        :param entries: list of dicts
+        :return: void
+        """
+        with self.lock:
+            self.entries += entries
+
+    def write_manifest(self, **extra):
+        """
+        Atomically (re)write manifest.json
+        :param extra: additional top level keys (job report, etc)
+        :return: manifest path
+        """
+        with self.lock:
+            files = sorted(self.entries, key=lambda entry: entry['path'])
+        manifest = dict(
+            run_id=self.run_id,
+            written_at=time.strftime('%Y-%m-%dT%H:%M:%S'),
+            files=files,
+        )
+        manifest.update(extra)
+        target = os.path.join(self.run_dir, self.manifest_name)
+        atomic_write(target, json.dumps(manifest, indent=2, sort_keys=True))
+        logging.info('Run manifest %s (%s files)', target, len(files))
+        return target
+
+
+def load_manifest(run_dir):
+    """
+    Read a run manifest
+    :param run_dir: string, json/runs/<run_id>
+    :return: dict
+    """
+    with open(os.path.join(run_dir, RunOutput.manifest_name)) as manifest_file:
+        return json.load(manifest_file)
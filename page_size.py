@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Page size controller, adapts limit from what the API responses cost"""
+
+from __future__ import print_function
+
+
+class PageSizeController(object):
+
+    """
+    Pick the next page size for one resource. Grows while pages come back
+    fast and small, shrinks in proportion when a page is slow or heavy (huge
+    body_html) and halves on a timeout/server error. Always within
+    [min_limit, max_limit].
+    """
+
+    def __init__(self, initial=50, min_limit=10, max_limit=250, target_seconds=2.0,
+                 max_bytes=4 * 1024 * 1024, growth=1.5):
+        """
+        :param initial: int, first page size
+        :param min_limit: int, lower bound
+        :param max_limit: int, upper bound (250 is the API maximum)
+        :param target_seconds: float, response time a page should stay under
+        :param max_bytes: int, payload size a page should stay under
+        :param growth: float, factor applied while pages are cheap
+        :return: void
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_seconds = float(target_seconds)
+        self.max_bytes = max_bytes
+        self.growth = growth
+        self.limit = self.clamp(initial)
+        self.history = []  # limit used for each page
+        self.errors = 0
+        self.seconds = 0.0
+
+    def clamp(self, limit):
+        """
+        :param limit: number
+        :return: int within bounds
+        """
+        return int(max(self.min_limit, min(self.max_limit, limit)))
+
+    def observe(self, records, seconds, size, error=False):
+        """
+        Feed back one page and set the next limit
+        :param records: int, records in the page
+        :param seconds: float, response time
+        :param size: int, payload bytes
+        :param error: bool, timeout or server error (the page will be retried)
+        :return: int, the next limit
+        """
+        limit = self.limit
+        self.history.append(limit)
+        self.seconds += seconds
+        if error:
+            self.errors += 1
+            self.limit = self.clamp(limit // 2)
+            return self.limit
+
+        # heaviest page that still fits, from what a record costs on this resource
+        per_record = float(size) / records if records else 0
+        ceiling = self.max_bytes / per_record if per_record else self.max_limit
+        if seconds > self.target_seconds or size > self.max_bytes:
+            scale = min(self.target_seconds / seconds if seconds else 1, ceiling / limit)
+            limit = limit * max(scale, 0.5)
+        elif records >= limit and seconds < self.target_seconds / 2 and size < self.max_bytes / 2:
+            # only full pages say anything about a bigger one
+            limit = min(limit * self.growth + 1, ceiling)
+        self.limit = self.clamp(limit)
+        return self.limit
+
+    def summary(self):
+        """
+        For run reports
+        :return: dict
+        """
+        if not self.history:
+            return dict(pages=0, limit=self.limit)
+        return dict(
+            pages=len(self.history),
+            limit=self.limit,
+            min=min(self.history),
+            max=max(self.history),
+            mean=round(float(sum(self.history)) / len(self.history), 1),
+            errors=self.errors,
+            seconds=round(self.seconds, 2),
+        )
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Dry run: estimate the API calls, bytes and time of a run from count.json and past runs"""
+
+from __future__ import print_function
+import glob
+import json
+import logging
+import math
+import os
+import time
+from jobs.orders import ExtractOrders, to_timestamp
+from output import RunOutput
+from page_size import PageSizeController
+
+# job name: resource paged by the job (count.json gives its size)
+paged_jobs = dict(
+    smart_collections='smart_collections',
+    custom_collections='custom_collections',
+    collects='collects',
+    products='products',
+    orders='orders',
+)
+# jobs making no API calls (or, for product_images, only CDN downloads)
+local_jobs = (
+    'product_collections', 'product_changes', 'smart_collection_members', 'search_index',
+    'product_images', 'catalog_audit',
+)
+
+
+def ceil_div(count, size):
+    """
+    :param count: int
+    :param size: int
+    :return: int, pages of size needed for count
+    """
+    return -(-int(count) // max(int(size), 1))
+
+
+class History(object):
+
+    """What past runs (their manifests) say about each resource"""
+
+    def __init__(self, runs_dir=None, runs=5):
+        """
+        :param runs_dir: string, optional, defaults to json/runs
+        :param runs: int, optional, newest manifests read
+        :return: void
+        """
+        if runs_dir is None:
+            runs_dir = os.path.dirname(os.path.realpath(__file__)) + '/json/runs'
+        self.resources = {}  # resource: dict(records, bytes, pages, page_seconds, page_records)
+        self.job_records = {}  # job name: records of the newest run that had the job
+        self.runs = 0
+        paths = sorted(
+            glob.glob(os.path.join(runs_dir, '*', RunOutput.manifest_name)),
+            key=os.path.getmtime, reverse=True,
+        )
+        for path in paths[:runs]:
+            try:
+                with open(path) as manifest_file:
+                    self.add(json.load(manifest_file))
+            except (IOError, OSError, ValueError) as e:
+                logging.warning('Skipping manifest %s: %r', path, e)
+
+    def stats(self, resource):
+        """
+        :param resource: string
+        :return: dict, created on first use
+        """
+        return self.resources.setdefault(resource, dict(
+            records=0, bytes=0, pages=0, page_seconds=0.0, page_records=0
+        ))
+
+    def add(self, manifest):
+        """
+        :param manifest: dict, a run manifest (output.RunOutput.write_manifest())
+        :return: void
+        """
+        self.runs += 1
+        by_resource = {}
+        for entry in manifest.get('files', []):
+            by_resource.setdefault(entry['resource'], []).append(entry)
+        for resource, entries in by_resource.items():
+            whole = [entry for entry in entries if entry['partition'] == 'all']
+            for entry in whole or entries:  # chunked runs write pages and all, count once
+                if entry.get('records'):
+                    self.stats(resource)['records'] += entry['records']
+                    self.stats(resource)['bytes'] += entry['bytes']
+
+        for name, row in manifest.get('jobs', {}).items():
+            if row.get('records') is not None:
+                self.job_records.setdefault(name, row['records'])
+            resource = paged_jobs.get(name)
+            if resource is None or row.get('status') != 'ok':
+                continue
+            stats = self.stats(resource)
+            sizes = (row.get('page_sizes') or {}).get(resource) or {}
+            phases = ((row.get('profile') or {}).get('phases') or {})
+            if sizes.get('pages') and sizes.get('seconds'):
+                stats['pages'] += sizes['pages']
+                stats['page_seconds'] += sizes['seconds']
+                stats['page_records'] += sizes['pages'] * sizes['mean']
+            elif phases.get('request', {}).get('count') and row.get('records'):
+                stats['pages'] += phases['request']['count']
+                stats['page_seconds'] += phases['request']['seconds']
+                stats['page_records'] += row['records']
+
+    def bytes_per_record(self, resource):
+        """
+        :param resource: string
+        :return: float or None without history
+        """
+        stats = self.resources.get(resource)
+        if not stats or not stats['records']:
+            return None
+        return float(stats['bytes']) / stats['records']
+
+    def page_seconds(self, resource, limit, overhead):
+        """
+        Response time of one page of limit records: a fixed overhead plus a per record
+        share taken from past pages
+        :param resource: string
+        :param limit: int
+        :param overhead: float, seconds per call regardless of size
+        :return: float or None without history
+        """
+        stats = self.resources.get(resource)
+        if not stats or not stats['pages'] or not stats['page_records']:
+            return None
+        mean_seconds = stats['page_seconds'] / stats['pages']
+        mean_records = float(stats['page_records']) / stats['pages']
+        return overhead + max(mean_seconds - overhead, 0.0) / mean_records * limit
+
+
+class Planner(object):
+
+    """
+    Estimate a run before it happens. Only count.json calls are made; calls
+    follow from the counts and each job's page size/batch settings, bytes and
+    page latency from past runs (defaults without history), and time from
+    whichever is slower: the requests themselves or the shop's leaky bucket.
+    """
+
+    # seconds per call regardless of page size (TLS, routing, Shopify's own overhead)
+    call_overhead = 0.25
+    # seconds per page record when no past run measured it
+    record_seconds = 0.004
+    # bytes per record when no past run measured it
+    record_bytes = 4096
+    # variants per product when no past run measured it (inventory batches)
+    variants_per_product = 3.0
+    # concurrency recommended at most
+    max_workers = 8
+
+    def __init__(self, shopify, jobs, history=None, capacity=40, leak_rate=2.0,
+                 reserve=2):
+        """
+        :param shopify: Shopify, read only object used for the count calls
+        :param jobs: dict {job name: job object with the run's options applied}
+        :param history: History, optional
+        :param capacity: int, REST bucket size (40 standard, 80 Plus)
+        :param leak_rate: float, REST calls per second (2 standard, 4 Plus)
+        :param reserve: int, calls kept free, as in RateBudget
+        :return: void
+        """
+        self.shopify = shopify
+        self.jobs = jobs
+        self.history = history or History()
+        self.capacity = capacity
+        self.leak_rate = float(leak_rate)
+        self.reserve = reserve
+        self.counts = {}
+
+    def count(self, resource):
+        """
+        :param resource: string, a paged resource
+        :return: int or None on fail (writes to shopify.errors)
+        """
+        if resource not in self.counts:
+            if resource == 'orders':
+                orders = self.jobs.get('orders') or ExtractOrders(self.shopify.creds)
+                orders.cassette = self.shopify.cassette
+                end = to_timestamp(orders.created_at_max) if orders.created_at_max else int(
+                    time.time()
+                )
+                count = orders.count_orders(to_timestamp(orders.created_at_min), end)
+                if count is None:
+                    self.shopify.errors += orders.errors
+            else:
+                call = 'admin/%s/count.json' % resource
+                res = self.shopify.shopify_get(call)
+                count = res.get('count') if res is not None else None
+                if count is None:
+                    self.shopify.errors.append('calling %s returned None' % call)
+            self.counts[resource] = count
+        return self.counts[resource]
+
+    def page_seconds(self, resource, limit):
+        """
+        :param resource: string
+        :param limit: int
+        :return: tuple (float seconds per page, bool from history)
+        """
+        seconds = self.history.page_seconds(resource, limit, self.call_overhead)
+        if seconds is not None:
+            return seconds, True
+        return self.call_overhead + self.record_seconds * limit, False
+
+    def record_size(self, resource):
+        """
+        :param resource: string
+        :return: tuple (float bytes per record, bool from history)
+        """
+        size = self.history.bytes_per_record(resource)
+        if size is not None:
+            return size, True
+        return float(self.record_bytes), False
+
+    def plan_job(self, name):
+        """
+        :param name: string, job name
+        :return: dict (calls, records, bytes, request_seconds, sleep_seconds, limit,
+            graphql_points, history, recommend) or None when the job has no cost model
+        """
+        job = self.jobs[name]
+        plan = dict(calls=0, records=0, bytes=0, request_seconds=0.0, sleep_seconds=0.0,
+                    graphql_points=0, history=False, recommend={})
+        if name in local_jobs:
+            plan['note'] = 'no API calls'
+            return plan
+        products = self.count('products') if name in (
+            'inventory_levels', 'product_metafields') else None
+
+        if name in paged_jobs:
+            resource = paged_jobs[name]
+            count = self.count(resource)
+            if count is None:
+                return None
+            limit = job.limit
+            pages = ceil_div(count, limit) + 1  # the empty page that ends page=N paging
+            if name == 'orders':
+                shards = ceil_div(count, job.shard_size)
+                pages = ceil_div(count, limit) + shards
+                plan['calls'] += 2 * shards  # the count calls splitting the window
+            seconds, measured = self.page_seconds(resource, limit)
+            size, sized = self.record_size(resource)
+            plan.update(
+                limit=limit,
+                records=count,
+                bytes=int(count * size),
+                history=measured or sized,
+                request_seconds=pages * seconds,
+                # orders shards run in parallel threads without sleeping
+                sleep_seconds=0.0 if name == 'orders' else pages * job.sleep_interval,
+            )
+            plan['calls'] += pages + 1
+            plan['recommend'] = self.recommend_limit(resource, limit)
+        elif name == 'inventory_levels':
+            if products is None:
+                return None
+            variants = self.history.job_records.get('inventory_levels')
+            product_records = self.history.job_records.get('products')
+            per_product = (float(variants) / product_records if variants and product_records
+                           else self.variants_per_product)
+            plan['calls'] = ceil_div(products * per_product, job.batch_size)
+            plan['records'] = int(products * per_product)
+            plan['request_seconds'] = plan['calls'] * self.page_seconds(
+                'inventory_levels', job.batch_size)[0]
+            plan['history'] = bool(variants and product_records)
+        elif name == 'product_metafields':
+            if products is None:
+                return None
+            plan['calls'] = ceil_div(products, job.batch_size)
+            plan['graphql_points'] = plan['calls'] * job.batch_size * (
+                job.metafields_per_owner + 3)
+            plan['request_seconds'] = plan['calls'] * self.page_seconds(
+                'metafields', job.batch_size)[0]
+        else:
+            return None
+        return plan
+
+    def recommend_limit(self, resource, limit):
+        """
+        Biggest page that stays inside PageSizeController's size and time targets
+        :param resource: string
+        :param limit: int, configured page size
+        :return: dict, {} when the configured limit is already best
+        """
+        controller = PageSizeController()
+        size, _ = self.record_size(resource)
+        best = controller.max_limit
+        best = min(best, int(controller.max_bytes / size)) if size else best
+        while best > controller.min_limit and (
+                self.page_seconds(resource, best)[0] > controller.target_seconds):
+            best -= 10
+        best = controller.clamp(best)
+        return dict(limit=best) if best > limit else {}
+
+    def plan(self, names, workers=4):
+        """
+        :param names: list of job names (resolved, run order)
+        :param workers: int, jobs run at once (run.py --workers)
+        :return: dict (jobs, totals, recommend, unplanned) or None on fail
+            (writes to shopify.errors)
+        """
+        jobs = {}
+        unplanned = []
+        for name in names:
+            plan = self.plan_job(name)
+            if plan is None:
+                if self.shopify.errors:
+                    return None
+                unplanned.append(name)
+                continue
+            jobs[name] = plan
+
+        calls = sum(plan['calls'] for plan in jobs.values())
+        graphql_calls = sum(plan['calls'] for name, plan in jobs.items()
+                            if name == 'product_metafields')
+        rest_calls = calls - graphql_calls
+        points = sum(plan['graphql_points'] for plan in jobs.values())
+        # the bucket lets a burst through, after that calls go at the leak rate
+        budget_seconds = max(rest_calls - (self.capacity - self.reserve), 0) / self.leak_rate
+        graphql_seconds = max(points - 1000, 0) / 50.0
+        # each job pages on its own thread, sleeps included, up to workers jobs at once
+        job_seconds = [plan['request_seconds'] + plan['sleep_seconds'] for plan in jobs.values()]
+        request_seconds = max(sum(job_seconds) / max(workers, 1), max(job_seconds or [0]))
+        seconds = max(request_seconds, budget_seconds, graphql_seconds)
+        totals = dict(
+            calls=calls,
+            rest_calls=rest_calls,
+            graphql_points=points,
+            bytes=sum(plan['bytes'] for plan in jobs.values()),
+            records=sum(plan['records'] for plan in jobs.values()),
+            seconds=round(seconds, 1),
+            budget_seconds=round(budget_seconds, 1),
+            request_seconds=round(request_seconds, 1),
+            graphql_seconds=round(graphql_seconds, 1),
+            bottleneck=max(
+                (request_seconds, 'requests'), (budget_seconds, 'rate budget'),
+                (graphql_seconds, 'graphql budget'),
+            )[1],
+        )
+        return dict(
+            counts=dict(self.counts),
+            jobs=jobs,
+            totals=totals,
+            recommend=self.recommend(jobs, totals, workers),
+            unplanned=unplanned,
+        )
+
+    def recommend(self, jobs, totals, workers):
+        """
+        :param jobs: dict, plan_job() per job
+        :param totals: dict
+        :param workers: int, jobs run at once
+        :return: dict (options {JOB.ATTRIBUTE: value} for run.py -o, workers for --workers)
+        """
+        options = {}
+        api_jobs = [name for name, plan in jobs.items() if plan['calls']]
+        # sequential pagers running side by side share the leak rate, each sleeps for its share
+        pagers = [name for name in api_jobs if name in paged_jobs and name != 'orders']
+        share = float(min(len(pagers), max(workers, 1))) / self.leak_rate
+        fits_burst = totals['rest_calls'] <= self.capacity - self.reserve
+        for name in sorted(api_jobs):
+            plan = jobs[name]
+            limit = plan['recommend'].get('limit')
+            if limit:
+                options['%s.limit' % name] = limit
+            if name in pagers:
+                page_seconds = self.page_seconds(paged_jobs[name], limit or plan['limit'])[0]
+                sleep = 0.0 if fits_burst else round(max(share - page_seconds, 0.0), 2)
+                if sleep < self.jobs[name].sleep_interval:
+                    options['%s.sleep_interval' % name] = sleep
+            # threaded jobs: enough requests in flight to use the whole leak rate, more
+            # only queue on the budget
+            if getattr(self.jobs[name], 'workers', None) is not None:
+                seconds = plan['request_seconds'] / plan['calls']
+                in_flight = min(max(int(math.ceil(self.leak_rate * seconds)), 1), self.max_workers)
+                if in_flight != self.jobs[name].workers:
+                    options['%s.workers' % name] = in_flight
+        return dict(options=options, workers=min(max(len(api_jobs), 1), self.max_workers))
+
+
+def log_plan(names, plan):
+    """
+    :param names: list, job names in run order
+    :param plan: dict, output of Planner.plan()
+    :return: void
+    """
+    logging.info('\n------Dry run (counts: %s)', ', '.join(
+        '%s=%s' % item for item in sorted(plan['counts'].items())))
+    for name in names:
+        if name not in plan['jobs']:
+            continue
+        row = plan['jobs'][name]
+        logging.info(
+            '%-22s calls=%-7s records=%-8s %8.1f MB %8.1fs%s', name, row['calls'], row['records'],
+            row['bytes'] / 1e6, row['request_seconds'] + row['sleep_seconds'],
+            '' if row['history'] or not row['calls'] else '  (no history, defaults)',
+        )
+    totals = plan['totals']
+    logging.info(
+        'Total: %s calls, %.1f MB, ~%.0fs (%s bound: requests %.0fs, rate budget %.0fs, '
+        'graphql budget %.0fs)', totals['calls'], totals['bytes'] / 1e6, totals['seconds'],
+        totals['bottleneck'], totals['request_seconds'], totals['budget_seconds'],
+        totals['graphql_seconds'],
+    )
+    if plan['unplanned']:
+        logging.info('No estimate for: %s', ', '.join(plan['unplanned']))
+    recommend = plan['recommend']
+    logging.info('Recommended: --workers %s %s', recommend['workers'], ' '.join(
+        '-o %s=%s' % item for item in sorted(recommend['options'].items())))
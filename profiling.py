@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Profiling for extract jobs: cProfile, tracemalloc and a wall time breakdown by phase"""
+
+from __future__ import print_function
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+class NullPhase(object):
+
+    """Context manager doing nothing, used when profiling is off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_PHASE = NullPhase()
+
+# profilers currently using tracemalloc, the last one out stops it
+tracing = dict(users=0, lock=threading.Lock())
+
+
+class Phase(object):
+
+    """Times one block into its profiler's phase totals"""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.time() - self.started)
+        return False
+
+
+class Profiler(object):
+
+    """
+    Profile one job. cProfile covers the thread calling start() (the job
+    thread in run.py), tracemalloc and the phase totals cover every thread,
+    so with jobs running in parallel the memory figures are for the process.
+    """
+
+    # allocation sites kept in the report
+    top_allocations = 20
+
+    def __init__(self, name, directory):
+        """
+        :param name: string, job name, used for the file names
+        :param directory: string, where the reports are written
+        :return: void
+        """
+        self.name = name
+        self.directory = directory
+        self.profile = cProfile.Profile()
+        self.phases = {}  # name: [seconds, count]
+        self.lock = threading.Lock()
+        self.started = None
+
+    def phase(self, name):
+        """
+        :param name: string, e.g. request/decode/write/sleep
+        :return: context manager timing the block
+        """
+        return Phase(self, name)
+
+    def add(self, name, seconds):
+        with self.lock:
+            totals = self.phases.setdefault(name, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+
+    def start(self):
+        """
+        :return: void, raises ValueError on Python 3.12+ when another profiler is
+            enabled in the process (run.py profiles each job in its own process)
+        """
+        if tracemalloc is not None:
+            with tracing['lock']:
+                if not tracing['users'] and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                tracing['users'] += 1
+        self.started = time.time()
+        try:
+            self.profile.enable()
+        except Exception:
+            self.release_tracing()  # stop() will not run
+            raise
+
+    @classmethod
+    def release_tracing(cls):
+        """
+        :return: void, the last profiler out stops tracemalloc
+        """
+        if tracemalloc is not None:
+            with tracing['lock']:
+                tracing['users'] -= 1
+                if not tracing['users']:
+                    tracemalloc.stop()
+
+    def stop(self):
+        """
+        Stop and write <name>.pstats, <name>_profile.txt and <name>_profile.json
+        :return: dict, the json report
+        """
+        self.profile.disable()
+        try:
+            report = self.build_report()
+        finally:
+            self.release_tracing()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        base = os.path.join(self.directory, self.name)
+        self.profile.dump_stats('%s.pstats' % base)
+        text = StringIO()
+        pstats.Stats(self.profile, stream=text).sort_stats('cumulative').print_stats(40)
+        with open('%s_profile.txt' % base, 'w') as stats_file:
+            stats_file.write(text.getvalue())
+        with open('%s_profile.json' % base, 'w') as report_file:
+            report_file.write(json.dumps(report, indent=2, sort_keys=True))
+        logging.info('Profile of %s written to %s_profile.json', self.name, base)
+        return report
+
+    def build_report(self):
+        """
+        :return: dict, wall time, phase totals and (with tracemalloc) memory
+        """
+        wall = time.time() - self.started
+        report = dict(
+            job=self.name,
+            wall_seconds=round(wall, 3),
+            phases=dict(
+                (name, dict(seconds=round(seconds, 3), count=count))
+                for name, (seconds, count) in self.phases.items()
+            ),
+        )
+        # time not spent in a timed phase: job logic, list building, logging
+        report['phases']['other'] = dict(
+            seconds=round(max(wall - sum(seconds for seconds, _ in self.phases.values()), 0), 3),
+            count=None,
+        )
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            report['memory'] = dict(
+                current_bytes=current,
+                peak_bytes=peak,
+                top_allocations=[
+                    dict(site=str(stat.traceback), bytes=stat.size, count=stat.count)
+                    for stat in snapshot.statistics('lineno')[:self.top_allocations]
+                ],
+            )
+        return report
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Client side API rate budget shared by threads"""
+
+from __future__ import print_function
+import logging
+import threading
+import time
+
+
+class RateBudget(object):
+
+    """
+    Local copy of the Shopify leaky bucket https://help.shopify.com/api/guides/api-call-limit
+    A bucket of `capacity` calls that drains at `leak_rate` calls per second.
+    acquire() blocks until a call fits, update() re-syncs with the
+    X-Shopify-Shop-Api-Call-Limit header and backoff() pauses everyone after a 429.
+    """
+
+    header = 'X-Shopify-Shop-Api-Call-Limit'
+
+    def __init__(self, capacity=40, leak_rate=2.0, reserve=2):
+        """
+        :param capacity: int, bucket size (40 standard, 80 Plus)
+        :param leak_rate: float, calls per second drained (2 standard, 4 Plus)
+        :param reserve: int, calls kept free for other apps/scripts on the shop
+        :return: void
+        """
+        self.capacity = capacity
+        self.leak_rate = float(leak_rate)
+        self.reserve = reserve
+        self.level = 0.0
+        self.updated = time.time()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.waited = 0.0  # seconds callers spent blocked, for run summaries
+
+    def leak(self, now):
+        """
+        Drain the bucket for the time passed, call with the lock held
+        :param now: float, time.time()
+        :return: void
+        """
+        self.level = max(self.level - (now - self.updated) * self.leak_rate, 0.0)
+        self.updated = now
+
+    def acquire(self, cost=1):
+        """
+        Block until a call fits in the budget, then take it
+        :param cost: number, units the call takes (1 per REST call, the query cost for GraphQL)
+        :return: float, seconds waited
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                self.leak(now)
+                # a call bigger than the whole budget waits for an empty bucket
+                units = min(cost, self.capacity - self.reserve)
+                if now >= self.blocked_until and self.level + units <= self.capacity - self.reserve:
+                    self.level += units
+                    self.calls += 1
+                    self.waited += waited
+                    return waited
+                wait = max(
+                    self.blocked_until - now,
+                    (self.level + units - (self.capacity - self.reserve)) / self.leak_rate,
+                    0.01,
+                )
+            time.sleep(wait)
+            waited += wait
+
+    def update(self, value):
+        """
+        Sync with the shop's view, e.g. "32/40" from X-Shopify-Shop-Api-Call-Limit
+        :param value: string or None
+        :return: void
+        """
+        if not value:
+            return
+        try:
+            used, capacity = [int(part) for part in value.split('/')]
+        except ValueError:
+            logging.debug('Unparsable call limit header %r', value)
+            return
+        with self.lock:
+            self.leak(time.time())
+            self.capacity = capacity
+            # other clients on the shop count too, never trust a lower local view
+            self.level = max(self.level, float(used))
+
+    def backoff(self, seconds):
+        """
+        Hold every caller for a while, used on 429 with the Retry-After value
+        :param seconds: float
+        :return: void
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+        logging.warning('Rate budget backing off for %.1fs', seconds)
+
+
+class SharedRateBudget(RateBudget):
+
+    """
+    One bucket for every process/host of a distributed run, kept in the work
+    queue's store (work_queue.SqliteQueue or RedisQueue) instead of memory
+    """
+
+    def __init__(self, store, capacity=40, leak_rate=2.0, reserve=2):
+        """
+        :param store: queue object with budget_take/budget_sync/budget_block
+        :param capacity: int, bucket size (40 standard, 80 Plus)
+        :param leak_rate: float, calls per second drained (2 standard, 4 Plus)
+        :param reserve: int, calls kept free for other apps/scripts on the shop
+        :return: void
+        """
+        super(SharedRateBudget, self).__init__(capacity, leak_rate, reserve)
+        self.store = store
+
+    def acquire(self, cost=1):
+        waited = 0.0
+        while True:
+            wait = self.store.budget_take(self.capacity - self.reserve, self.leak_rate, cost)
+            if not wait:
+                with self.lock:
+                    self.calls += 1
+                    self.waited += waited
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def update(self, value):
+        if not value:
+            return
+        try:
+            used, capacity = [int(part) for part in value.split('/')]
+        except ValueError:
+            logging.debug('Unparsable call limit header %r', value)
+            return
+        self.capacity = capacity
+        self.store.budget_sync(used, capacity, self.leak_rate)
+
+    def backoff(self, seconds):
+        self.store.budget_block(time.time() + seconds)
+        logging.warning('Shared rate budget backing off for %.1fs', seconds)
@@ -1,70 +1,559 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-"""Basic implementation"""
+"""Basic implementation, command line entry point for the extract jobs"""
 
 from __future__ import print_function
+import argparse
 import logging
+import multiprocessing
 import os
+import sys
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import logs
+from cassette import Cassette
+from output import RunOutput
+from planner import Planner, log_plan
+from profiling import Profiler
+from shopify import Shopify
 from shopify_creds import ShopifyCreds
+from jobs.audit import AuditCatalog
+from jobs.changes import DiffSnapshots
 from jobs.collections import ExtractCollectionData
+from jobs.images import MirrorImages
+from jobs.inventory import ExtractInventory
+from jobs.joins import JoinProductCollections
+from jobs.metafields import ExtractMetafields
+from jobs.orders import ExtractOrders
 from jobs.products import ExtractProducts
+from jobs.rules import EvaluateSmartCollections
+from jobs.search import IndexProducts
 
-# let's get noisy
-logging.basicConfig(level=logging.INFO)  # global
-logger = logging.getLogger()
-fh = logging.FileHandler('%s/transform_log.txt' % os.path.dirname(os.path.realpath(__file__)))
-formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-fh.setFormatter(formatter)
-logger.addHandler(fh)
+# --------------------------------------------------------------------
+# Job registry |
+# name: job class, method, upstream jobs whose results are passed in |
+# --------------------------------------------------------------------
+JOBS = {
+    'smart_collections': dict(
+        cls=ExtractCollectionData,
+        method='extract_smart_collection_data',
+        requires=[],
+    ),
+    'custom_collections': dict(
+        cls=ExtractCollectionData,
+        method='extract_custom_collection_data',
+        requires=[],
+    ),
+    'collects': dict(
+        cls=ExtractCollectionData,
+        method='extract_collect_data',
+        requires=[],
+    ),
+    'products': dict(
+        cls=ExtractProducts,
+        method='extract_product',
+        requires=[],
+    ),
+    'orders': dict(
+        cls=ExtractOrders,
+        method='extract_orders',
+        requires=[],
+    ),
+    'product_collections': dict(
+        cls=JoinProductCollections,
+        method='join_product_collections',
+        requires=['products', 'collects'],
+    ),
+    'inventory_levels': dict(
+        cls=ExtractInventory,
+        method='extract_inventory_levels',
+        requires=['products'],
+    ),
+    'product_changes': dict(
+        cls=DiffSnapshots,
+        method='diff_products',
+        requires=['products'],
+    ),
+    'product_metafields': dict(
+        cls=ExtractMetafields,
+        method='extract_product_metafields',
+        requires=['products'],
+    ),
+    'smart_collection_members': dict(
+        cls=EvaluateSmartCollections,
+        method='evaluate_smart_collections',
+        requires=['products', 'smart_collections'],
+    ),
+    'search_index': dict(
+        cls=IndexProducts,
+        method='index_products',
+        requires=['products'],
+    ),
+    'product_images': dict(
+        cls=MirrorImages,
+        method='mirror_images',
+        requires=['products'],
+    ),
+    'catalog_audit': dict(
+        cls=AuditCatalog,
+        method='audit_catalog',
+        requires=['products', 'product_collections'],
+    ),
+}
 
+# what runs when no job is named, same as the old hard-coded run.py
+DEFAULT_JOBS = ['smart_collections', 'custom_collections', 'collects', 'products']
 
-if __name__ == "__main__":
 
-    # ----------------------
-    # Run basic extraction |
-    logging.info('Beginning extraction via run.py')
-    col = ExtractCollectionData(ShopifyCreds())
-    logging.info('Start Smart Collections')
-    smart_collections = col.extract_smart_collection_data()
-    logging.info('Start Custom Collections')
-    custom_collections = col.extract_custom_collection_data()
-    logging.info('Start Collects')
-    collect_data = col.extract_collect_data()
-
-    logging.info('Start Products')
-    pro = ExtractProducts(ShopifyCreds())
-    product_data_all = pro.extract_product()
+def setup_logging():
+    """
+    Let's get noisy, console plus transform_log.txt next to this file, written
+    by a background thread (see logs.py)
+    :return: QueueListener or None
+    """
+    return logs.setup_logging(
+        '%s/transform_log.txt' % os.path.dirname(os.path.realpath(__file__))
+    )
 
-    logging.info('Complete')
 
-    # --------------------
-    # # Chunk everything |
-    # logging.info('Beginning extraction via run.py')
-    # col = ExtractCollectionData(ShopifyCreds())
-    # col.chunk = True
-    # # col.limit = 1  # 1 item per page, good for testing otherwise a bad idea
-    # logging.info('Start Smart Collections')
-    # smart_collections = col.extract_smart_collection_data()
-    # logging.info('Start Custom Collections')
-    # custom_collections = col.extract_custom_collection_data()
-    # logging.info('Start Collects')
-    # collect_data = col.extract_collect_data()
-    #
-    # logging.info('Start Products')
-    # pro = ExtractProducts(ShopifyCreds())
-    # pro.chunk = True
-    # product_data_all = pro.extract_product()
-    #
-    # logging.info('Complete')
-
-    # ----------------
-    # Reduced memory |
-    # col = ExtractCollectionData(ShopifyCreds())
-    # col.less_memory = True
-    # # col.limit = 1  # 1 item per page, good for testing otherwise a bad idea
-    # smart_collections = col.extract_smart_collection_data()
-    # print(smart_collections)
-    # # ERROR:root:Collection starting count (15) != number of results pulled from the API (0).
+def parse_value(value):
+    """
+    Turn a command line option value into bool/int/float/string
+    :param value: string
+    :return: mixed
+    """
+    if value.lower() in ('true', 'yes', 'on'):
+        return True
+    if value.lower() in ('false', 'no', 'off'):
+        return False
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_job_options(options, job_names):
+    """
+    Parse ["products.limit=50", "all.chunk=true"] into per job attribute dicts
+    :param options: list of strings JOB.ATTRIBUTE=VALUE, JOB may be "all"
+    :param job_names: list, jobs selected for this run
+    :return: dict {job name: {attribute: value}}
+    """
+    job_options = dict((name, {}) for name in job_names)
+    for option in options:
+        target, equals, value = option.partition('=')
+        job, dot, attribute = target.partition('.')
+        if not equals or not dot or not attribute:
+            raise ValueError('Job option "%s" is not JOB.ATTRIBUTE=VALUE' % option)
+        if job == 'all':
+            for name in job_names:
+                job_options[name][attribute] = parse_value(value)
+        elif job in job_options:
+            job_options[job][attribute] = parse_value(value)
+        else:
+            raise ValueError('Job option "%s" targets a job not in this run' % option)
+    return job_options
+
+
+def resolve_jobs(names):
+    """
+    Add the upstream jobs of every named job and order the lot so each job
+    comes after what it requires
+    :param names: list of job names
+    :return: list of job names (topological order)
+    """
+    ordered = []
+    visiting = set()
+
+    def visit(name):
+        if name in ordered:
+            return
+        if name not in JOBS:
+            raise ValueError('Unknown job "%s", see --list' % name)
+        if name in visiting:
+            raise ValueError('Job "%s" is part of a dependency cycle' % name)
+        visiting.add(name)
+        for upstream in JOBS[name]['requires']:
+            visit(upstream)
+        visiting.discard(name)
+        ordered.append(name)
+
+    for job_name in names:
+        visit(job_name)
+    return ordered
+
+
+def downstream_results(results, options):
+    """
+    What a job hands to the jobs requiring it. A job run with less_memory returns
+    an empty list, not its records, so downstream jobs get None and refuse to run
+    rather than read it as an empty catalog (a diff deleting every product)
+    :param results: return value of the job method
+    :param options: dict, the job's options
+    :return: results or None
+    """
+    if options.get('less_memory'):
+        return None
+    return results
+
+
+def execute_job(name, options, inputs, write=True, overwrite_files=False, run_id=None,
+                profile=False, ndjson=False, cassette=None):
+    """
+    Run one job start to finish. Module level so it can cross a process boundary.
+    :param name: string, key of JOBS
+    :param options: dict, job attributes to set before running (limit, chunk, ...)
+    :param inputs: list, results of the upstream jobs in JOBS[name]['requires'] order
+    :param write: bool, passed to the job method
+    :param overwrite_files: bool, passed on via the creds object
+    :param run_id: string, optional, write into json/runs/<run_id> instead of flat files
+    :param profile: bool, optional, profile the job into <run dir>/profiles (or json/profiles)
+    :param ndjson: bool, optional, write record lists as indexed ndjson (run layout only)
+    :param cassette: dict, optional, (directory, mode, latency) serve the job's requests from
+        <directory>/<name>.json.gz instead of the network, see cassette.Cassette
+    :return: tuple (name, results, errors, seconds, info) info holds the manifest entries
+        written (files), the page sizes chosen per resource (page_sizes) and the
+        profile report (profile, None unless profiling)
+    """
+    started = time.time()
+    output = RunOutput(run_id, ndjson=ndjson) if run_id else None
+    job = None
+    profiler = None
+    profile_report = None
+    if profile:
+        profiler = Profiler(name, os.path.join(
+            output.run_dir if output is not None
+            else os.path.dirname(os.path.realpath(__file__)) + '/json',
+            'profiles'
+        ))
+    try:
+        creds = ShopifyCreds()
+        creds.overwrite_files = overwrite_files
+        job = JOBS[name]['cls'](creds)
+        job.output = output
+        for attribute, value in options.items():
+            setattr(job, attribute, value)
+        if cassette is not None:
+            job.cassette = Cassette(
+                os.path.join(cassette['directory'], '%s.json.gz' % name),
+                cassette['mode'], cassette['latency'],
+            )
+        if profiler is not None:
+            job.profiler = profiler
+            profiler.start()
+        try:
+            results = getattr(job, JOBS[name]['method'])(*inputs, write=write)
+        finally:
+            if profiler is not None:
+                profile_report = profiler.stop()
+            if job.cassette is not None:
+                job.cassette.close()
+        errors = list(job.errors)
+        if results is None and not errors:
+            errors.append('%s returned no results' % name)
+    except Exception as e:  # report it, don't take the sibling jobs down with it
+        logging.exception('Job %s raised', name)
+        results = None
+        errors = ['%s raised %r' % (name, e)]
+    info = dict(
+        files=output.entries if output is not None else [],
+        page_sizes=job.page_size_summary() if job is not None else {},
+        profile=profile_report,
+    )
+    return name, results, errors, time.time() - started, info
+
+
+def run_jobs(names, job_options=None, workers=4, processes=False, write=True,
+             overwrite_files=False, output=None, profile=False, cassette=None, log_queue=None):
+    """
+    Run jobs as a DAG, every job whose upstream jobs are complete is started
+    right away so independent jobs run side by side.
+    :param names: list, job names in topological order (see resolve_jobs())
+    :param job_options: dict, optional, output of parse_job_options()
+    :param workers: int, max jobs running at once
+    :param processes: bool, use a process pool instead of threads
+    :param write: bool, passed to each job method
+    :param overwrite_files: bool, passed on via the creds object
+    :param output: RunOutput, optional, run scoped layout, the manifest is written at the end
+    :param profile: bool, optional, profile every job (see profiling.Profiler), implies processes
+    :param cassette: dict, optional, record/replay every job, see execute_job()
+    :param log_queue: multiprocessing queue, optional, the queue of logs.setup_logging()'s
+        listener, process pool workers log through it (see logs.init_worker())
+    :return: dict {name: dict(status, records, errors, seconds, page_sizes, profile)}
+    """
+    job_options = job_options or {}
+    if profile and not processes:
+        # one cProfile per process: Python 3.12+ refuses a second one enabled at once
+        logging.info('Profiling runs every job in its own process (--processes)')
+        processes = True
+    done = queue.Queue()
+    pool = multiprocessing.Pool(
+        workers, initializer=logs.init_worker,
+        initargs=(log_queue, logging.getLogger().level),
+    ) if processes else None
+    pending = list(names)
+    results = {}
+    report = {}
+    running = 0
+
+    def submit(name):
+        args = (
+            name,
+            job_options.get(name, {}),
+            [results[upstream] for upstream in JOBS[name]['requires']],
+            write,
+            overwrite_files,
+            output.run_id if output is not None else None,
+            profile,
+            output.ndjson if output is not None else False,
+            cassette,
+        )
+        logging.info('Start %s', name)
+        if pool is not None:
+            def failed(e):
+                # raised outside execute_job() (pickling args or the result), callback never runs
+                done.put((name, None, ['%s raised %r' % (name, e)], 0.0, dict(
+                    files=[], page_sizes={}, profile=None,
+                )))
+            callbacks = dict(callback=done.put)
+            if sys.version_info[0] >= 3:  # Python 2 pools have no error_callback
+                callbacks['error_callback'] = failed
+            pool.apply_async(execute_job, args, **callbacks)
+        else:
+            thread = threading.Thread(target=lambda: done.put(execute_job(*args)))
+            thread.daemon = True
+            thread.start()
 
+    try:
+        while pending or running:
+            for name in list(pending):
+                if running >= workers:
+                    break
+                requires = JOBS[name]['requires']
+                if any(upstream not in report for upstream in requires):
+                    continue
+                pending.remove(name)
+                failed = [upstream for upstream in requires if report[upstream]['status'] != 'ok']
+                if failed:
+                    report[name] = dict(
+                        status='skipped',
+                        records=None,
+                        errors=['upstream failed: %s' % ', '.join(failed)],
+                        seconds=0.0,
+                        page_sizes={},
+                        profile=None,
+                    )
+                    continue
+                submit(name)
+                running += 1
+            if not running:
+                continue
+            name, job_results, errors, seconds, info = done.get()
+            running -= 1
+            if output is not None:
+                output.add_entries(info['files'])
+            results[name] = downstream_results(job_results, job_options.get(name, {}))
+            report[name] = dict(
+                status='failed' if errors else 'ok',
+                records=len(job_results) if isinstance(job_results, list) else None,
+                errors=errors,
+                seconds=seconds,
+                page_sizes=info['page_sizes'],
+                profile=info['profile'],
+            )
+            logging.info('Finished %s (%s) in %.2fs', name, report[name]['status'], seconds)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if output is not None and write:
+        output.write_manifest(jobs=report)
+    return report
 
+
+def log_report(names, report, elapsed):
+    """
+    Log the final per job report
+    :param names: list, job names in run order
+    :param report: dict, output of run_jobs()
+    :param elapsed: float, wall seconds for the whole run
+    :return: void
+    """
+    logging.info('\n------Run report')
+    for name in names:
+        row = report[name]
+        logging.info(
+            '%-22s %-8s records=%-8s %8.2fs', name, row['status'], row['records'], row['seconds']
+        )
+        for resource, sizes in sorted(row['page_sizes'].items()):
+            logging.info('    page size %s: %s', resource, sizes)
+        if row['profile'] is not None:
+            logging.info('    phases: %s', ', '.join(
+                '%s %.2fs' % (phase, totals['seconds'])
+                for phase, totals in sorted(row['profile']['phases'].items())
+            ))
+        for error in row['errors']:
+            logging.info('    %s', error)
+    logging.info('Wall time %.2fs', elapsed)
+
+
+def dry_run(names, job_options, workers, cassette=None):
+    """
+    Estimate the run without fetching any data, only count.json is called
+    :param names: list, job names in run order
+    :param job_options: dict, output of parse_job_options()
+    :param workers: int, jobs run at once
+    :param cassette: dict, optional, see execute_job()
+    :return: dict, output of planner.Planner.plan() or None on fail
+    """
+    creds = ShopifyCreds()
+    shopify = Shopify(creds)
+    shopify.read_only = True
+    if cassette is not None:
+        shopify.cassette = Cassette(
+            os.path.join(cassette['directory'], 'dry_run.json.gz'),
+            cassette['mode'], cassette['latency'],
+        )
+    jobs = {}
+    for name in names:
+        jobs[name] = JOBS[name]['cls'](creds)
+        for attribute, value in job_options.get(name, {}).items():
+            setattr(jobs[name], attribute, value)
+    try:
+        plan = Planner(shopify, jobs).plan(names, workers)
+    finally:
+        if shopify.cassette is not None:
+            shopify.cassette.close()
+    if plan is None:
+        for error in shopify.errors:
+            logging.error('Dry run: %s', error)
+        return None
+    log_plan(names, plan)
+    return plan
+
+
+def get_parser():
+    """
+    Command line arguments
+    :return: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description='ShopifyETL extract jobs')
+    parser.add_argument(
+        'jobs', nargs='*',
+        help='jobs to run (default: %s), upstream jobs are added' % ' '.join(DEFAULT_JOBS)
+    )
+    parser.add_argument('--list', action='store_true', help='list the available jobs and exit')
+    parser.add_argument(
+        '-o', '--option', action='append', default=[], metavar='JOB.ATTR=VALUE',
+        help='set a job attribute, e.g. products.limit=50 or all.chunk=true (repeatable)'
+    )
+    parser.add_argument('-w', '--workers', type=int, default=4, help='jobs running at once')
+    parser.add_argument(
+        '--processes', action='store_true', help='run jobs in processes instead of threads'
+    )
+    parser.add_argument(
+        '--auto-limit', action='store_true',
+        help='adapt page sizes per resource from response time/size (same as all.auto_limit=true)'
+    )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='profile each job (cProfile, tracemalloc, time per phase) into <run dir>/profiles'
+    )
+    parser.add_argument(
+        '--cassettes', metavar='DIR',
+        help='serve every request from DIR/<job>.json.gz instead of the network (offline runs)'
+    )
+    parser.add_argument(
+        '--record', choices=('record', 'once'),
+        help='with --cassettes: record all cassettes again, or only the missing ones'
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help='with --cassettes: replay the recorded response times scaled by this (1.0 real time)'
+    )
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='only call count.json, estimate calls, bytes and time and recommend settings'
+    )
+    parser.add_argument('--no-write', action='store_true', help='do not write json files')
+    parser.add_argument('--overwrite', action='store_true', help='overwrite existing json files')
+    parser.add_argument(
+        '--flat-output', action='store_true',
+        help='write json/<name>.json files instead of a json/runs/<run_id> directory'
+    )
+    parser.add_argument(
+        '--ndjson', action='store_true',
+        help='write record lists as .ndjson with an id -> offset .idx for random access'
+    )
+    return parser
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    :param argv: list, optional, defaults to sys.argv[1:]
+    :return: int exit code
+    """
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name in sorted(JOBS):
+            requires = JOBS[name]['requires']
+            print('%-22s %s%s' % (
+                name,
+                JOBS[name]['method'],
+                ' (requires %s)' % ', '.join(requires) if requires else '',
+            ))
+        return 0
+
+    try:
+        names = resolve_jobs(args.jobs or DEFAULT_JOBS)
+        if args.auto_limit:
+            args.option.insert(0, 'all.auto_limit=true')
+        job_options = parse_job_options(args.option, names)
+    except ValueError as e:
+        parser.error(str(e))
+
+    cassette = dict(
+        directory=args.cassettes, mode=args.record or 'replay', latency=args.latency
+    ) if args.cassettes else None
+    listener = setup_logging()
+    if args.dry_run:
+        plan = dry_run(names, job_options, max(args.workers, 1), cassette)
+        if listener is not None:
+            listener.stop()
+        return 0 if plan is not None else 1
+    output = None if args.flat_output else RunOutput(ndjson=args.ndjson)
+    logging.info('Beginning extraction via run.py: %s', ', '.join(names))
+    if output is not None:
+        logging.info('Run output: %s', output.run_dir)
+    started = time.time()
+    report = run_jobs(
+        names,
+        job_options,
+        workers=max(args.workers, 1),
+        processes=args.processes,
+        write=not args.no_write,
+        overwrite_files=args.overwrite,
+        output=output,
+        profile=args.profile,
+        cassette=cassette,
+        log_queue=listener.queue if listener is not None else None,
+    )
+    log_report(names, report, time.time() - started)
+    logging.info('Complete')
+    if listener is not None:
+        listener.stop()  # flush the queue
+    return 0 if all(report[name]['status'] == 'ok' for name in names) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
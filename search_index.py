@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Inverted search index over extracted products, kept in a SQLite file"""
+
+from __future__ import print_function
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import time
+from snapshot import iter_json_records, record_digest
+from transform import source_files
+
+# fields with postings, stored by position so a posting row is (token, small int, id)
+fields = ('title', 'tag', 'vendor', 'type', 'sku', 'variant')
+# fields with exact (whole value) lookups
+exact_fields = ('sku', 'handle', 'barcode')
+token_pattern = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """
+    :param text: string or None
+    :return: list of lower case word tokens
+    """
+    return token_pattern.findall((text or '').lower())
+
+
+def product_terms(product):
+    """
+    What gets indexed for a product
+    :param product: dict, a product of ExtractProducts.extract_product()
+    :return: tuple (set of (token, field position), set of (exact field, lower case value))
+    """
+    tags = product.get('tags') or ''
+    if not isinstance(tags, list):
+        tags = tags.split(',')
+    texts = [
+        ('title', product.get('title')),
+        ('vendor', product.get('vendor')),
+        ('type', product.get('product_type')),
+    ]
+    texts += [('tag', tag) for tag in tags]
+    exact = set()
+    if product.get('handle'):
+        exact.add(('handle', product['handle'].lower()))
+    for variant in product.get('variants', []):
+        texts.append(('sku', variant.get('sku')))
+        texts.append(('variant', variant.get('title')))
+        for field in ('sku', 'barcode'):
+            if variant.get(field):
+                exact.add((field, variant[field].strip().lower()))
+    tokens = set(
+        (token, fields.index(field)) for field, text in texts for token in tokenize(text)
+    )
+    return tokens, exact
+
+
+class SearchIndex(object):
+
+    """
+    Token -> product id postings (clustered by token, so a term is one range
+    read of sorted ids) plus exact maps for SKU, handle and barcode. Every
+    product's content hash is kept, an update re-indexes only what changed
+    since the last snapshot and drops what disappeared.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: string, optional, database file, defaults to json/search.db
+        :return: void
+        """
+        if path is None:
+            path = os.path.dirname(os.path.realpath(__file__)) + '/json/search.db'
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')  # queries keep working during an update
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS documents ('
+            ' id INTEGER PRIMARY KEY, digest BLOB NOT NULL, title TEXT, handle TEXT)'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS postings ('
+            ' token TEXT NOT NULL, field INTEGER NOT NULL, id INTEGER NOT NULL,'
+            ' PRIMARY KEY (token, field, id)) WITHOUT ROWID'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS exact ('
+            ' field TEXT NOT NULL, value TEXT NOT NULL, id INTEGER NOT NULL,'
+            ' PRIMARY KEY (field, value, id)) WITHOUT ROWID'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS postings_id ON postings (id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS exact_id ON exact (id)')
+        self.db.commit()
+
+    def update(self, products, full=True, commit=True):
+        """
+        Bring the index in line with a snapshot
+        :param products: iterable of product dicts (a list or iter_json_records())
+        :param full: bool, optional, products is the whole catalog, products not in it are
+            dropped. False for change sets (see delete() for their deletions)
+        :param commit: bool, optional, False rolls the update back (counts only)
+        :return: dict (added, changed, deleted, unchanged counts), raises ValueError for a
+            full update without products on a non-empty index (it would drop every document,
+            most likely an empty or less_memory run; use delete() to empty the index)
+        """
+        counts = dict(added=0, changed=0, deleted=0, unchanged=0)
+        digests = dict(self.db.execute('SELECT id, digest FROM documents'))
+        seen = set()
+        try:
+            for product in products:
+                if product['id'] in seen:  # repeated across page files, the last copy wins
+                    self.index_product(product, record_digest(product), True)
+                    continue
+                seen.add(product['id'])
+                digest = record_digest(product)
+                previous = digests.get(product['id'])
+                if previous is not None and bytes(previous) == digest:
+                    counts['unchanged'] += 1
+                    continue
+                counts['added' if previous is None else 'changed'] += 1
+                self.index_product(product, digest, previous is not None)
+            if full and not seen and digests:
+                raise ValueError(
+                    'No products to index, refusing to drop all %s documents of %s' % (
+                        len(digests), self.path
+                    )
+                )
+            if full:
+                gone = [product_id for product_id in digests if product_id not in seen]
+                counts['deleted'] = self.delete(gone, commit=False)
+        except Exception:
+            self.db.rollback()
+            raise
+        if commit:
+            self.db.commit()
+        else:
+            self.db.rollback()
+        logging.info(
+            'Search index %s: %s added, %s changed, %s deleted, %s unchanged', self.path,
+            counts['added'], counts['changed'], counts['deleted'], counts['unchanged']
+        )
+        return counts
+
+    def index_product(self, product, digest, replace):
+        """
+        :param product: dict
+        :param digest: bytes, record_digest() of the product
+        :param replace: bool, drop the previous postings first
+        :return: void
+        """
+        if replace:
+            self.remove(product['id'])
+        tokens, exact = product_terms(product)
+        self.db.execute(
+            'INSERT OR REPLACE INTO documents (id, digest, title, handle) VALUES (?, ?, ?, ?)',
+            (product['id'], sqlite3.Binary(digest), product.get('title'), product.get('handle'))
+        )
+        self.db.executemany(
+            'INSERT INTO postings (token, field, id) VALUES (?, ?, ?)',
+            [(token, field, product['id']) for token, field in tokens]
+        )
+        self.db.executemany(
+            'INSERT INTO exact (field, value, id) VALUES (?, ?, ?)',
+            [(field, value, product['id']) for field, value in exact]
+        )
+
+    def remove(self, product_id):
+        """
+        :param product_id: int
+        :return: void, uncommitted
+        """
+        for table in ('postings', 'exact', 'documents'):
+            self.db.execute('DELETE FROM %s WHERE id = ?' % table, (product_id,))
+
+    def delete(self, product_ids, commit=True):
+        """
+        :param product_ids: iterable of int, e.g. the deleted.json of a change set
+        :param commit: bool, optional
+        :return: int, products removed
+        """
+        removed = 0
+        for product_id in product_ids:
+            removed += 1
+            self.remove(product_id)
+        if commit:
+            self.db.commit()
+        return removed
+
+    def parse_query(self, query):
+        """
+        :param query: string, words, 'field:word' and 'prefix*' (e.g. 'vendor:acme red t-shirt*')
+        :return: list of (token, field position or None, prefix bool), one per indexed token
+        """
+        terms = []
+        for term in query.lower().split():
+            field, colon, text = term.rpartition(':')
+            if colon and field not in fields:
+                raise ValueError(
+                    'Unknown search field "%s", one of %s' % (field, ', '.join(fields))
+                )
+            tokens = tokenize(text)  # split like the index did, 't-shirt' is t + shirt
+            for position, token in enumerate(tokens):
+                terms.append((
+                    token,
+                    fields.index(field) if colon else None,
+                    text.endswith('*') and position == len(tokens) - 1,
+                ))
+        return terms
+
+    def term_ids(self, token, field=None, prefix=False):
+        """
+        :param token: string, lower case
+        :param field: int, optional, position in fields
+        :param prefix: bool, optional, match tokens starting with token
+        :return: set of product ids
+        """
+        where, params = [], []
+        if prefix:
+            where.append('token >= ? AND token < ?')
+            params += [token, token + u'\uffff']
+        else:
+            where.append('token = ?')
+            params.append(token)
+        if field is not None:
+            where.append('field = ?')
+            params.append(field)
+        return set(row[0] for row in self.db.execute(
+            'SELECT DISTINCT id FROM postings WHERE %s' % ' AND '.join(where), params
+        ))
+
+    def search(self, query, limit=50):
+        """
+        Products having every term of the query
+        :param query: string, see parse_query()
+        :param limit: int, optional, max results
+        :return: list of dicts (id, title, handle) ordered by id
+        """
+        matched = None
+        for token, field, prefix in self.parse_query(query):
+            ids = self.term_ids(token, field, prefix)
+            matched = ids if matched is None else matched & ids
+            if not matched:
+                return []
+        return self.documents(sorted(matched)[:limit]) if matched else []
+
+    def lookup(self, field, value):
+        """
+        Exact match, case insensitive
+        :param field: string, one of exact_fields
+        :param value: string
+        :return: list of dicts (id, title, handle)
+        """
+        if field not in exact_fields:
+            raise ValueError(
+                'Unknown exact field "%s", one of %s' % (field, ', '.join(exact_fields))
+            )
+        return self.documents([row[0] for row in self.db.execute(
+            'SELECT id FROM exact WHERE field = ? AND value = ? ORDER BY id',
+            (field, value.strip().lower())
+        )])
+
+    def documents(self, product_ids):
+        """
+        :param product_ids: list of int
+        :return: list of dicts (id, title, handle) in the same order
+        """
+        found = {}
+        for start in range(0, len(product_ids), 500):  # under SQLite's variable limit
+            batch = product_ids[start:start + 500]
+            for row in self.db.execute(
+                    'SELECT id, title, handle FROM documents WHERE id IN (%s)'
+                    % ','.join('?' * len(batch)), batch):
+                found[row[0]] = dict(id=row[0], title=row[1], handle=row[2])
+        return [found[product_id] for product_id in product_ids if product_id in found]
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    :param argv: list, optional, defaults to sys.argv[1:]
+    :return: int exit code, 1 when nothing was found
+    """
+    parser = argparse.ArgumentParser(description='ShopifyETL product search index')
+    parser.add_argument('command', choices=('index', 'search', 'lookup'))
+    parser.add_argument(
+        'args', nargs='+',
+        help='index: product files or run directories; search: query terms; '
+             'lookup: sku|handle|barcode VALUE'
+    )
+    parser.add_argument('--db', default=None, help='index file (default: json/search.db)')
+    parser.add_argument('--limit', type=int, default=50, help='search: max results')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    with SearchIndex(args.db) as index:
+        if args.command == 'index':
+            paths = []
+            for source in args.args:
+                paths += source_files(source, 'products')
+            try:
+                index.update(iter_json_records(paths))
+            except ValueError as e:
+                logging.error('%s', e)
+                return 1
+            return 0
+        started = time.time()
+        try:
+            if args.command == 'search':
+                results = index.search(' '.join(args.args), args.limit)
+            elif len(args.args) != 2:
+                parser.error('lookup takes a field and a value')
+            else:
+                results = index.lookup(args.args[0], args.args[1])
+        except ValueError as e:
+            parser.error(str(e))
+        for result in results:
+            print(json.dumps(result))
+        logging.info('%s results in %.1fms', len(results), (time.time() - started) * 1000)
+    return 0 if results else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,9 +4,17 @@
 """Shopify Base Class"""
 
 from __future__ import print_function
+from time import sleep
+import time
 import requests
 import logging
 import json
+import os
+from external_sort import sort_files
+from page_size import PageSizeController
+from profiling import NULL_PHASE
+from rate_budget import RateBudget
+from util import claim_json_path, write_json
 
 
 def handle_429(calltype, call, data=None, params=None):
@@ -30,6 +38,28 @@ class Shopify(object):
     """Base Shopify Class"""
 
     base = 'https://%s:%s@%s.myshopify.com/'  # key / pass / store
+    # max page size the API allows, used by id probes and range re-fetches
+    max_limit = 250
+    # connections kept alive per object, raise for many threads on one object
+    pool_size = 10
+    # when True only GET calls are allowed (extract jobs)
+    read_only = False
+    # bytes of a bad response body kept for the verbose payload dump
+    payload_bytes = 64 * 1024
+    # pagination defaults used by paginate(), job classes set their own
+    page = 1
+    limit = 20
+    sleep_interval = 0
+    # Boolean, when True paginate() pages by since_id and adapts limit per resource
+    auto_limit = False
+    # seconds before a page request times out when auto_limit is on (then retried smaller)
+    page_timeout = 30
+    # retries of one page after a timeout/server error when auto_limit is on
+    page_retries = 3
+    # GraphQL Admin API version, REST calls stay on the unversioned admin/ paths
+    graphql_version = '2023-01'
+    # retries of a GraphQL call answered THROTTLED
+    graphql_retries = 5
     # overwrite_files = False  # flag used by write_json()
 
     def __init__(self, creds_object, verbose=False):
@@ -43,6 +73,14 @@ class Shopify(object):
         self.creds = creds_object
         self.conn = None
         self.errors = []
+        self.output = None  # output.RunOutput, None writes flat files via write_json()
+        self.rate_budget = None  # rate_budget.RateBudget, shared between objects/threads
+        self.session = None
+        self.cassette = None  # cassette.Cassette, records/replays requests instead of the network
+        self.page_sizes = {}  # resource: PageSizeController, when auto_limit is on
+        self.profiler = None  # profiling.Profiler, times request/decode/write/sleep phases
+        # rate_budget.RateBudget in query cost points, GraphQL has its own bucket
+        self.graphql_budget = None
 
     def get_connection(self):
         """
@@ -57,33 +95,109 @@ class Shopify(object):
             ) + '%s'
         return self.conn
 
-    def shopify_get(self, call, params=None):
+    def get_session(self):
         """
-        Make a get call to Shopify
-        :param call:
-        :param params:
-        :return: None or data for product (request.contents)
+        requests session with a pool of keep-alive connections, sized for the
+        threads sharing this object, or the cassette when one is set
+        :return: requests.Session or cassette.Cassette
+        """
+        if self.cassette is not None:
+            return self.cassette
+        if self.session is None:
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+        return self.session
+
+    def graphql_call(self):
+        """
+        :return: string, API path of the GraphQL endpoint
+        """
+        return 'admin/api/%s/graphql.json' % self.graphql_version
+
+    @classmethod
+    def is_graphql_query(cls, data):
+        """
+        A GraphQL read (query, not mutation), allowed on read only objects
+        :param data: string, json request body
+        :return: bool
+        """
+        try:
+            document = json.loads(data)['query'].lstrip()
+        except (TypeError, ValueError, KeyError, AttributeError):
+            return False
+        return document.startswith('{') or document.startswith('query')
+
+    def shopify_request(self, method, call, params=None, data=None, headers=None, timeout=None,
+                        cost=1):
+        """
+        Every call to Shopify goes through here, pooled connection, optional
+        shared rate budget (self.rate_budget, self.graphql_budget for GraphQL)
+        and 429 handling
+        :param method: string, required, get/post/put/delete
+        :param call: string, required, API path
+        :param params: optional dict of query params
+        :param data: optional request body
+        :param headers: optional dict of headers
+        :param timeout: optional seconds, None waits forever
+        :param cost: optional, budget units the call takes (GraphQL query cost)
+        :return: requests.Response or None if the method is forbidden (read_only)
         """
         call = self.prepare_call(call)
-        if params is not None:
-            req = requests.get(self.get_connection() % call, params=params)
-        else:
-            req = requests.get(self.get_connection() % call)
-        if req.status_code == 429:
-            handle_429(
-                'get', call, params=params
+        graphql = call == self.graphql_call()
+        if self.read_only and method != 'get' and not (graphql and self.is_graphql_query(data)):
+            logging.error('shopify_%s called on a read only object and forbidden', method)
+            return None
+        budget = self.graphql_budget if graphql else self.rate_budget
+        if budget is not None:
+            with self.phase('budget'):
+                budget.acquire(cost)
+        with self.phase('request'):
+            req = self.get_session().request(
+                method.upper(), self.get_connection() % call, params=params, data=data,
+                headers=headers, timeout=timeout,
             )
-        if req.status_code != 200 and req.status_code != 201:  # do we get 201 here also?
+        if self.rate_budget is not None:
+            self.rate_budget.update(req.headers.get(RateBudget.header))
+        if req.status_code == 429:
+            handle_429(method, call, data=data, params=params)
+            if self.rate_budget is not None:
+                self.rate_budget.backoff(float(req.headers.get('Retry-After') or 2))
+        return req
+
+    def parse_response(self, method, req):
+        """
+        Decode a response, log the bad ones when verbose
+        :param method: string, for the log
+        :param req: requests.Response or None
+        :return: None or decoded json
+        """
+        if req is None:
+            return None
+        if req.status_code != 200 and req.status_code != 201:
             if self.verbose:
-                logging.error('>>bad status using shopify_get(): %s', req.status_code)
-                logging.error('> r.request %s', req.request)
-                logging.error('> r.content %s', req.content)
-                logging.error('> r.raw %s', req.raw)
-                logging.error('> r.text %s', req.text)
+                # the body goes to its own truncated file when logs.setup_logging() is used
+                logging.error(
+                    '>>bad status using shopify_%s(): %s %s (%s bytes)',
+                    method, req.status_code, req.request, len(req.content),
+                    extra=dict(
+                        payload=req.content[:self.payload_bytes], payload_size=len(req.content)
+                    ),
+                )
             return None
-        else:
+        with self.phase('decode'):
             return json.loads(req.content)
 
+    def shopify_get(self, call, params=None):
+        """
+        Make a get call to Shopify
+        :param call:
+        :param params:
+        :return: None or data for product (request.contents)
+        """
+        return self.parse_response('get', self.shopify_request('get', call, params=params))
+
     def shopify_post(self, call, data=None, headers=None):
         """
         Make a post call to Shopify
@@ -93,25 +207,11 @@ class Shopify(object):
         :return: return strong, should be json
         ** Note: no leading slash
         """
-        call = self.prepare_call(call)
         if headers is None:
             headers = {'Content-Type': 'application/json'}
-        if data is not None:
-            req = requests.post(self.get_connection() % call, headers=headers, data=data)
-        else:
-            req = requests.post(self.get_connection() % call, headers=headers)
-        if req.status_code == 429:
-            handle_429('post', call, data=data)
-        if req.status_code != 200 and req.status_code != 201:
-            if self.verbose:
-                logging.error('>>bad status using shopify_post(): %s', req.status_code)
-                logging.error('> r.request %s', req.request)
-                logging.error('> r.content %s', req.content)
-                logging.error('> r.raw %s', req.raw)
-                logging.error('> r.text %s', req.text)
-            return None
-        else:
-            return json.loads(req.content)
+        return self.parse_response(
+            'post', self.shopify_request('post', call, data=data, headers=headers)
+        )
 
     def shopify_put(self, call, data=None, headers=None):
         """
@@ -125,25 +225,11 @@ class Shopify(object):
         # requests.put(url, data=None, **kwargs)
 
         """
-        call = self.prepare_call(call)
         if headers is None:
             headers = {'Content-Type': 'application/json'}
-        if data is not None:
-            req = requests.put(self.get_connection() % call, headers=headers, data=data)
-        else:
-            req = requests.put(self.get_connection() % call, headers=headers)
-        if req.status_code == 429:
-            handle_429('post', call, data=data)
-        if req.status_code != 200 and req.status_code != 201:
-            if self.verbose:
-                logging.error('>>bad status using shopify_put(): %s', req.status_code)
-                logging.error('> r.request %s', req.request)
-                logging.error('> r.content %s', req.content)
-                logging.error('> r.raw %s', req.raw)
-                logging.error('> r.text %s', req.text)
-            return None
-        else:
-            return json.loads(req.content)
+        return self.parse_response(
+            'put', self.shopify_request('put', call, data=data, headers=headers)
+        )
 
     def shopify_delete(self, call):
         """
@@ -151,20 +237,296 @@ class Shopify(object):
         :param call: path on api
         :return: content, none on error
         """
-        call = self.prepare_call(call)
-        req = requests.delete(self.get_connection() % call)
-        if req.status_code == 429:
-            handle_429('post', call, data=None)
-        if req.status_code != 200 and req.status_code != 201:
-            if self.verbose:
-                logging.error('>>bad status using shopify_delete(): %s', req.status_code)
-                logging.error('> r.request %s', req.request)
-                logging.error('> r.content %s', req.content)
-                logging.error('> r.raw %s', req.raw)
-                logging.error('> r.text %s', req.text)
+        return self.parse_response('delete', self.shopify_request('delete', call))
+
+    def shopify_graphql(self, query, variables=None, cost=1):
+        """
+        Run a GraphQL query, retried while THROTTLED. The cost figures of each
+        response re-sync self.graphql_budget.
+        :param query: string, required, GraphQL document
+        :param variables: dict, optional
+        :param cost: number, optional, expected query cost, taken from the budget up front
+        :return: dict (data, extensions) or None on fail (errors are logged and kept in self.errors)
+        """
+        data = json.dumps(dict(query=query, variables=variables or {}))
+        for attempt in range(self.graphql_retries + 1):
+            res = self.parse_response('post', self.shopify_request(
+                'post', self.graphql_call(), data=data,
+                headers={'Content-Type': 'application/json'}, cost=cost,
+            ))
+            if res is None:
+                return None
+            throttle = res.get('extensions', {}).get('cost', {}).get('throttleStatus')
+            if throttle and self.graphql_budget is not None:
+                self.graphql_budget.leak_rate = float(throttle['restoreRate'])
+                self.graphql_budget.update('%d/%d' % (
+                    throttle['maximumAvailable'] - throttle['currentlyAvailable'],
+                    throttle['maximumAvailable'],
+                ))
+            errors = res.get('errors')
+            if not errors:
+                return res
+            throttled = any(
+                error.get('extensions', {}).get('code') == 'THROTTLED' for error in errors
+            )
+            if not throttled or attempt == self.graphql_retries:
+                self.errors.append('GraphQL errors: %s' % json.dumps(errors))
+                return None
+            wait = 1.0
+            if throttle:
+                wait = max(cost - throttle['currentlyAvailable'], 0) / float(throttle['restoreRate'])
+            if self.graphql_budget is not None:
+                self.graphql_budget.backoff(wait)
+            else:
+                self.sleep(wait)
+
+    def write_output(self, data, file_name, resource, partition='all'):
+        """
+        Write job output, into the run layout when self.output is set otherwise
+        as json/<file_name>.json
+        :param data: list/dict/string, required
+        :param file_name: string, required, flat file name (no .json)
+        :param resource: string, required, resource folder in the run layout
+        :param partition: string, optional, partition name in the run layout
+        :return: file path or None/False on fail
+        """
+        with self.phase('write'):
+            if self.output is not None:
+                return self.output.write(resource, data, partition)
+            return write_json(data, file_name, overwrite_files=self.creds.overwrite_files)
+
+    def merge_pages(self, resource, paths, file_name, memory_bytes=64 * 1024 * 1024):
+        """
+        Merge page files written by write_output() into one id ordered file
+        without duplicates (external_sort.sort_files(), memory bounded), the run
+        layout gets the 'all' partition, flat output json/<file_name>.json
+        :param resource: string, required, resource folder in the run layout
+        :param paths: list, required, page file paths
+        :param file_name: string, required, flat file name (no .json)
+        :param memory_bytes: int, optional, records held before spilling a sorted run
+        :return: dict (records, bytes, sha256, index, records_in, duplicates, runs, path)
+        """
+        with self.phase('write'):
+            if self.output is not None:
+                ndjson = self.output.ndjson
+                target = self.output.path(resource, 'all', 'ndjson' if ndjson else 'json')
+            else:
+                ndjson = False
+                target = claim_json_path(file_name, self.creds.overwrite_files)
+            stats = sort_files(paths, target, memory_bytes, ndjson)
+            if self.output is not None:
+                self.output.add_file(
+                    target, resource, 'all', stats['records'], stats['bytes'], stats['sha256'],
+                    os.path.relpath(stats['index'], self.output.run_dir) if ndjson else None,
+                )
+        stats['path'] = target
+        logging.info(
+            'Merged %s %s pages into %s: %s records, %s duplicates dropped',
+            len(paths), resource, target, stats['records'], stats['duplicates']
+        )
+        return stats
+
+    def phase(self, name):
+        """
+        Time a block into the profiler's phase totals, a no-op unless profiling
+        :param name: string, e.g. 'request', 'decode', 'write', 'sleep'
+        :return: context manager
+        """
+        if self.profiler is None:
+            return NULL_PHASE
+        return self.profiler.phase(name)
+
+    def sleep(self, seconds):
+        """
+        sleep() between pages, counted as the 'sleep' phase when profiling
+        :param seconds: number
+        :return: void
+        """
+        with self.phase('sleep'):
+            sleep(seconds)
+
+    def page_size_controller(self, resource):
+        """
+        The page size controller of a resource, starting from self.limit
+        :param resource: string
+        :return: PageSizeController
+        """
+        if resource not in self.page_sizes:
+            self.page_sizes[resource] = PageSizeController(
+                initial=self.limit, max_limit=self.max_limit
+            )
+        return self.page_sizes[resource]
+
+    def page_size_summary(self):
+        """
+        Page sizes chosen per resource, for run reports
+        :return: dict
+        """
+        return dict(
+            (resource, controller.summary()) for resource, controller in self.page_sizes.items()
+        )
+
+    def paginate(self, resource):
+        """
+        Page through admin/<resource>.json sleeping sleep_interval between pages.
+        By default pages are page=N with a fixed self.limit. With auto_limit the
+        pages follow a since_id cursor (so the size can change between pages)
+        and the limit adapts to response time, payload size and errors.
+        :param resource: string, required, e.g. 'products' (also the key of the list returned)
+        :return: generator of (page number, list of records), stops early on fail
+            (writes to self.errors)
+        """
+        page = self.page
+        since_id = 0
+        retries = 0
+        controller = self.page_size_controller(resource) if self.auto_limit else None
+        while True:
+            if controller is None:
+                limit = self.limit
+                call = 'admin/%s.json?page=%s&limit=%s' % (resource, page, limit)
+            else:
+                limit = controller.limit
+                call = 'admin/%s.json?since_id=%s&limit=%s' % (resource, since_id, limit)
+            logging.info('\n------Page: %s via limit %s', page, limit)
+
+            started = time.time()
+            try:
+                req = self.shopify_request(
+                    'get', call, timeout=self.page_timeout if controller is not None else None
+                )
+            except requests.exceptions.Timeout:
+                if controller is None or retries >= self.page_retries:
+                    msg = 'The call [%s] timed out after %s retries.' % (call, retries)
+                    logging.error(msg)
+                    self.errors.append(msg)
+                    return
+                req = None
+            seconds = time.time() - started
+            if controller is not None and retries < self.page_retries and (
+                    req is None or req.status_code >= 500):
+                retries += 1
+                controller.observe(0, seconds, 0, error=True)
+                logging.warning('Page %s of %s failed, retrying with limit %s',
+                                page, resource, controller.limit)
+                continue
+
+            res = self.parse_response('get', req)
+            if res is None:
+                self.errors.append('The call [%s] returned None.' % call)
+                return
+            this_page = res.get(resource, False)
+            if resource not in res or not this_page:
+                return
+            if controller is not None:
+                controller.observe(len(this_page), seconds, len(req.content))
+                since_id = this_page[-1]['id']
+            retries = 0
+
+            yield page, this_page
+
+            if controller is not None and len(this_page) < limit:
+                return  # a short since_id page is the last one
+            page += 1
+            logging.info('Sleeping for %s', self.sleep_interval)
+            self.sleep(self.sleep_interval)
+
+    @classmethod
+    def has_duplicates(cls, results):
+        """
+        Check a list of records for repeated ids (offset paging can repeat rows)
+        :param results: list, required, records with an 'id' key
+        :return: bool
+        """
+        return len(set(item['id'] for item in results)) != len(results)
+
+    def get_resource_ids(self, resource):
+        """
+        Walk a resource by since_id asking only for ids (cheap, max page size)
+        :param resource: string, required, resource path such as 'products' or 'collects'
+        :return: sorted list of ids or None on fail (writes to self.errors)
+        """
+        ids = []
+        since_id = 0
+        while True:
+            call = 'admin/%s.json?since_id=%s&limit=%s&fields=id' % (
+                resource, since_id, self.max_limit
+            )
+            res = self.shopify_get(call)
+            if res is None:
+                self.errors.append('The call [%s] returned None.' % call)
+                return None
+            this_page = res.get(resource, [])
+            if not this_page:
+                break
+            ids += [item['id'] for item in this_page]
+            if len(this_page) < self.max_limit:  # short page, nothing left
+                break
+            since_id = this_page[-1]['id']
+            self.sleep(self.sleep_interval)
+        return sorted(ids)
+
+    def reconcile(self, resource, results):
+        """
+        Repair a paginated extraction that drifted while the catalog changed.
+        The fetched ids are diffed against the ids the API reports now, only
+        the missing ranges are re-fetched (via since_id) and the results are
+        de-duplicated by id. Records deleted mid-run are dropped.
+        :param resource: string, required, resource path such as 'products' or 'collects'
+        :param results: list, required, records pulled during pagination
+        :return: list ordered by id or None on fail (writes to self.errors)
+        """
+        expected_ids = self.get_resource_ids(resource)
+        if expected_ids is None:
             return None
-        else:
-            return json.loads(req.content)
+
+        by_id = {}
+        for item in results:
+            by_id[item['id']] = item  # last one wins, later pages are fresher
+        logging.info(
+            'Reconciling %s: %s fetched (%s unique) vs %s expected',
+            resource, len(results), len(by_id), len(expected_ids)
+        )
+
+        # group the missing ids into runs of neighbours in the expected list,
+        # each run is fetched by since_id=<id before the run>
+        runs = []
+        for position, item_id in enumerate(expected_ids):
+            if item_id in by_id:
+                continue
+            if runs and runs[-1][1] == position:
+                runs[-1][1] = position + 1
+            else:
+                runs.append([position, position + 1])
+
+        for start, end in runs:
+            since_id = expected_ids[start - 1] if start > 0 else 0
+            remaining = end - start
+            while remaining > 0:
+                limit = min(remaining, self.max_limit)
+                call = 'admin/%s.json?since_id=%s&limit=%s' % (resource, since_id, limit)
+                res = self.shopify_get(call)
+                if res is None:
+                    self.errors.append('The call [%s] returned None.' % call)
+                    return None
+                this_page = res.get(resource, [])
+                if not this_page:
+                    break
+                for item in this_page:
+                    by_id[item['id']] = item
+                since_id = this_page[-1]['id']
+                remaining -= len(this_page)
+                self.sleep(self.sleep_interval)
+
+        reconciled = [by_id[item_id] for item_id in expected_ids if item_id in by_id]
+        if len(reconciled) != len(expected_ids):
+            msg = 'Reconciliation of %s left %s ids missing.' % (
+                resource, len(expected_ids) - len(reconciled)
+            )
+            logging.error(msg)
+            self.errors.append(msg)
+            return None
+        logging.info('Reconciled %s with %s range calls', resource, len(runs))
+        return reconciled
 
     @classmethod
     def prepare_call(cls, call):
@@ -5,7 +5,10 @@
 
 import logging
 import os
-from ConfigParser import SafeConfigParser  # todo make Py 3.5x happy
+try:
+    from ConfigParser import SafeConfigParser as ConfigParser
+except ImportError:  # Python 3
+    from configparser import ConfigParser
 
 
 class ShopifyCreds(object):
@@ -16,6 +19,7 @@ class ShopifyCreds(object):
     SHOPIFY_PASSWORD = None
     SHOPIFY_STORE = None
     SHOPIFY_BASE_URL = None
+    SHOPIFY_WEBHOOK_SECRET = None  # optional, used by webhooks.py
     overwrite_files = False  # flag used by write_json() and ETL application.
 
     expected_properties = [
@@ -46,6 +50,7 @@ class ShopifyCreds(object):
         self.SHOPIFY_PASSWORD = creds.get('SHOPIFY_PASSWORD', None)
         self.SHOPIFY_STORE = creds.get('SHOPIFY_STORE', None)
         self.SHOPIFY_BASE_URL = creds.get('SHOPIFY_BASE_URL', None)
+        self.SHOPIFY_WEBHOOK_SECRET = creds.get('SHOPIFY_WEBHOOK_SECRET', None)
 
         # iD10t check
         for item in self.expected_properties:
@@ -65,7 +70,7 @@ class ShopifyCreds(object):
         :return: dict
         """
         file_loc = os.path.dirname(os.path.realpath(__file__)) + '/config.cfg'
-        parser = SafeConfigParser()
+        parser = ConfigParser()
         parser.optionxform = str  # preserve case
         parser.read(file_loc)
         creds = dict(parser.items('all'))
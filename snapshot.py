@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Snapshot diffing, compare an extraction against the previous one"""
+
+from __future__ import print_function
+import hashlib
+import heapq
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import time
+from ndjson import iter_ndjson
+
+# index record: big endian id + md5 digest. Big endian means sorting the
+# packed bytes sorts by id, and the file can be bisected in place.
+INDEX_RECORD = struct.Struct('>Q16s')
+
+
+def record_digest(record, field=None):
+    """
+    Hash a record for change detection
+    :param record: dict, required
+    :param field: string, optional, hash only this field (e.g. 'updated_at') instead of the content
+    :return: 16 bytes
+    """
+    if field is not None:
+        payload = '%s' % record.get(field)
+    else:
+        payload = json.dumps(record, sort_keys=True, separators=(',', ':'))
+    return hashlib.md5(payload.encode('utf-8')).digest()
+
+
+def iter_json_records(paths):
+    """
+    Stream records from json list files one file at a time (e.g. chunk page files),
+    .ndjson files are read line by line
+    :param paths: list of file paths
+    :return: generator of dicts
+    """
+    for path in paths:
+        if path.endswith('.ndjson'):
+            for record in iter_ndjson(path):
+                yield record
+            continue
+        with open(path) as json_file:
+            for record in json.load(json_file):
+                yield record
+
+
+class HashIndex(object):
+
+    """Read only view of a sorted on disk id -> digest index, bisected via mmap"""
+
+    def __init__(self, path):
+        """
+        Open the index, a missing or empty file is an empty index
+        :param path: string, required
+        :return: void
+        """
+        self.path = path
+        self.count = 0
+        self.file = None
+        self.map = None
+        if os.path.isfile(path) and os.path.getsize(path):
+            self.file = open(path, 'rb')
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.count = len(self.map) // INDEX_RECORD.size
+
+    def record(self, position):
+        """
+        :param position: int, record number
+        :return: tuple (id, digest)
+        """
+        return INDEX_RECORD.unpack_from(self.map, position * INDEX_RECORD.size)
+
+    def get(self, record_id):
+        """
+        Binary search for an id
+        :param record_id: int
+        :return: digest or None
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            middle_id, digest = self.record(middle)
+            if middle_id == record_id:
+                return digest
+            if middle_id < record_id:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def __iter__(self):
+        for position in range(self.count):
+            yield self.record(position)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+        self.map = self.file = None
+
+
+class JsonListWriter(object):
+
+    """Stream a json list to disk one record at a time, counting bytes and sha256"""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.file = open(path, 'wb')
+        self.put('[')
+
+    def put(self, text):
+        chunk = text.encode('utf-8')
+        self.file.write(chunk)
+        self.sha256.update(chunk)
+        self.size += len(chunk)
+
+    def write(self, record):
+        self.put((',' if self.count else '') + json.dumps(record))
+        self.count += 1
+
+    def close(self):
+        self.put(']')
+        self.file.close()
+
+
+class SnapshotDiff(object):
+
+    """Diff an extraction against the previous snapshot of the same name"""
+
+    kinds = ('added', 'changed', 'deleted')
+
+    def __init__(self, name, base_dir=None, field=None, output=None,
+                 memory_bytes=64 * 1024 * 1024):
+        """
+        :param name: string, required, snapshot name such as 'products'
+        :param base_dir: string, optional, defaults to the json folder
+        :param field: string, optional, compare on this field (e.g. 'updated_at') instead of a
+            content hash of the whole record
+        :param output: RunOutput, optional, write the change sets as the <name>_changes
+            resource of the run (in its manifest) instead of json/changes/<name>/<timestamp>
+        :param memory_bytes: int, optional, new index records held before a sorted run is
+            spilled to a temp file (see sort_packed())
+        :return: void
+        """
+        if base_dir is None:
+            base_dir = os.path.dirname(os.path.realpath(__file__)) + '/json'
+        self.name = name
+        self.field = field
+        self.output = output
+        self.memory_bytes = memory_bytes
+        self.index_path = os.path.join(base_dir, 'snapshots', '%s.idx' % name)
+        self.changes_dir = os.path.join(base_dir, 'changes', name)
+
+    def change_paths(self):
+        """
+        :return: tuple (change set dir, {kind: file path})
+        """
+        if self.output is not None:
+            resource = '%s_changes' % self.name
+            return os.path.join(self.output.run_dir, resource), dict(
+                (kind, self.output.path(resource, kind)) for kind in self.kinds
+            )
+        stamp = time.strftime('%Y%m%d%H%M%S')
+        change_dir = os.path.join(self.changes_dir, stamp)
+        suffix = 1
+        while os.path.isdir(change_dir):  # two diffs inside the same second
+            suffix += 1
+            change_dir = os.path.join(self.changes_dir, '%s_%s' % (stamp, suffix))
+        return change_dir, dict(
+            (kind, os.path.join(change_dir, '%s.json' % kind)) for kind in self.kinds
+        )
+
+    def diff(self, records, write=True):
+        """
+        Stream the new records once, comparing each to the previous index on disk,
+        then merge join the previous index with the new one (sorted with bounded
+        memory, see sort_packed()) to find deletions while the new index is
+        streamed to disk. Neither snapshot is loaded.
+        :param records: iterable of dicts with an 'id' (a list, or iter_json_records())
+        :param write: bool, optional, default True. Write change sets and store the new index
+        :return: dict (added, changed, deleted counts, path of the change set dir or None)
+        """
+        previous = HashIndex(self.index_path)
+        change_dir = None
+        writers = {}
+        index_file = None
+        temp_path = '%s.tmp' % self.index_path
+        if write:
+            change_dir, paths = self.change_paths()
+            if not os.path.isdir(change_dir):
+                os.makedirs(change_dir)
+            for kind in self.kinds:
+                writers[kind] = JsonListWriter(paths[kind])
+            if not os.path.isdir(os.path.dirname(self.index_path)):
+                os.makedirs(os.path.dirname(self.index_path))
+            index_file = open(temp_path, 'wb')
+
+        counts = dict(added=0, changed=0, deleted=0, unchanged=0)
+
+        def compared():
+            for record in records:
+                digest = record_digest(record, self.field)
+                previous_digest = previous.get(record['id'])
+                if previous_digest == digest:
+                    counts['unchanged'] += 1
+                else:
+                    kind = 'added' if previous_digest is None else 'changed'
+                    counts[kind] += 1
+                    if write:
+                        writers[kind].write(record)
+                yield INDEX_RECORD.pack(record['id'], digest)
+
+        def current_ids(packed):
+            for item in packed:
+                if index_file is not None:
+                    index_file.write(item)
+                yield INDEX_RECORD.unpack(item)[0]
+
+        try:
+            ids = current_ids(sort_packed(compared(), self.memory_bytes))
+            for deleted_id in sorted_difference(iter(previous), ids):
+                counts['deleted'] += 1
+                if write:
+                    writers['deleted'].write(deleted_id)
+            for _ in ids:  # the new ids past the last previous one still go in the index
+                pass
+        except Exception:
+            if index_file is not None:
+                index_file.close()
+                os.remove(temp_path)
+                index_file = None
+            raise
+        finally:
+            previous.close()
+            for writer in writers.values():
+                writer.close()
+
+        if index_file is not None:
+            index_file.close()
+            os.rename(temp_path, self.index_path)
+        if self.output is not None and write:
+            for kind, writer in sorted(writers.items()):
+                self.output.add_file(
+                    writer.path, '%s_changes' % self.name, kind, writer.count, writer.size,
+                    writer.sha256.hexdigest(),
+                )
+
+        logging.info(
+            'Snapshot %s diff: %s added, %s changed, %s deleted, %s unchanged',
+            self.name, counts['added'], counts['changed'], counts['deleted'], counts['unchanged']
+        )
+        counts['path'] = change_dir
+        return counts
+
+
+# bytes a buffered index record costs in memory (24 bytes of data + the bytes object)
+PACKED_RECORD_BYTES = 64
+
+
+def sort_packed(items, memory_bytes=64 * 1024 * 1024, temp_dir=None):
+    """
+    Sort INDEX_RECORD bytes by id holding at most memory_bytes of them, full
+    buffers are spilled as sorted runs to temp files and merged with heapq.
+    A repeated id is kept once.
+    :param items: iterable of INDEX_RECORD bytes
+    :param memory_bytes: int, optional
+    :param temp_dir: string, optional, where runs go (default the system temp folder)
+    :return: generator of INDEX_RECORD bytes, ordered by id
+    """
+    per_run = max(memory_bytes // PACKED_RECORD_BYTES, 1)
+    run_dir = None
+    run_paths = []
+    buffered = []
+    try:
+        for item in items:
+            buffered.append(item)
+            if len(buffered) >= per_run:
+                if run_dir is None:
+                    run_dir = tempfile.mkdtemp(dir=temp_dir, prefix='snapshot-')
+                buffered.sort()
+                run_paths.append(os.path.join(run_dir, 'run_%05d' % len(run_paths)))
+                with open(run_paths[-1], 'wb') as run_file:
+                    run_file.write(b''.join(buffered))
+                buffered = []
+        buffered.sort()
+        last_id = None
+        for item in heapq.merge(*([read_packed(path) for path in run_paths] + [iter(buffered)])):
+            if item[:8] != last_id:  # the big endian id
+                last_id = item[:8]
+                yield item
+    finally:
+        if run_dir is not None:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def read_packed(path):
+    """
+    :param path: string, a file of INDEX_RECORD bytes
+    :return: generator of INDEX_RECORD bytes
+    """
+    size = INDEX_RECORD.size
+    with open(path, 'rb') as run_file:
+        while True:
+            chunk = run_file.read(size * 4096)
+            if not chunk:
+                return
+            for start in range(0, len(chunk), size):
+                yield chunk[start:start + size]
+
+
+def sorted_difference(previous, current_ids):
+    """
+    Ids in the previous index but not the current one, merge walk of two sorted streams
+    :param previous: iterator of (id, digest) sorted by id
+    :param current_ids: iterator of ids sorted by id
+    :return: generator of ids
+    """
+    current_id = next(current_ids, None)
+    for previous_id, _ in previous:
+        while current_id is not None and current_id < previous_id:
+            current_id = next(current_ids, None)
+        if current_id != previous_id:
+            yield previous_id
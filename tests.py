@@ -4,16 +4,68 @@
 """Testing"""
 
 from __future__ import print_function
+import gzip
+import json
 import logging
+import multiprocessing
 import os
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import shutil
+import sys
+import tempfile
+import threading
 import unittest
 import uuid
-from util import ping_shop, strip_new_line, strip_multi_whitespace, write_json
+try:
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from urllib.parse import urlparse, parse_qs
+from util import ping_shop, strip_html, strip_new_line, strip_multi_whitespace, write_json
+import requests
 from shopify import Shopify
+from shopify_creds import ShopifyCreds
+from bulk import BulkWriter
+from cassette import Cassette, CassetteError
+from distributed import Worker, finish, plan
+from external_sort import ExternalSort, sort_files
+from jobs import audit
+from jobs.audit import AuditCatalog
+from jobs.changes import DiffSnapshots
+from jobs.collections import ExtractCollectionData
+from jobs.images import MirrorImages
+from jobs.inventory import ExtractInventory
+from jobs.joins import JoinProductCollections
+from jobs.metafields import ExtractMetafields
+from jobs.orders import ExtractOrders, to_timestamp
+from jobs.products import ExtractProducts
+from jobs.rules import EvaluateSmartCollections
+from jobs.search import IndexProducts
+from ndjson import NdjsonReader
+import run
+from run import downstream_results, parse_job_options, resolve_jobs
+from logs import DroppingQueueHandler, PayloadHandler, RateLimitFilter, init_worker, setup_logging
+from output import RunOutput, load_manifest
+from page_size import PageSizeController
+from planner import History, Planner
+import profiling
+from profiling import Profiler
+import search_index
+from search_index import SearchIndex
+from snapshot import SnapshotDiff, iter_json_records
+from transform import clean_body_html, clean_strings, partition_names, source_files, transform_pages
+from webhooks import WebhookReceiver, sign_payload
+from work_queue import SqliteQueue
 
 # set logging level
 logging.basicConfig(level=logging.DEBUG)
 
+# recorded responses, SHOPIFY_CASSETTE_MODE=record runs the tests against the live store
+cassette_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cassettes')
+cassette_mode = os.environ.get('SHOPIFY_CASSETTE_MODE', 'replay')
+
 # ----------
 # Fixtures |
 # ----------
@@ -64,19 +116,283 @@ prepare_call_tests = [
 ]
 
 
+def log_from_worker(message):
+    """
+    Logs from a process pool worker
+    :param message: string
+    :return: void
+    """
+    logging.error(message)
+
+
+class FakeBusyProfile(object):
+
+    """cProfile.Profile while another profiler is active (Python 3.12+)"""
+
+    def enable(self):
+        raise ValueError('Another profiling tool is already active')
+
+
+class FakeResponse(object):
+
+    """Just enough of requests.Response"""
+
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.content = json.dumps(body or {}).encode('utf-8')
+        self.text = self.content.decode('utf-8')
+        self.headers = headers or {}
+
+
+class FakeCatalogShopify(Shopify):
+
+    """Shopify answering count, page and since_id calls from an in-memory catalog"""
+
+    def __init__(self, catalog):
+        super(FakeCatalogShopify, self).__init__(None)
+        self.catalog = catalog  # {resource: [records]}
+        self.calls = []
+
+    def shopify_request(self, method, call, params=None, data=None, headers=None, timeout=None):
+        self.calls.append(call)
+        url = urlparse(call)
+        parts = url.path.replace('.json', '').split('/')
+        if parts[-1] == 'count':
+            return FakeResponse(200, dict(count=len(self.catalog[parts[-2]])))
+        resource = parts[-1]
+        query = parse_qs(url.query)
+        since_id = int(query.get('since_id', ['0'])[0])
+        limit = int(query.get('limit', ['50'])[0])
+        offset = (int(query.get('page', ['1'])[0]) - 1) * limit
+        page = [item for item in sorted(self.catalog[resource], key=lambda x: x['id'])
+                if item['id'] > since_id][offset:offset + limit]
+        if 'fields' in query:
+            page = [dict(id=item['id']) for item in page]
+        return FakeResponse(200, {resource: page})
+
+
+class FakeCatalogProducts(FakeCatalogShopify, ExtractProducts):
+
+    """ExtractProducts over an in-memory catalog"""
+
+    sleep_interval = 0
+
+
+class FakeDuplicateProducts(FakeCatalogProducts):
+
+    """Counts distinct ids while a product shows up twice in the pages"""
+
+    def shopify_request(self, method, call, params=None, data=None, headers=None, timeout=None):
+        if urlparse(call).path.endswith('count.json'):
+            return FakeResponse(200, dict(
+                count=len(set(item['id'] for item in self.catalog['products']))
+            ))
+        return super(FakeDuplicateProducts, self).shopify_request(
+            method, call, params, data, headers, timeout
+        )
+
+
+class UnpicklableResult(Shopify):
+
+    """A job whose result can not cross a process boundary"""
+
+    def make(self, write=True):
+        return threading.Lock()
+
+
+class TimeoutCatalogProducts(FakeCatalogProducts):
+
+    """Every page call times out"""
+
+    def shopify_request(self, method, call, params=None, data=None, headers=None, timeout=None):
+        if 'count' not in call:
+            self.calls.append(call)
+            raise requests.exceptions.Timeout('read timed out')
+        return super(TimeoutCatalogProducts, self).shopify_request(
+            method, call, params, data, headers, timeout
+        )
+
+
+class FlakyCatalogShopify(FakeCatalogShopify):
+
+    """Answers 500 to the first call of each listed page"""
+
+    def __init__(self, catalog, flaky_pages):
+        super(FlakyCatalogShopify, self).__init__(catalog)
+        self.flaky_pages = set(flaky_pages)
+
+    def shopify_request(self, method, call, params=None, data=None, headers=None, timeout=None):
+        page = parse_qs(urlparse(call).query).get('page', [None])[0]
+        if page in self.flaky_pages:
+            self.flaky_pages.discard(page)
+            self.calls.append(call)
+            return FakeResponse(500)
+        return super(FlakyCatalogShopify, self).shopify_request(
+            method, call, params, data, headers, timeout
+        )
+
+
+class FakeMetafields(ExtractMetafields):
+
+    """GraphQL metafields from a dict {product id: [(namespace, key, value, type)]}"""
+
+    def __init__(self, metafields):
+        super(FakeMetafields, self).__init__(None)
+        self.metafields = metafields
+        self.calls = []
+
+    def connection(self, owner_id, first, after=None):
+        start = int(after or 0)
+        edges = [
+            dict(node=dict(namespace=namespace, key=key, value=value, type=value_type))
+            for namespace, key, value, value_type in self.metafields.get(owner_id, [])
+        ]
+        return dict(
+            pageInfo=dict(hasNextPage=start + first < len(edges), endCursor=str(start + first)),
+            edges=edges[start:start + first],
+        )
+
+    def shopify_request(self, method, call, params=None, data=None, headers=None, timeout=None,
+                        cost=1):
+        if self.read_only and not self.is_graphql_query(data):
+            return None
+        body = json.loads(data)
+        self.calls.append(body['variables'])
+        variables = body['variables']
+        extensions = dict(cost=dict(requestedQueryCost=42, throttleStatus=dict(
+            maximumAvailable=1000.0, currentlyAvailable=900, restoreRate=50.0
+        )))
+        if 'ids' in variables:
+            nodes = [
+                dict(id=gid, metafields=self.connection(int(gid.split('/')[-1]), variables['first']))
+                if int(gid.split('/')[-1]) in self.metafields else None
+                for gid in variables['ids']
+            ]
+            return FakeResponse(200, dict(data=dict(nodes=nodes), extensions=extensions))
+        node = dict(id=variables['id'], metafields=self.connection(
+            int(variables['id'].split('/')[-1]), variables['first'], variables['after']
+        ))
+        return FakeResponse(200, dict(data=dict(node=node), extensions=extensions))
+
+
+class FakeCatalogSession(object):
+
+    """The network side of FakeCatalogShopify, for recording cassettes"""
+
+    def __init__(self, catalog):
+        self.shop = FakeCatalogShopify(catalog)
+
+    def request(self, method, url, params=None, data=None, headers=None, timeout=None,
+                stream=False):
+        return self.shop.shopify_request(method, url.split('.myshopify.com/')[1], params)
+
+
+class FakeImageSession(object):
+
+    """Image CDN from a dict {url: bytes}, answers 304 to a matching If-None-Match"""
+
+    def __init__(self, images):
+        self.images = images
+        self.calls = []
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        self.calls.append((url, dict(headers or {})))
+        etag = '"%s"' % len(self.images[url])
+        if (headers or {}).get('If-None-Match') == etag:
+            return FakeImageResponse(304, b'', {})
+        return FakeImageResponse(200, self.images[url], {'ETag': etag})
+
+
+class FakeImageResponse(FakeResponse):
+
+    """Streamed response"""
+
+    def __init__(self, status_code, content, headers):
+        super(FakeImageResponse, self).__init__(status_code, headers=headers)
+        self.content = content
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeWriteShopify(Shopify):
+
+    """Shopify answering writes from a script of status codes per call"""
+
+    def __init__(self, script):
+        super(FakeWriteShopify, self).__init__(None)
+        self.script = script  # {call: [status, ...]} last status repeats
+        self.sent = []
+
+    def shopify_request(self, method, call, params=None, data=None, headers=None):
+        self.sent.append((call, data))
+        statuses = self.script[call]
+        status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+        return FakeResponse(status, json.loads(data))  # echo, the id is in the data
+
+
+class FakeInventory(ExtractInventory):
+
+    """Two locations per inventory item, answered from the call's query"""
+
+    def __init__(self):
+        super(FakeInventory, self).__init__(None)
+        self.calls = []
+
+    def shopify_get(self, call, params=None):
+        self.calls.append(call)
+        query = parse_qs(urlparse(call).query)
+        levels = [
+            dict(inventory_item_id=int(item_id), location_id=location_id, available=location_id)
+            for item_id in query['inventory_item_ids'][0].split(',') for location_id in (1, 2)
+        ]
+        page, limit = int(query['page'][0]), int(query['limit'][0])
+        return dict(inventory_levels=levels[(page - 1) * limit:page * limit])
+
+
+class FakeOrders(ExtractOrders):
+
+    """Orders created every hour, answered from the call's created_at window"""
+
+    def __init__(self, orders):
+        super(FakeOrders, self).__init__(None)
+        self.orders = orders
+
+    def shopify_get(self, call, params=None):
+        url = urlparse(call)
+        query = parse_qs(url.query)
+        start = to_timestamp(query['created_at_min'][0])
+        end = to_timestamp(query['created_at_max'][0])
+        window = [order for order in self.orders if start <= order['created'] <= end]
+        if url.path.endswith('count.json'):
+            return dict(count=len(window))
+        since_id = int(query['since_id'][0])
+        return dict(orders=[order for order in window if order['id'] > since_id][
+            :int(query['limit'][0])])
+
+
 class TestUtil(unittest.TestCase):
 
     """util tests"""
 
     def test_ping_shop(self):
         """
-        Test the ping_shop call
+        Test the ping_shop call. The replayed cassette is a SYNTHETIC fixture, written
+        by hand rather than recorded (a 200 for the store, a connection error for the
+        unknown one): offline this checks how ping_shop() reads those answers, not how
+        Shopify answers. SHOPIFY_CASSETTE_MODE=record runs the live check and replaces
+        the fixture with a recording.
         :return:
         """
-        for test in util_ping_shop_tests_true:
-            self.assertTrue(ping_shop(test[0], test[1]))
-        for test in util_ping_shop_tests_false:
-            self.assertFalse(ping_shop(test[0], test[1]))
+        with Cassette(os.path.join(cassette_dir, 'ping_shop.json.gz'), cassette_mode) as session:
+            for test in util_ping_shop_tests_true:
+                self.assertTrue(ping_shop(test[0], test[1], session))
+            for test in util_ping_shop_tests_false:
+                self.assertFalse(ping_shop(test[0], test[1], session))
 
     def test_strip_new_line(self):
         """
@@ -100,6 +416,50 @@ class TestUtil(unittest.TestCase):
                 count,
             )
 
+    def test_transform_pages(self):
+        """
+        Page files are transformed in a process pool into run partitions
+        :return:
+        """
+        self.assertEqual(strip_html('<p>Soft&nbsp;<b>cotton</b>\n  tee</p>'), 'Soft cotton tee')
+        base_dir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for page in range(1, 4):
+                path = os.path.join(base_dir, 'products_page_%s.json' % page)
+                with open(path, 'w') as page_file:
+                    json.dump([dict(id=page * 10 + i, body_html='<p>%s</p>' % i) for i in range(5)],
+                              page_file)
+                paths.append(path)
+            output = RunOutput('transformed', base_dir)
+            summaries = list(transform_pages(paths, clean_body_html, output, 'products', 2))
+            self.assertEqual(sum(summary['records_out'] for summary in summaries), 15)
+            self.assertEqual(len(output.entries), 3)
+            with open(output.path('products', 'products_page_2')) as page_file:
+                self.assertEqual(json.load(page_file)[1]['body_text'], '1')
+
+            # a chunked run lists pages and 'all', the pages are read (a task each)
+            run = RunOutput('run-1', base_dir)
+            run.write('products', [dict(id=1)], run.page_partition(1))
+            run.write('products', [dict(id=2)], run.page_partition(2))
+            run.write('products', [dict(id=1), dict(id=2)])
+            run.write_manifest(jobs={})
+            self.assertEqual(source_files(run.run_dir, 'products'), [
+                run.path('products', 'page_00001'), run.path('products', 'page_00002')
+            ])
+            empty = RunOutput('run-2', base_dir)  # not chunked, only 'all'
+            empty.write('products', [dict(id=3)])
+            empty.write_manifest(jobs={})
+            self.assertEqual(source_files(empty.run_dir, 'products'), [empty.path('products', 'all')])
+            self.assertEqual(clean_strings(dict(title=u'caf\xe9\n  tee'))['title'], u'caf\xe9 tee')
+            names = partition_names([run.path('products', 'page_00001'), paths[0],
+                                     RunOutput('run-3', base_dir).path('products', 'page_00001')])
+            self.assertEqual(names[1], 'products_page_1')
+            self.assertTrue(names[0].startswith('page_00001_'))
+            self.assertEqual(len(set(names)), 3)
+        finally:
+            shutil.rmtree(base_dir)
+
     def test_basic_shopify_methods(self):
         """
         Non-connection tests
@@ -118,6 +478,793 @@ class TestUtil(unittest.TestCase):
                 count,
             )
 
+    def test_reconcile(self):
+        """
+        Reconcile re-fetches only the gaps, drops duplicates and deleted records
+        :return:
+        """
+        catalog = [dict(id=i, title='p%s' % i) for i in range(1, 101)]
+        s = FakeCatalogShopify(dict(products=catalog))
+        # 10-19 and 50 missed, 5 duplicated, 1000 deleted mid-run
+        pulled = [item for item in catalog if not 10 <= item['id'] < 20 and item['id'] != 50]
+        pulled += [dict(id=5, title='p5'), dict(id=1000, title='gone')]
+        self.assertTrue(s.has_duplicates(pulled))
+
+        reconciled = s.reconcile('products', pulled)
+        self.assertEqual([item['id'] for item in reconciled], list(range(1, 101)))
+        # 1 id probe + 2 range calls
+        self.assertEqual(len(s.calls), 3)
+        self.assertFalse(s.errors)
+
+    def test_run_job_graph(self):
+        """
+        run.py resolves upstream jobs in order and parses per job options
+        :return:
+        """
+        names = resolve_jobs(['product_collections', 'smart_collections'])
+        self.assertEqual(names, ['products', 'collects', 'product_collections', 'smart_collections'])
+        options = parse_job_options(['all.chunk=true', 'products.limit=50'], names)
+        self.assertEqual(options['products'], dict(chunk=True, limit=50))
+        self.assertEqual(options['collects'], dict(chunk=True))
+        self.assertRaises(ValueError, resolve_jobs, ['not_a_job'])
+        self.assertRaises(ValueError, parse_job_options, ['orders.limit=5'], names)
+        # less_memory results are not the records, downstream jobs must not see them as a catalog
+        self.assertIsNone(downstream_results([], dict(less_memory=True)))
+        self.assertEqual(downstream_results([dict(id=1)], options['products']), [dict(id=1)])
+        self.assertIsNone(DiffSnapshots(None).diff_products(None))
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'Python 2 pools have no error_callback')
+    def test_run_jobs_processes(self):
+        """
+        A job failing outside execute_job() in a process pool is reported, not waited on forever
+        :return:
+        """
+        run.JOBS['unpicklable'] = dict(cls=UnpicklableResult, method='make', requires=[])
+        try:
+            report = run.run_jobs(['unpicklable'], workers=1, processes=True, write=False)
+        finally:
+            del run.JOBS['unpicklable']
+        self.assertEqual(report['unpicklable']['status'], 'failed')
+        self.assertIn('unpicklable raised', report['unpicklable']['errors'][0])
+
+    def test_join_product_collections(self):
+        """
+        Join products to collection ids via collects
+        :return:
+        """
+        join = JoinProductCollections(None)
+        results = join.join_product_collections(
+            [dict(id=1), dict(id=2)],
+            [dict(product_id=1, collection_id=9), dict(product_id=1, collection_id=3)],
+            write=False,
+        )
+        self.assertEqual(results, [
+            dict(product_id=1, collection_ids=[3, 9]),
+            dict(product_id=2, collection_ids=[]),
+        ])
+
+    @unittest.skipIf(audit.numpy is None, 'numpy is not installed')
+    def test_audit_catalog(self):
+        """
+        Flags, outliers and collection rollups from variant arrays
+        :return:
+        """
+        products = [
+            dict(id=1, variants=[
+                dict(id=11, price='10.00', compare_at_price='12.00', grams=100, inventory_quantity=5),
+                dict(id=12, price='0.00', compare_at_price=None, grams=100, inventory_quantity=2),
+            ]),
+            dict(id=2, variants=[
+                dict(id=21, price='11.00', compare_at_price='9.00', grams=120, inventory_quantity=-1),
+                dict(id=22, price='12.00', compare_at_price='', grams=110, inventory_quantity=3),
+                dict(id=23, price='990.00', compare_at_price=None, grams=90, inventory_quantity=1),
+            ]),
+        ]
+        job = AuditCatalog(None)
+        job.chunk_size = 2  # several chunks
+        results = job.audit_catalog(products, [
+            dict(product_id=1, collection_ids=[7]),
+            dict(product_id=2, collection_ids=[7, 8]),
+        ], write=False)
+        self.assertEqual((results['products'], results['variants']), (2, 5))
+        self.assertEqual(results['flags']['zero_price']['variant_ids'], [12])
+        self.assertEqual(results['flags']['price_above_compare_at']['variant_ids'], [21])
+        self.assertEqual(results['flags']['negative_inventory']['variant_ids'], [21])
+        self.assertEqual(results['flags']['price_outlier']['variant_ids'], [23])
+        self.assertEqual(results['distributions']['compare_at_price']['missing'], 3)
+        self.assertEqual(results['distributions']['price']['max'], 990.0)
+        self.assertEqual(results['collections'][0], dict(
+            collection_id=7, products=2, variants=5, zero_price=1, price_min=0.0, price_max=990.0,
+            price_mean=204.6, inventory=10, inventory_value=1065.0,
+        ))
+        self.assertEqual(results['collections'][1]['variants'], 3)
+
+    def test_snapshot_diff(self):
+        """
+        Second diff reports only what changed since the first
+        :return:
+        """
+        base_dir = tempfile.mkdtemp()
+        try:
+            first = [dict(id=i, title='p%s' % i) for i in (3, 1, 2)]
+            counts = SnapshotDiff('products', base_dir).diff(first)
+            self.assertEqual((counts['added'], counts['changed'], counts['deleted']), (3, 0, 0))
+
+            second = [dict(id=1, title='p1'), dict(id=2, title='new'), dict(id=4, title='p4')]
+            counts = SnapshotDiff('products', base_dir).diff(second)
+            self.assertEqual((counts['added'], counts['changed'], counts['deleted']), (1, 1, 1))
+            with open(os.path.join(counts['path'], 'changed.json')) as changed:
+                self.assertEqual(json.load(changed), [dict(id=2, title='new')])
+            with open(os.path.join(counts['path'], 'deleted.json')) as deleted:
+                self.assertEqual(json.load(deleted), [3])
+
+            # spilled sorted runs, change sets in the run manifest
+            third = [dict(id=i, title='p%s' % i) for i in range(200, 0, -1) if i != 4]
+            output = RunOutput('run-1', base_dir)
+            diff = SnapshotDiff('products', base_dir, output=output, memory_bytes=640)
+            counts = diff.diff(iter(third))
+            self.assertEqual(
+                (counts['added'], counts['changed'], counts['unchanged'], counts['deleted']),
+                (197, 1, 1, 1)
+            )
+            self.assertEqual(sorted((entry['path'], entry['records']) for entry in output.entries), [
+                ('products_changes/added.json', 197), ('products_changes/changed.json', 1),
+                ('products_changes/deleted.json', 1),
+            ])
+            with open(output.path('products_changes', 'deleted')) as deleted:
+                self.assertEqual(json.load(deleted), [4])
+            counts = SnapshotDiff('products', base_dir).diff(third, write=False)
+            self.assertEqual((counts['unchanged'], counts['deleted']), (200 - 1, 0))
+        finally:
+            shutil.rmtree(base_dir)
+
+    def test_run_output(self):
+        """
+        Partitioned run output writes atomically and lists every file in the manifest
+        :return:
+        """
+        base_dir = tempfile.mkdtemp()
+        try:
+            output = RunOutput('run-1', base_dir)
+            page = output.write('products', [dict(id=1), dict(id=2)], output.page_partition(1))
+            self.assertTrue(page.endswith('run-1/products/page_00001.json'))
+            # a second writer of the same run, e.g. another process
+            other = RunOutput('run-1', base_dir)
+            other.write('collects', [dict(id=3)])
+            output.add_entries(other.entries)
+            output.write_manifest(jobs={})
+
+            manifest = load_manifest(output.run_dir)
+            self.assertEqual(
+                [(entry['path'], entry['records']) for entry in manifest['files']],
+                [('collects/all.json', 1), ('products/page_00001.json', 2)],
+            )
+            self.assertEqual(
+                [name for name in os.listdir(os.path.dirname(page)) if name.startswith('.tmp')], []
+            )
+        finally:
+            shutil.rmtree(base_dir)
+
+    def test_ndjson_index(self):
+        """
+        Indexed ndjson partitions are read one record at a time
+        :return:
+        """
+        base_dir = tempfile.mkdtemp()
+        try:
+            output = RunOutput('run-1', base_dir, ndjson=True)
+            records = [dict(id=i, title=u'caf\xe9 %s' % i) for i in (5, 3, 9, 1)]
+            path = output.write('products', records)
+            self.assertTrue(path.endswith('products/all.ndjson'))
+            self.assertEqual(output.entries[0]['index'], 'products/all.idx')
+            output.write('catalog_audit', dict(variants=4))  # not a record list, stays json
+            self.assertEqual(output.entries[1]['format'], 'json')
+
+            with NdjsonReader(path) as reader:
+                self.assertEqual(len(reader), 4)
+                self.assertEqual(reader.get(9), dict(id=9, title=u'caf\xe9 9'))
+                self.assertIsNone(reader.get(4))
+                self.assertEqual(list(reader.ids()), [1, 3, 5, 9])
+            self.assertEqual([record['id'] for record in iter_json_records([path])], [5, 3, 9, 1])
+
+            # a repeated id is indexed at its last copy
+            path = output.write('products', records + [dict(id=3, title='newer')], 'page_00002')
+            with NdjsonReader(path) as reader:
+                self.assertEqual(len(reader), 4)
+                self.assertEqual(reader.get(3), dict(id=3, title='newer'))
+                self.assertEqual(list(reader.ids()), [1, 3, 5, 9])
+        finally:
+            shutil.rmtree(base_dir)
+
+    def test_external_sort(self):
+        """
+        Spilled runs merge (in passes past max_fan_in) into id order, the last copy wins
+        :return:
+        """
+        base_dir = tempfile.mkdtemp()
+        try:
+            records = [dict(id=(i * 37) % 101, copy=1) for i in range(101)]
+            records += [dict(id=i, copy=2) for i in (5, 50, 100)]
+            sorter = ExternalSort(memory_bytes=200, temp_dir=base_dir)
+            sorter.max_fan_in = 4
+            results = list(sorter.sort(iter(records)))
+            self.assertEqual([record['id'] for record in results], list(range(101)))
+            self.assertEqual(
+                [record['id'] for record in results if record['copy'] == 2], [5, 50, 100]
+            )
+            self.assertEqual((sorter.records_in, sorter.duplicates), (104, 3))
+            self.assertGreater(sorter.runs, 4)
+            self.assertEqual(os.listdir(base_dir), [])  # runs cleaned up
+
+            pages = []
+            for page in range(4):
+                pages.append(os.path.join(base_dir, 'page_%s.json' % page))
+                with open(pages[-1], 'w') as page_file:
+                    json.dump(records[page * 26:page * 26 + 26], page_file)
+            target = os.path.join(base_dir, 'out', 'all.json')
+            stats = sort_files(pages, target, memory_bytes=500)
+            self.assertEqual((stats['records'], stats['duplicates']), (101, 3))
+            with open(target) as target_file:
+                self.assertEqual(target_file.read(), json.dumps(results))
+
+            stats = sort_files(pages, os.path.join(base_dir, 'out', 'all.ndjson'), ndjson=True)
+            with NdjsonReader(os.path.join(base_dir, 'out', 'all.ndjson')) as reader:
+                self.assertEqual(list(reader.ids()), list(range(101)))
+                self.assertEqual(reader.get(50), dict(id=50, copy=2))
+
+            # a product repeated across pages, merged into one id ordered products_all
+            job = FakeDuplicateProducts(dict(products=[dict(id=i) for i in range(1, 46)] + [
+                dict(id=20, title='moved')
+            ]))
+            job.output = RunOutput('run-1', base_dir)
+            job.chunk = job.less_memory = job.sort_pages = True
+            job.sort_memory_bytes = 300
+            job.extract_product()
+            self.assertEqual(job.errors, [])
+            merged = job.output.entries[-1]
+            self.assertEqual((merged['partition'], merged['records']), ('all', 45))
+            products = list(iter_json_records([os.path.join(job.output.run_dir, merged['path'])]))
+            self.assertEqual([product['id'] for product in products], list(range(1, 46)))
+            self.assertEqual(products[19], dict(id=20, title='moved'))
+        finally:
+            shutil.rmtree(base_dir)
+
+    def test_extract_metafields(self):
+        """
+        Metafields come back batched, long owners are paged, the rest is one call per batch
+        :return:
+        """
+        metafields = dict((i, [('custom', 'k%s' % n, 'v', 'single_line_text_field') for n in range(2)])
+                          for i in range(1, 24))
+        metafields[7] = [('custom', 'k%s' % n, 'v', 'integer') for n in range(5)]
+        job = FakeMetafields(metafields)
+        job.metafields_per_owner = 2
+        results = job.extract_product_metafields([dict(id=i) for i in range(1, 26)], write=False)
+        self.assertEqual(len(results), 22 * 2 + 5)
+        self.assertEqual(results[0], [1, 'custom', 'k0', 'v', 'single_line_text_field'])
+        # 3 batches of 10 + 2 more pages for product 7
+        self.assertEqual(len(job.calls), 3 + 2)
+        self.assertEqual(job.batch_cost, 42)
+        self.assertEqual(job.graphql_budget.capacity, 1000)
+        # read only objects may send GraphQL queries, never mutations
+        self.assertTrue(Shopify.is_graphql_query(json.dumps(dict(query='query ($id: ID!) {}'))))
+        self.assertFalse(Shopify.is_graphql_query(json.dumps(dict(query='mutation { x }'))))
+
+    def test_cassette(self):
+        """
+        A recorded extraction replays offline, same results, no network
+        :return:
+        """
+        creds = ShopifyCreds(dict(
+            SHOPIFY_KEY='key', SHOPIFY_PASSWORD='secret', SHOPIFY_STORE='unit-testing-store',
+            SHOPIFY_BASE_URL='unit-testing-store.myshopify.com',
+        ))
+        catalog = [dict(id=i, title='p%s' % i) for i in range(1, 46)]
+        cassette_path = os.path.join(tempfile.mkdtemp(), 'products.json.gz')
+        try:
+            job = ExtractProducts(creds)
+            job.sleep_interval = 0
+            network = FakeCatalogSession(dict(products=catalog))
+            with Cassette(cassette_path, 'record', session=network) as job.cassette:
+                recorded = job.extract_product(write=False)
+            self.assertEqual(len(network.shop.calls), 1 + 4)
+
+            job = ExtractProducts(creds)
+            job.sleep_interval = 0
+            job.cassette = Cassette(cassette_path, latency=1.0)
+            self.assertEqual(job.extract_product(write=False), recorded)
+            self.assertIsNone(job.session)
+            with gzip.open(cassette_path, 'rb') as cassette_file:
+                self.assertNotIn(b'secret', cassette_file.read())  # credentials never recorded
+            self.assertRaises(CassetteError, job.shopify_get, 'admin/orders.json')
+        finally:
+            shutil.rmtree(os.path.dirname(cassette_path))
+
+    def test_evaluate_smart_collections(self):
+        """
+        Smart collection rules resolve against the local catalog, and/or, any variant
+        :return:
+        """
+        def product(product_id, title, vendor, tags, *variants):
+            return dict(id=product_id, title=title, vendor=vendor, product_type='Shirt',
+                        tags=tags, variants=[
+                            dict(title=v_title, price=price, compare_at_price=compare_at)
+                            for v_title, price, compare_at in variants
+                        ])
+        products = [
+            product(1, 'Red Tee', 'Acme', 'summer, Sale', ('S', '10.00', '15.00')),
+            product(2, 'Blue Tee', 'ACME', 'winter', ('S', '20.00', None), ('L', '30.00', None)),
+            product(3, 'Red Hoodie', 'Other', '', ('M', '50.00', None)),
+        ]
+        rule = lambda column, relation, condition: dict(
+            column=column, relation=relation, condition=condition
+        )
+        collections = [
+            dict(id=100, disjunctive=False, rules=[rule('vendor', 'equals', 'acme'),
+                                                   rule('variant_price', 'greater_than', '25')]),
+            dict(id=101, disjunctive=True, rules=[rule('tag', 'equals', 'sale'),
+                                                  rule('title', 'ends_with', 'hoodie')]),
+            dict(id=102, disjunctive=False, rules=[rule('title', 'starts_with', 'red'),
+                                                   rule('tag', 'not_equals', 'summer')]),
+            dict(id=103, disjunctive=False, rules=[rule('is_price_reduced', 'is_set', '')]),
+            dict(id=104, disjunctive=False, rules=[rule('variant_title', 'not_equals', 's')]),
+            dict(id=105, disjunctive=False, rules=[
+                rule('vendor', 'equals', 'Acme'),
+                rule('product_metafield_definition', 'equals', 'x'),
+            ]),
+        ]
+        job = EvaluateSmartCollections()
+        results = job.evaluate_smart_collections(products, collections, write=False)
+        self.assertEqual([row['product_ids'] for row in results],
+                         [[2], [1, 3], [3], [1], [2, 3], None])
+        self.assertEqual(results[5]['unsupported_rules'], [collections[5]['rules'][1]])
+
+    def test_search_index(self):
+        """
+        Terms, fields, prefixes and exact SKUs, updates touch only what changed
+        :return:
+        """
+        products = [
+            dict(id=1, title='Red T-Shirt', handle='red-t-shirt', vendor='Acme', tags='summer, sale',
+                 variants=[dict(title='Small', sku='RTS-S', barcode='0001')]),
+            dict(id=2, title='Blue Shirt', handle='blue-shirt', vendor='Other', tags='summer',
+                 variants=[dict(title='Large', sku='BS-L', barcode=None)]),
+            dict(id=3, title='Red Hoodie', handle='red-hoodie', vendor='Acme', tags='winter',
+                 variants=[]),
+        ]
+        db_dir = tempfile.mkdtemp()
+        try:
+            with SearchIndex(os.path.join(db_dir, 'search.db')) as index:
+                self.assertEqual(index.update(products)['added'], 3)
+                ids = lambda results: [result['id'] for result in results]
+                self.assertEqual(ids(index.search('red')), [1, 3])
+                self.assertEqual(ids(index.search('vendor:acme t-shirt')), [1])
+                self.assertEqual(ids(index.search('tag:summ* shirt')), [1, 2])
+                self.assertEqual(ids(index.search('red large')), [])
+                self.assertEqual(index.lookup('sku', 'bs-l'), [
+                    dict(id=2, title='Blue Shirt', handle='blue-shirt')
+                ])
+                self.assertRaises(ValueError, index.search, 'color:red')
+
+                products[1] = dict(products[1], title='Blue Tee')
+                counts = index.update(products[1:])
+                self.assertEqual(
+                    (counts['added'], counts['changed'], counts['deleted'], counts['unchanged']),
+                    (0, 1, 1, 1)
+                )
+                self.assertEqual(ids(index.search('shirt')), [])
+                self.assertEqual(ids(index.search('tee')), [2])
+                self.assertEqual(len(index), 2)
+                self.assertRaises(ValueError, index.update, [])  # an empty run
+                self.assertEqual(len(index), 2)
+                index.update([products[1], dict(products[1], title='Blue Top')], full=False)
+                self.assertEqual(ids(index.search('top')), [2])  # repeated id, last copy wins
+
+            job = IndexProducts(None)
+            job.search_db = os.path.join(db_dir, 'search.db')
+            self.assertIsNone(job.index_products([]))  # e.g. a less_memory products run
+            self.assertEqual(len(job.errors), 1)
+            self.assertEqual(job.index_products(products[1:])['products'], 2)
+            empty = os.path.join(db_dir, 'products_all.json')
+            with open(empty, 'w') as empty_file:
+                empty_file.write('[]')
+            self.assertEqual(search_index.main(['index', empty, '--db', job.search_db]), 1)
+            with SearchIndex(job.search_db) as index:
+                self.assertEqual(len(index), 2)
+        finally:
+            shutil.rmtree(db_dir)
+
+    def test_planner(self):
+        """
+        A dry run counts, estimates from past runs and recommends bigger pages
+        :return:
+        """
+        runs_dir = tempfile.mkdtemp()
+        try:
+            output = RunOutput('run-1', runs_dir)
+            output.add_entries([dict(path='products/all.json', resource='products',
+                                     partition='all', records=500, bytes=1000000)])
+            output.write_manifest(jobs=dict(products=dict(
+                status='ok', records=500, seconds=30.0, profile=None,
+                page_sizes=dict(products=dict(pages=10, mean=50, seconds=8.5)),
+            )))
+            history = History(runs_dir)
+            self.assertEqual(history.bytes_per_record('products'), 2000.0)
+            self.assertAlmostEqual(history.page_seconds('products', 100, 0.25), 1.45)
+
+            shopify = FakeCatalogShopify(dict(
+                products=[dict(id=i) for i in range(1, 1001)], collects=[dict(id=1)],
+            ))
+            jobs = dict(products=ExtractProducts(None), collects=ExtractCollectionData(None),
+                        product_collections=JoinProductCollections(None))
+            plan = Planner(shopify, jobs, history).plan(
+                ['products', 'collects', 'product_collections']
+            )
+            self.assertEqual(plan['counts'], dict(products=1000, collects=1))
+            products = plan['jobs']['products']
+            self.assertEqual(products['calls'], 50 + 1 + 1)  # pages, the empty page, count
+            self.assertEqual(products['bytes'], 2000000)
+            self.assertTrue(products['history'])
+            self.assertEqual(plan['jobs']['product_collections']['calls'], 0)
+            self.assertEqual(plan['totals']['calls'], 52 + 3)
+            # 0.012s per record measured, 140 records is the biggest page under 2s
+            self.assertEqual(plan['recommend']['options']['products.limit'], 140)
+            self.assertEqual(plan['recommend']['options']['products.sleep_interval'], 0)
+        finally:
+            shutil.rmtree(runs_dir)
+
+    def test_mirror_images(self):
+        """
+        Shared images are stored once, unchanged images are not downloaded again
+        :return:
+        """
+        mirror_dir = tempfile.mkdtemp()
+        try:
+            images = {
+                'https://cdn.test/a.jpg?v=1': b'jpeg' * 50000,
+                'https://cdn.test/b.jpg?v=1': b'jpeg' * 50000,  # same file, other URL
+                'https://cdn.test/c.png': b'png',
+            }
+            products = [
+                dict(id=1, images=[dict(id=10, src='https://cdn.test/a.jpg?v=1'),
+                                   dict(id=11, src='https://cdn.test/c.png')]),
+                dict(id=2, images=[dict(id=20, src='https://cdn.test/b.jpg?v=1'),
+                                   dict(id=21, src='https://cdn.test/c.png')]),
+            ]
+            job = MirrorImages(None)
+            job.mirror_dir = mirror_dir
+            job.session = FakeImageSession(images)
+            results = job.mirror_images(products, write=False)
+            self.assertEqual([row[4] for row in results], ['downloaded'] * 3)
+            self.assertEqual(results[0][3], results[2][3])
+            objects = [name for _, _, names in os.walk(os.path.join(mirror_dir, 'objects'))
+                       for name in names]
+            self.assertEqual(len(objects), 2)
+
+            job = MirrorImages(None)
+            job.mirror_dir = mirror_dir
+            job.session = FakeImageSession(images)
+            results = job.mirror_images(products, write=False)
+            self.assertEqual([row[4] for row in results], ['not_modified'] * 3)
+            calls = dict(job.session.calls)  # workers finish in any order
+            self.assertEqual(calls['https://cdn.test/a.jpg?v=1']['If-None-Match'], '"200000"')
+        finally:
+            shutil.rmtree(mirror_dir)
+
+    def test_distributed_queue(self):
+        """
+        Planned page tasks are claimed and written, a failed page goes back on the queue
+        :return:
+        """
+        base_dir = tempfile.mkdtemp()
+        try:
+            queue = SqliteQueue(os.path.join(base_dir, 'queue.db'), retry_delay=0)
+            shopify = FlakyCatalogShopify(dict(products=[dict(id=i) for i in range(1, 26)]), ['2'])
+            self.assertEqual(plan(queue, 'run-1', ['products'], shopify, limit=10), dict(products=3))
+            plan(queue, 'run-1', ['products'], shopify, limit=10)  # planning twice is safe
+            self.assertEqual(queue.counts('run-1'), dict(pending=3))
+
+            worker = Worker(queue, 'run-1', shopify, worker_id='w1', base_dir=base_dir)
+            worker.poll_interval = 0.01
+            self.assertEqual(worker.run(), dict(done=3, retried=1, failed=0, lost=0))
+            self.assertEqual(finish(queue, 'run-1', base_dir), dict(done=3))
+            manifest = load_manifest(os.path.join(base_dir, 'run-1'))
+            self.assertEqual(
+                [(entry['path'], entry['records']) for entry in manifest['files']],
+                [('products/page_00001.json', 10), ('products/page_00002.json', 10),
+                 ('products/page_00003.json', 5)],
+            )
+
+            # a lease that runs out (worker died) is claimable again
+            queue.put('run-2', 'collects page 1', dict(kind='page'))
+            task = queue.claim('w1', 'run-2')
+            self.assertIsNone(queue.claim('w2', 'run-2'))
+            queue.lease_seconds = 0
+            queue.extend(task, 'w1')
+            self.assertEqual(queue.claim('w2', 'run-2')['attempts'], 2)
+            self.assertFalse(queue.complete(task, 'w1'))  # w1 lost it
+        finally:
+            shutil.rmtree(base_dir)
+
+    def test_webhook_receiver(self):
+        """
+        Signed webhooks are batched into the run layout, unsigned ones refused
+        :return:
+        """
+        base_dir = tempfile.mkdtemp()
+        receiver = WebhookReceiver(
+            'secret', output=RunOutput('webhooks', base_dir), port=0, batch_interval=30
+        )
+        receiver.start()
+        try:
+            url = 'http://127.0.0.1:%s/' % receiver.port
+            fixtures = [
+                ('products/create', 'w1', dict(id=1, title='first')),
+                ('products/update', 'w2', dict(id=1, title='second')),
+                ('products/update', 'w2', dict(id=1, title='second')),  # retry
+                ('collects/delete', 'w3', dict(id=7)),
+            ]
+            for topic, webhook_id, payload in fixtures:
+                body = json.dumps(payload).encode('utf-8')
+                res = requests.post(url, data=body, headers={
+                    'X-Shopify-Topic': topic,
+                    'X-Shopify-Webhook-Id': webhook_id,
+                    'X-Shopify-Hmac-Sha256': sign_payload(body, 'secret'),
+                })
+                self.assertEqual(res.status_code, 200)
+            res = requests.post(url, data=b'{}', headers={
+                'X-Shopify-Topic': 'products/update',
+                'X-Shopify-Hmac-Sha256': sign_payload(b'{}', 'wrong'),
+            })
+            self.assertEqual(res.status_code, 401)
+        finally:
+            receiver.stop()
+        try:
+            manifest = load_manifest(receiver.output.run_dir)
+            self.assertEqual(
+                [(entry['path'], entry['records']) for entry in manifest['files']],
+                [('collects/batch_00001_deleted.json', 1), ('products/batch_00001.json', 1)],
+            )
+            with open(receiver.output.path('products', 'batch_00001')) as batch:
+                self.assertEqual(json.load(batch), [dict(id=1, title='second')])
+
+            # a webhook refused on a full queue is accepted when Shopify retries it
+            full = WebhookReceiver('secret', output=receiver.output, queue_size=1)
+            body = b'{"id": 2}'
+            headers = {
+                'X-Shopify-Topic': 'products/update',
+                'X-Shopify-Webhook-Id': 'w4',
+                'X-Shopify-Hmac-Sha256': sign_payload(body, 'secret'),
+            }
+            other = dict(headers, **{'X-Shopify-Webhook-Id': 'w5'})
+            self.assertEqual(full.handle(other, body), 200)
+            self.assertEqual(full.handle(headers, body), 503)
+            full.queue.get_nowait()
+            self.assertEqual(full.handle(headers, body), 200)
+            self.assertEqual(full.queue.get_nowait(), ('products/update', dict(id=2)))
+
+            # collections land where the extract jobs write them
+            mapped = WebhookReceiver('secret', output=RunOutput('mapped', base_dir))
+            mapped.write_batch([
+                ('collections/create', dict(id=5, rules=[dict(column='tag')])),
+                ('collections/update', dict(id=6, title='custom')),
+                ('collections/delete', dict(id=7)),
+            ])
+            self.assertEqual(sorted(entry['path'] for entry in mapped.output.entries), [
+                'custom_collections/batch_00001.json', 'custom_collections/batch_00001_deleted.json',
+                'smart_collections/batch_00001.json', 'smart_collections/batch_00001_deleted.json',
+            ])
+            # a batch that fails to write is logged, the writer carries on
+            mapped.output = None
+            self.assertFalse(mapped.flush([('products/update', dict(id=8))]))
+            self.assertEqual(mapped.failed_batches, 1)
+        finally:
+            shutil.rmtree(base_dir)
+
+    def test_bulk_writer(self):
+        """
+        Transient failures are retried, results journaled and a rerun resumes
+        :return:
+        """
+        base_dir = tempfile.mkdtemp()
+        try:
+            journal = os.path.join(base_dir, 'journal.jsonl')
+            s = FakeWriteShopify({
+                'admin/variants/1.json': [503, 429, 200],
+                'admin/variants/2.json': [422],
+                'admin/variants/3.json': [200],
+            })
+            operations = [
+                dict(method='put', call='admin/variants/%s.json' % i, data=dict(variant=dict(id=i)))
+                for i in (1, 2, 3)
+            ]
+            writer = BulkWriter(s, journal, workers=2, backoff=0)
+            counts = writer.run(iter(operations))
+            self.assertEqual((counts['ok'], counts['failed'], counts['skipped']), (2, 1, 0))
+            counts = writer.run(operations)
+            self.assertEqual((counts['ok'], counts['failed'], counts['skipped']), (0, 1, 2))
+            with open(journal) as entries:
+                entries = [json.loads(line) for line in entries]
+            retried = [
+                entry for entry in entries if entry['key'] == BulkWriter.operation_key(operations[0])
+            ]
+            self.assertEqual([(entry['status'], entry['attempts']) for entry in retried], [('ok', 3)])
+            self.assertRaises(ValueError, BulkWriter, ExtractProducts(None), journal)
+
+            # creates on one endpoint are resumed one by one, not as a single key
+            s = FakeWriteShopify({'admin/products.json': [200, 422, 200]})
+            creates = [
+                dict(method='post', call='admin/products.json', data=dict(product=dict(id=i)))
+                for i in (1, 2, 3)
+            ]
+            writer = BulkWriter(s, os.path.join(base_dir, 'creates.jsonl'), workers=1, backoff=0)
+            counts = writer.run(creates)
+            self.assertEqual((counts['ok'], counts['failed'], counts['skipped']), (2, 1, 0))
+            counts = writer.run(creates)
+            self.assertEqual((counts['ok'], counts['failed'], counts['skipped']), (1, 0, 2))
+            self.assertEqual(s.sent[-1], ('admin/products.json', json.dumps(creates[1]['data'])))
+        finally:
+            shutil.rmtree(base_dir)
+
+    def test_extract_inventory_levels(self):
+        """
+        Inventory items are batched, batches paged and merged into one table
+        :return:
+        """
+        products = [
+            dict(id=p, variants=[dict(inventory_item_id=p * 10 + v) for v in range(3)])
+            for p in range(1, 41)
+        ]
+        job = FakeInventory()
+        job.limit = 60
+        rows = job.extract_inventory_levels(products, write=False)
+        self.assertEqual(len(rows), 40 * 3 * 2)
+        self.assertEqual(rows[:2], [[10, 1, 1], [10, 2, 2]])
+        # 120 items -> batches of 50, 50, 20 -> 100 levels each need 2 pages of 60
+        self.assertEqual(len(job.calls), 2 + 2 + 1)
+
+    def test_extract_orders(self):
+        """
+        Order windows split until they fit a shard and every order comes back once
+        :return:
+        """
+        start = to_timestamp('2020-01-01')
+        # a quiet month then a busy day
+        orders = [dict(id=i, created=start + i * 3600 * 24) for i in range(1, 31)]
+        orders += [dict(id=100 + i, created=start + 40 * 3600 * 24 + i * 60) for i in range(60)]
+        job = FakeOrders(orders)
+        job.created_at_min = '2020-01-01'
+        job.created_at_max = '2020-03-01'
+        job.shard_size = 20
+        job.limit = 7
+        shards = job.plan_shards(to_timestamp('2020-01-01'), to_timestamp('2020-03-01'))
+        self.assertTrue(all(count <= 20 for _, _, count in shards))
+        self.assertEqual(sum(count for _, _, count in shards), 90)
+        results = job.extract_orders(write=False)
+        self.assertEqual([order['id'] for order in results], sorted(order['id'] for order in orders))
+
+    def test_auto_limit(self):
+        """
+        Page sizes grow on cheap pages, shrink on slow/heavy/failed ones, within bounds
+        :return:
+        """
+        controller = PageSizeController(initial=20, target_seconds=2.0, max_bytes=1000000)
+        self.assertEqual(controller.observe(20, 0.1, 2000), 31)
+        self.assertEqual(controller.observe(31, 4.0, 3100), 15)  # twice the target time
+        self.assertEqual(controller.observe(15, 0.1, 900000), 15)  # heavy page, hold
+        self.assertEqual(controller.observe(0, 30, 0, error=True), 10)  # floor
+        for _ in range(20):
+            controller.observe(controller.limit, 0.1, controller.limit * 100)
+        self.assertEqual(controller.limit, 250)
+
+        catalog = [dict(id=i) for i in range(1, 1001)]
+        job = FakeCatalogProducts(dict(products=catalog))
+        job.auto_limit = True
+        results = job.extract_product(write=False)
+        self.assertEqual([item['id'] for item in results], list(range(1, 1001)))
+        # count + pages of 20, 31, 47, 71, 107, 161, 242, 250, 71 instead of 50 pages of 20
+        self.assertEqual(len(job.calls), 1 + 9)
+        self.assertEqual(job.page_size_summary()['products']['max'], 250)
+
+        # pages that keep timing out end the job with an error, not an exception
+        job = TimeoutCatalogProducts(dict(products=catalog))
+        job.auto_limit = True
+        self.assertIsNone(job.extract_product(write=False))
+        self.assertEqual(len(job.calls), 1 + 1 + job.page_retries)
+        self.assertIn('timed out', job.errors[0])
+
+    def test_logging(self):
+        """
+        Chatty call sites are rate limited, a full queue drops, payloads go to files
+        :return:
+        """
+        def record(level, line, payload=None):
+            item = logging.LogRecord('root', level, 'shopify.py', line, 'msg %s', (line,), None)
+            if payload is not None:
+                item.payload = payload
+                item.payload_size = 100
+            return item
+
+        limiter = RateLimitFilter(per_second=0.001, burst=3)
+        passed = [limiter.filter(record(logging.INFO, 1)) for _ in range(10)]
+        self.assertEqual(passed.count(True), 3)
+        self.assertTrue(limiter.filter(record(logging.INFO, 2)))  # other call site
+        self.assertTrue(limiter.filter(record(logging.ERROR, 1)))
+
+        handler = DroppingQueueHandler(queue.Queue(2))
+        for _ in range(5):
+            handler.handle(record(logging.INFO, 3))
+        self.assertEqual((handler.queue.qsize(), handler.dropped), (2, 3))
+        # a warning waits for room instead of being dropped
+        waiting = threading.Thread(target=handler.handle, args=(record(logging.WARNING, 5),))
+        waiting.start()
+        handler.queue.get()
+        waiting.join(5)
+        self.assertEqual((handler.queue.qsize(), handler.dropped), (2, 3))
+
+        base_dir = tempfile.mkdtemp()
+        root = logging.getLogger()
+        root_handlers, root_level = list(root.handlers), root.level
+        try:
+            PayloadHandler(base_dir, max_bytes=10).handle(record(logging.ERROR, 4, b'x' * 50))
+            dumps = os.listdir(base_dir)
+            self.assertEqual(len(dumps), 1)
+            with open(os.path.join(base_dir, dumps[0]), 'rb') as dump:
+                self.assertTrue(dump.read().endswith(b'x' * 10 + b'\n...[truncated, 100 bytes total]'))
+
+            # records of process pool workers reach the parent's log file
+            log_file = os.path.join(base_dir, 'run_log.txt')
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+            listener = setup_logging(log_file)
+            if listener is not None:
+                pool = multiprocessing.Pool(1, initializer=init_worker, initargs=(listener.queue,))
+                try:
+                    pool.apply(log_from_worker, ('worker error',))
+                finally:
+                    pool.close()
+                    pool.join()
+                listener.stop()
+                with open(log_file) as log:
+                    self.assertIn('ERROR MainThread worker error', log.read())
+        finally:
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+                handler.close()
+            for handler in root_handlers:
+                root.addHandler(handler)
+            root.setLevel(root_level)
+            shutil.rmtree(base_dir)
+
+    def test_profiler(self):
+        """
+        A profiled extraction writes pstats, text and a json phase breakdown
+        :return:
+        """
+        base_dir = tempfile.mkdtemp()
+        try:
+            job = FakeCatalogProducts(dict(products=[dict(id=i) for i in range(1, 51)]))
+            job.profiler = Profiler('products', base_dir)
+            job.profiler.start()
+            job.extract_product(write=False)
+            report = job.profiler.stop()
+            self.assertEqual(report['phases']['decode']['count'], 5)  # count + 3 pages + empty page
+            self.assertEqual(report['phases']['sleep']['count'], 3)
+            self.assertIn('other', report['phases'])
+            for suffix in ('.pstats', '_profile.txt', '_profile.json'):
+                self.assertTrue(os.path.isfile(os.path.join(base_dir, 'products' + suffix)))
+            with open(os.path.join(base_dir, 'products_profile.json')) as report_file:
+                self.assertEqual(json.load(report_file)['job'], 'products')
+
+            # a profiler that can not start (another one active) gives its tracemalloc use back
+            users = profiling.tracing['users']
+            busy = Profiler('busy', base_dir)
+            busy.profile = FakeBusyProfile()
+            self.assertRaises(ValueError, busy.start)
+            self.assertEqual(profiling.tracing['users'], users)
+        finally:
+            shutil.rmtree(base_dir)
+
     def test_write_json(self):
         """
         Test write_json() using list, dict, string w/cleanup
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Transform stage, runs a per record function over page files in a process pool"""
+
+from __future__ import print_function
+import argparse
+import collections
+import hashlib
+import importlib
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from output import RunOutput, load_manifest, new_run_id
+from snapshot import iter_json_records
+from util import string_types, strip_html, strip_multi_whitespace, strip_new_line
+
+
+def clean_body_html(record):
+    """
+    Default transform, adds body_text: body_html as plain text
+    :param record: dict, e.g. a product
+    :return: dict
+    """
+    record['body_text'] = strip_html(record.get('body_html'))
+    return record
+
+
+def clean_strings(record):
+    """
+    strip_new_line + strip_multi_whitespace on every top level string of a record
+    :param record: dict
+    :return: dict
+    """
+    for key, value in record.items():
+        if isinstance(value, string_types):
+            record[key] = strip_multi_whitespace(strip_new_line(value))
+    return record
+
+
+def load_function(name):
+    """
+    :param name: string, dotted path of a module level function, e.g. 'transform.clean_body_html'
+    :return: callable
+    """
+    module, _, attribute = name.rpartition('.')
+    if not module:
+        raise ValueError('Transform "%s" is not module.function' % name)
+    return getattr(importlib.import_module(module), attribute)
+
+
+def transform_file(task):
+    """
+    Transform one page file and write the result, runs in a worker process.
+    The records never travel back to the parent, only the counts do.
+    :param task: tuple (path, func, resource, run_id, base_dir, ndjson, partition)
+    :return: dict (source, records_in, records_out, seconds, entries)
+    """
+    path, func, resource, run_id, base_dir, ndjson, partition = task
+    started = time.time()
+    records_in = 0
+    results = []
+    for record in iter_json_records([path]):
+        records_in += 1
+        result = func(record)
+        if result is not None:  # None drops the record
+            results.append(result)
+    output = RunOutput(run_id, base_dir, ndjson)
+    output.write(resource, results, partition)
+    return dict(
+        source=path,
+        records_in=records_in,
+        records_out=len(results),
+        seconds=time.time() - started,
+        entries=output.entries,
+    )
+
+
+def partition_names(paths):
+    """
+    Output partition per source file: the file name, plus a hash of the full path
+    where two sources share a name (page_00001 of two runs)
+    :param paths: list of file paths
+    :return: list of strings, unique, in the same order
+    """
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    return [
+        name if names.count(name) == 1 else '%s_%s' % (
+            name, hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:8]
+        )
+        for path, name in zip(paths, names)
+    ]
+
+
+def transform_pages(paths, func, output, resource, processes=None):
+    """
+    Run func over every record of the page files, one file per task, in a
+    process pool. Each worker writes its own partition (named after the page
+    file, see partition_names()) into output so results stream to disk as pages finish.
+    :param paths: list of json list or .ndjson files (chunk page files or run partitions)
+    :param func: callable, module level (it is pickled by name), returns the
+        record, a new record or None to drop it
+    :param output: RunOutput, where the transformed partitions go
+    :param resource: string, resource folder in output
+    :param processes: int, optional, pool size, defaults to the cpu count
+    :return: generator of dicts (see transform_file()) in completion order,
+        the entries are added to output for the manifest
+    """
+    paths = list(collections.OrderedDict.fromkeys(paths))  # a file listed twice runs once
+    tasks = [
+        (path, func, resource, output.run_id, output.base_dir, output.ndjson, partition)
+        for path, partition in zip(paths, partition_names(paths))
+    ]
+    pool = multiprocessing.Pool(processes)
+    try:
+        for summary in pool.imap_unordered(transform_file, tasks):
+            output.add_entries(summary['entries'])
+            yield summary
+    finally:
+        pool.close()
+        pool.join()
+
+
+def source_files(path, resource):
+    """
+    The files holding a resource's records, each record once: a chunked run
+    writes both page partitions and the 'all' partition, the pages are taken
+    (one task each in transform_pages()), 'all' only when there are no pages
+    :param path: string, a json file or a run directory (its manifest is read)
+    :param resource: string, resource of the files taken from a run directory
+    :return: list of file paths
+    """
+    if not os.path.isdir(path):
+        return [path]
+    manifest = load_manifest(path)
+    entries = [entry for entry in manifest['files'] if entry['resource'] == resource]
+    chosen = [entry for entry in entries if entry['partition'] != 'all']
+    if not chosen:
+        chosen = entries
+    return [os.path.join(path, entry['path']) for entry in chosen]
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    :param argv: list, optional, defaults to sys.argv[1:]
+    :return: int exit code
+    """
+    parser = argparse.ArgumentParser(description='ShopifyETL transform stage')
+    parser.add_argument(
+        'sources', nargs='+',
+        help='page files (json/products_page_*.json) or run directories (json/runs/<run_id>)'
+    )
+    parser.add_argument('--resource', default='products', help='resource read from run directories')
+    parser.add_argument(
+        '--func', default='transform.clean_body_html',
+        help='module.function applied to each record (default: transform.clean_body_html)'
+    )
+    parser.add_argument('--processes', type=int, default=None, help='default: cpu count')
+    parser.add_argument('--ndjson', action='store_true', help='write indexed .ndjson partitions')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        func = load_function(args.func)
+    except (ImportError, AttributeError, ValueError) as e:
+        parser.error('can not load %s: %s' % (args.func, e))
+    paths = []
+    for source in args.sources:
+        paths += source_files(source, args.resource)
+
+    output = RunOutput('transform-%s' % new_run_id(), ndjson=args.ndjson)
+    started = time.time()
+    records_in = records_out = 0
+    for summary in transform_pages(paths, func, output, args.resource, args.processes):
+        records_in += summary['records_in']
+        records_out += summary['records_out']
+        logging.info('%s: %s -> %s records in %.2fs', summary['source'],
+                     summary['records_in'], summary['records_out'], summary['seconds'])
+    seconds = time.time() - started
+    output.write_manifest(transform=dict(
+        func=args.func, sources=paths, records_in=records_in, records_out=records_out,
+        seconds=round(seconds, 2),
+    ))
+    logging.info('Transformed %s files, %s records (%.0f/s) into %s',
+                 len(paths), records_in, records_in / seconds if seconds else 0, output.run_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
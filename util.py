@@ -1,7 +1,14 @@
+import errno
 import logging
 import re
 import os
 import json
+import tempfile
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 # Try used as a firewall to allow other scripts to complete without the package shitting a brick
 try:
     import requests
@@ -11,12 +18,27 @@ except ImportError:
 
 """Whole bunch of utilities"""
 
+# compiled once, the strip_* helpers run on every string of every record
+multi_whitespace_pattern = re.compile(' +')
+whitespace_pattern = re.compile(r'\s+')
+html_tag_pattern = re.compile(r'<[^>]*>')
+try:
+    from html import unescape as html_unescape
+except ImportError:  # Python 2
+    from HTMLParser import HTMLParser
+    html_unescape = HTMLParser().unescape
+try:
+    string_types = basestring  # Python 2, str and unicode
+except NameError:
+    string_types = str
+
 
-def ping_shop(shop, fqdn=False):
+def ping_shop(shop, fqdn=False, session=None):
     """
     Make simple request ot shop and look for 2xx response
     :param shop: string, the shop name defined in the config
     :param fqdn: string, optional, if set will espect a FQDN incli HTTP(s)
+    :param session: optional, requests.Session or cassette.Cassette, defaults to requests
     :return: bool
     """
     if fqdn:
@@ -25,8 +47,8 @@ def ping_shop(shop, fqdn=False):
         shop = 'https://%s.myshopify.com' % shop
     try:
         logging.info('Making request to %s' % shop)
-        r = requests.get(shop)
-        if not unicode(r.status_code).startswith('2'):
+        r = (session or requests).get(shop)
+        if not 200 <= r.status_code < 300:
             logging.error('The request to %s did not return a 2xx status code.' % shop)
             return False
         return True
@@ -36,6 +58,58 @@ def ping_shop(shop, fqdn=False):
         return False
 
 
+def thread_map(func, items, workers=4, backlog=None):
+    """
+    Run func over items in a pool of threads. items is consumed lazily (a
+    generator is fine) through a bounded queue so memory stays flat.
+    :param func: callable, required, takes one item
+    :param items: iterable, required
+    :param workers: int, optional, threads
+    :param backlog: int, optional, items queued ahead of the workers (default 2x workers)
+    :return: generator of (item, result, exception or None) in completion order
+    """
+    tasks = queue.Queue(backlog or workers * 2)
+    done = queue.Queue()
+    stop = object()
+    feed_errors = []
+
+    def feed():
+        try:
+            for item in items:
+                tasks.put(item)
+        except Exception as e:  # surfaced to the caller once the workers are done
+            feed_errors.append(e)
+        for _ in range(workers):
+            tasks.put(stop)
+
+    def work():
+        while True:
+            item = tasks.get()
+            if item is stop:
+                done.put(stop)
+                return
+            try:
+                done.put((item, func(item), None))
+            except Exception as e:
+                done.put((item, None, e))
+
+    threads = [threading.Thread(target=feed)] + [
+        threading.Thread(target=work) for _ in range(workers)
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    finished = 0
+    while finished < workers:
+        result = done.get()
+        if result is stop:
+            finished += 1
+            continue
+        yield result
+    if feed_errors:
+        raise feed_errors[0]
+
+
 def strip_new_line(str_json):
     """
     Strip \n new line
@@ -52,68 +126,122 @@ def strip_multi_whitespace(str_json):
     :param str_json: string
     :return: string
     """
-    str_json = re.sub(' +', ' ', str_json)  # kills multi whitespace
+    str_json = multi_whitespace_pattern.sub(' ', str_json)  # kills multi whitespace
     return str_json
 
 
-def write_json(data, file_name, overwrite_files=False, prepend_count=1):
+def strip_html(html):
     """
-    Handy and/or dandy function to write data to a static file in the module.
-    :param data: dist/list/string, required, the data to write
-    :param file_name:
-    :param overwrite_files:
-    :param prepend_count:
-    :return:
+    Text of an html fragment (e.g. body_html): tags dropped, entities decoded,
+    any run of whitespace/new lines collapsed to a single " "
+    :param html: string or None
+    :return: string
     """
-    # validate location
-    json_dir = os.path.dirname(os.path.realpath(__file__))+'/json'
+    if not html:
+        return ''
+    text = html_unescape(html_tag_pattern.sub(' ', html))
+    return whitespace_pattern.sub(' ', text).strip()
 
-    if not os.path.isdir(json_dir):
-        logging.error('Expected %s to be a valid dir.' % json_dir)
-        return False
+
+def atomic_write(path, payload):
+    """
+    Write to a temp file in the target folder then rename it into place, readers
+    never see a half written file and the last writer wins cleanly
+    :param path: string, required, target file
+    :param payload: string or bytes, required
+    :return: path
+    """
+    target_dir = os.path.dirname(path)
+    if not os.path.isdir(target_dir):
+        try:
+            os.makedirs(target_dir)
+        except OSError:  # a parallel writer made it first
+            if not os.path.isdir(target_dir):
+                raise
+    handle, temp_path = tempfile.mkstemp(dir=target_dir, prefix='.tmp-')
+    try:
+        with os.fdopen(handle, 'wb' if isinstance(payload, bytes) else 'w') as temp_file:
+            temp_file.write(payload)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.chmod(temp_path, 0o644)  # mkstemp is owner only
+        os.rename(temp_path, path)  # atomic on POSIX
+    except Exception:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        raise
+    return path
+
+
+def reserve_file(path):
+    """
+    Claim a file name, safe between threads and processes (O_EXCL)
+    :param path: string
+    :return: bool, False if the file already exists
+    """
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return False
+        raise
+    return True
+
+
+def claim_json_path(file_name, overwrite_files=False, prepend_count=1):
+    """
+    Path of json/<file_name>.json, without overwrite_files a taken name gets a
+    _1, _2, ... suffix and the returned name is already claimed (reserve_file)
+    :param file_name: string
+    :param overwrite_files: bool, optional
+    :param prepend_count: first suffix tried on collision
+    :return: string, file path
+    """
     # loc of the file to be written
     json_dir_template = '/'.join(
         [
-            json_dir,
+            os.path.dirname(os.path.realpath(__file__)) + '/json',
             '%s.json'
         ]
     )
-
-    # create file path/name
     target_file_path = json_dir_template % file_name
 
     if not overwrite_files:  # will need to rename on collision
-        if os.path.isfile(target_file_path):
-            # try using the prepend before we recurse
+        while not reserve_file(target_file_path):
             target_file_path = json_dir_template % '%s_%s' % (file_name, prepend_count)
-            if os.path.isfile(target_file_path):
-                # okay, now we recurse
-                prepend_count += 1
-                write_json(
-                    data,
-                    file_name,
-                    overwrite_files,
-                    prepend_count,
-                )
-
-    data_file = open(target_file_path, "w")
+            prepend_count += 1
+
+    return target_file_path
+
+
+def write_json(data, file_name, overwrite_files=False, prepend_count=1):
+    """
+    Handy and/or dandy function to write data to a static file in the module.
+    Without overwrite_files a taken name gets a _1, _2, ... suffix, the name is
+    claimed atomically so parallel writers never collide.
+    :param data: dist/list/string, required, the data to write
+    :param file_name:
+    :param overwrite_files:
+    :param prepend_count: first suffix tried on collision
+    :return: file path or None on fail
+    """
+    # validate location
+    json_dir = os.path.dirname(os.path.realpath(__file__))+'/json'
+
+    if not os.path.isdir(json_dir):
+        logging.error('Expected %s to be a valid dir.' % json_dir)
+        return False
     json_write = None
     if isinstance(data, list) or isinstance(data, dict):
         json_write = json.dumps(data)
     elif isinstance(data, str):
         # assumes ready to write, not judging
         json_write = data
-    try:
-        data_file.write(json_write)
-    # Handles instance of None gracefully
-    except TypeError as e:
-        logging.error(e)
-        logging.error('\n\n json write data:')
-        logging.error(json_write)
+    if json_write is None:
+        # Handles instance of None gracefully
+        logging.error('write_json can not write data of type %s', type(data))
         logging.error('\n\ndata:')
         logging.error(data)
-        # because we care
-        data_file.close()
         return None
-    data_file.close()
-    return target_file_path
+
+    return atomic_write(claim_json_path(file_name, overwrite_files, prepend_count), json_write)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Webhook receiver, keeps the local catalog fresh between full extractions"""
+
+from __future__ import print_function
+import argparse
+import base64
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import sys
+import threading
+import time
+try:
+    import queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    import Queue as queue
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+from output import RunOutput, new_run_id
+
+
+def sign_payload(body, secret):
+    """
+    The X-Shopify-Hmac-Sha256 value for a body, base64 of the HMAC-SHA256 digest
+    :param body: bytes, required, raw request body
+    :param secret: string, required, the app's shared secret
+    :return: string
+    """
+    digest = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+def verify_hmac(body, secret, signature):
+    """
+    Constant time check of the X-Shopify-Hmac-Sha256 header
+    :param body: bytes, required, raw request body
+    :param secret: string, required
+    :param signature: string or None, header value
+    :return: bool
+    """
+    if not signature:
+        return False
+    return hmac.compare_digest(sign_payload(body, secret), signature)
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+
+    """Threaded HTTP server holding a reference to its receiver"""
+
+    daemon_threads = True
+    receiver = None
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    """POST only, everything is delegated to WebhookReceiver.handle()"""
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > self.server.receiver.max_body:
+            self.send_response(413)
+            self.end_headers()
+            return
+        body = self.rfile.read(length)
+        status = self.server.receiver.handle(self.headers, body)
+        self.send_response(status)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug('webhook %s - %s', self.address_string(), format % args)
+
+
+class WebhookReceiver(object):
+
+    """
+    Receive products/*, collections/* and collects/* webhooks, verify the
+    HMAC, queue them (bounded) and micro-batch them into the run output layout
+    the extract jobs write: <resource>/batch_00001.json holds upserts (last
+    version of each id wins) and <resource>/batch_00001_deleted.json the ids
+    deleted. Resources are named like the extract jobs' (see resources()). The
+    manifest is rewritten after every batch.
+    """
+
+    topics = ('products/', 'collections/', 'collects/')
+    # bytes, bigger bodies are refused with a 413
+    max_body = 5 * 1024 * 1024
+    # recent X-Shopify-Webhook-Id values kept to drop Shopify's retries
+    seen_size = 10000
+
+    def __init__(self, secret, output=None, host='127.0.0.1', port=8080, queue_size=1000,
+                 batch_size=250, batch_interval=5):
+        """
+        :param secret: string, required, shared secret used to sign the webhooks
+        :param output: RunOutput, optional, defaults to json/runs/webhooks-<run id>
+        :param host: string, optional, interface to bind
+        :param port: int, optional, 0 picks a free port (see self.port after start())
+        :param queue_size: int, optional, events held before new ones get a 503 (Shopify retries)
+        :param batch_size: int, optional, events per write
+        :param batch_interval: int/float, optional, max seconds an event waits to be written
+        :return: void
+        """
+        self.secret = secret
+        self.output = output or RunOutput('webhooks-%s' % new_run_id())
+        self.host = host
+        self.port = port
+        self.queue = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.batch = 0
+        self.failed_batches = 0
+        self.seen = collections.deque()
+        self.seen_ids = set()
+        self.lock = threading.Lock()
+        self.server = None
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def handle(self, headers, body):
+        """
+        Validate and queue one webhook
+        :param headers: mapping of request headers
+        :param body: bytes, raw request body
+        :return: int, HTTP status for the response
+        """
+        topic = headers.get('X-Shopify-Topic') or ''
+        if not topic.startswith(self.topics):
+            return 404
+        if not verify_hmac(body, self.secret, headers.get('X-Shopify-Hmac-Sha256')):
+            logging.warning('Webhook %s failed HMAC verification', topic)
+            return 401
+        try:
+            payload = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return 400
+        webhook_id = headers.get('X-Shopify-Webhook-Id')
+        if webhook_id and not self.remember(webhook_id):
+            return 200  # a retry of one already queued
+        try:
+            self.queue.put_nowait((topic, payload))
+        except queue.Full:
+            logging.warning('Webhook queue full, refusing %s', topic)
+            if webhook_id:
+                self.forget(webhook_id)  # Shopify's retry must be queued, not dropped
+            return 503
+        return 200
+
+    def remember(self, webhook_id):
+        """
+        :param webhook_id: string
+        :return: bool, False if seen recently
+        """
+        with self.lock:  # one thread per request
+            if webhook_id in self.seen_ids:
+                return False
+            self.seen.append(webhook_id)
+            self.seen_ids.add(webhook_id)
+            if len(self.seen) > self.seen_size:
+                self.seen_ids.discard(self.seen.popleft())
+        return True
+
+    def forget(self, webhook_id):
+        """
+        Undo remember() for a webhook that was not queued
+        :param webhook_id: string
+        :return: void
+        """
+        with self.lock:
+            if webhook_id in self.seen_ids:
+                self.seen_ids.discard(webhook_id)
+                self.seen.remove(webhook_id)
+
+    def run_writer(self):
+        """
+        Writer thread, drain the queue into batches until stopped and empty
+        :return: void
+        """
+        events = []
+        deadline = None
+        while not (self.stopping.is_set() and self.queue.empty()):
+            timeout = 0.2 if deadline is None else max(min(deadline - time.time(), 0.2), 0)
+            try:
+                events.append(self.queue.get(timeout=timeout))
+                if deadline is None:
+                    deadline = time.time() + self.batch_interval
+            except queue.Empty:
+                pass
+            if events and (len(events) >= self.batch_size or time.time() >= deadline):
+                self.flush(events)
+                events = []
+                deadline = None
+        if events:
+            self.flush(events)
+
+    def flush(self, events):
+        """
+        write_batch() that never takes the writer thread down, a failed batch is
+        logged (with its events) and the thread keeps draining the queue
+        :param events: list of (topic, payload)
+        :return: bool, False when the batch could not be written
+        """
+        try:
+            self.write_batch(events)
+        except Exception:
+            self.failed_batches += 1
+            logging.exception(
+                'Webhook batch %s of %s events could not be written', self.batch, len(events),
+                extra=dict(payload=json.dumps(events)),
+            )
+            return False
+        return True
+
+    @classmethod
+    def resources(cls, topic, payload):
+        """
+        Resource folders of an event, named like the extract jobs write them. A
+        collection is a smart collection when it has rules; a deleted collection
+        only has its id, the id goes to both collection resources.
+        :param topic: string, e.g. 'collections/update'
+        :param payload: dict
+        :return: tuple (list of resource names, action)
+        """
+        kind, action = topic.split('/', 1)
+        if kind != 'collections':
+            return [kind], action
+        if action == 'delete':
+            return ['custom_collections', 'smart_collections'], action
+        return ['smart_collections' if 'rules' in payload else 'custom_collections'], action
+
+    def write_batch(self, events):
+        """
+        Collapse events per resource and id (in arrival order) and write them
+        :param events: list of (topic, payload)
+        :return: void
+        """
+        self.batch += 1
+        upserts = collections.OrderedDict()
+        deletes = collections.OrderedDict()
+        for topic, payload in events:
+            resources, action = self.resources(topic, payload)
+            for resource in resources:
+                key = (resource, payload.get('id'))
+                if action == 'delete':
+                    upserts.pop(key, None)
+                    deletes[key] = True
+                else:
+                    deletes.pop(key, None)
+                    upserts[key] = payload
+
+        partition = 'batch_%05d' % self.batch
+        for resource in sorted(set(key[0] for key in list(upserts) + list(deletes))):
+            records = [payload for key, payload in upserts.items() if key[0] == resource]
+            deleted = [key[1] for key in deletes if key[0] == resource]
+            if records:
+                self.output.write(resource, records, partition)
+            if deleted:
+                self.output.write(resource, deleted, '%s_deleted' % partition)
+        self.output.write_manifest(source='webhooks')
+        logging.info(
+            'Webhook batch %s: %s events, %s upserts, %s deletes',
+            self.batch, len(events), len(upserts), len(deletes)
+        )
+
+    def start(self):
+        """
+        Start the HTTP server and the writer thread
+        :return: void
+        """
+        self.server = WebhookServer((self.host, self.port), WebhookHandler)
+        self.server.receiver = self
+        self.port = self.server.server_address[1]
+        for target in (self.server.serve_forever, self.run_writer):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        logging.info('Webhook receiver listening on %s:%s', self.host, self.port)
+
+    def stop(self):
+        """
+        Stop accepting, flush what is queued
+        :return: void
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    :param argv: list, optional, defaults to sys.argv[1:]
+    :return: int exit code
+    """
+    parser = argparse.ArgumentParser(description='ShopifyETL webhook receiver')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--secret', help='shared secret, defaults to SHOPIFY_WEBHOOK_SECRET')
+    parser.add_argument('--queue-size', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=250)
+    parser.add_argument('--batch-interval', type=float, default=5)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    secret = args.secret
+    if secret is None:
+        from shopify_creds import ShopifyCreds
+        secret = ShopifyCreds().SHOPIFY_WEBHOOK_SECRET
+    if not secret:
+        parser.error('no webhook secret, use --secret or SHOPIFY_WEBHOOK_SECRET in config.cfg')
+
+    receiver = WebhookReceiver(
+        secret,
+        host=args.host,
+        port=args.port,
+        queue_size=args.queue_size,
+        batch_size=args.batch_size,
+        batch_interval=args.batch_interval,
+    )
+    receiver.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logging.info('Stopping, flushing queued webhooks')
+        receiver.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,535 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Durable task queue with leases, SQLite locally or Redis across hosts"""
+
+from __future__ import print_function
+import json
+import sqlite3
+import threading
+import time
+try:
+    import redis
+except ImportError:  # optional, only RedisQueue needs it
+    redis = None
+
+
+def open_queue(url, **kwargs):
+    """
+    :param url: string, 'redis://host:port/db' or a SQLite file path (optionally 'sqlite:///path')
+    :param kwargs: passed to the queue class (lease_seconds, max_attempts, retry_delay)
+    :return: SqliteQueue or RedisQueue
+    """
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisQueue(url, **kwargs)
+    if url.startswith('sqlite:///'):
+        url = url[len('sqlite:///'):]
+    return SqliteQueue(url, **kwargs)
+
+
+class SqliteQueue(object):
+
+    """
+    Tasks in a SQLite file, safe between threads and processes of one host.
+    A claimed task is leased to its worker for lease_seconds, a lease that
+    runs out (worker died) puts the task back on the queue. Failed tasks are
+    retried after retry_delay (doubled per attempt) until max_attempts.
+    The file also holds the bucket of a SharedRateBudget.
+    """
+
+    def __init__(self, path, lease_seconds=60, max_attempts=5, retry_delay=5.0):
+        """
+        :param path: string, required, database file (created if missing)
+        :param lease_seconds: float, how long a claim holds without extend()
+        :param max_attempts: int, claims per task before it is marked failed
+        :param retry_delay: float, seconds before a failed task is claimable again
+        :return: void
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.local = threading.local()  # one connection per thread
+        with self.transaction() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS tasks ('
+                ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                ' run_id TEXT NOT NULL,'
+                ' key TEXT NOT NULL,'
+                ' payload TEXT NOT NULL,'
+                " status TEXT NOT NULL DEFAULT 'pending',"
+                ' attempts INTEGER NOT NULL DEFAULT 0,'
+                ' available_at REAL NOT NULL DEFAULT 0,'
+                ' lease_until REAL,'
+                ' worker TEXT,'
+                ' error TEXT,'
+                ' result TEXT,'
+                ' UNIQUE (run_id, key))'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS tasks_claim ON tasks (status, available_at)')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS budget ('
+                ' id INTEGER PRIMARY KEY CHECK (id = 1),'
+                ' level REAL, updated REAL, blocked_until REAL, capacity INTEGER)'
+            )
+
+    def connection(self):
+        """
+        :return: sqlite3.Connection of this thread, autocommit (transactions are explicit)
+        """
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            self.local.db = db
+        return db
+
+    def transaction(self):
+        """
+        :return: context manager, BEGIN IMMEDIATE (one writer at a time) ... COMMIT
+        """
+        return Transaction(self.connection())
+
+    def put(self, run_id, key, payload):
+        """
+        Add a task, a key already queued for the run is left alone (planning twice is safe)
+        :param run_id: string
+        :param key: string, unique within the run, e.g. 'products page 3'
+        :param payload: dict, json serializable
+        :return: bool, True if added
+        """
+        with self.transaction() as db:
+            cursor = db.execute(
+                'INSERT OR IGNORE INTO tasks (run_id, key, payload) VALUES (?, ?, ?)',
+                (run_id, key, json.dumps(payload))
+            )
+            return cursor.rowcount == 1
+
+    def claim(self, worker, run_id=None):
+        """
+        Lease the next available task, including leased ones whose lease ran out
+        :param worker: string, worker id
+        :param run_id: string, optional, only tasks of this run
+        :return: dict (id, run_id, key, payload, attempts) or None
+        """
+        now = time.time()
+        query = (
+            'SELECT * FROM tasks WHERE ((status = ? AND available_at <= ?)'
+            ' OR (status = ? AND lease_until < ?))'
+        )
+        params = ['pending', now, 'leased', now]
+        if run_id is not None:
+            query += ' AND run_id = ?'
+            params.append(run_id)
+        with self.transaction() as db:
+            while True:
+                row = db.execute(query + ' ORDER BY id LIMIT 1', params).fetchone()
+                if row is None:
+                    return None
+                if row['status'] == 'pending' or row['attempts'] < self.max_attempts:
+                    break
+                # the worker died on its last attempt
+                db.execute(
+                    'UPDATE tasks SET status = ?, error = ?, lease_until = NULL WHERE id = ?',
+                    ('failed', 'lease expired', row['id'])
+                )
+            db.execute(
+                'UPDATE tasks SET status = ?, attempts = attempts + 1, lease_until = ?, worker = ?'
+                ' WHERE id = ?',
+                ('leased', now + self.lease_seconds, worker, row['id'])
+            )
+        return dict(
+            id=row['id'], run_id=row['run_id'], key=row['key'],
+            payload=json.loads(row['payload']), attempts=row['attempts'] + 1,
+        )
+
+    def extend(self, task, worker):
+        """
+        Renew a lease (heartbeat)
+        :param task: dict, output of claim()
+        :param worker: string
+        :return: bool, False if the lease was lost (expired and claimed elsewhere)
+        """
+        with self.transaction() as db:
+            cursor = db.execute(
+                'UPDATE tasks SET lease_until = ? WHERE id = ? AND worker = ? AND status = ?',
+                (time.time() + self.lease_seconds, task['id'], worker, 'leased')
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, task, worker, result=None):
+        """
+        :param task: dict, output of claim()
+        :param worker: string
+        :param result: json serializable, kept with the task (e.g. manifest entries)
+        :return: bool, False if the lease was lost
+        """
+        with self.transaction() as db:
+            cursor = db.execute(
+                'UPDATE tasks SET status = ?, result = ?, lease_until = NULL, error = NULL'
+                ' WHERE id = ? AND worker = ? AND status = ?',
+                ('done', json.dumps(result), task['id'], worker, 'leased')
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, task, worker, error):
+        """
+        Put a task back on the queue after a delay, or mark it failed after max_attempts
+        :param task: dict, output of claim()
+        :param worker: string
+        :param error: string
+        :return: string, new status ('pending' or 'failed') or None if the lease was lost
+        """
+        status = 'failed' if task['attempts'] >= self.max_attempts else 'pending'
+        delay = self.retry_delay * 2 ** (task['attempts'] - 1)
+        with self.transaction() as db:
+            cursor = db.execute(
+                'UPDATE tasks SET status = ?, error = ?, available_at = ?, lease_until = NULL'
+                ' WHERE id = ? AND worker = ? AND status = ?',
+                (status, error, time.time() + delay, task['id'], worker, 'leased')
+            )
+            return status if cursor.rowcount == 1 else None
+
+    def counts(self, run_id):
+        """
+        :param run_id: string
+        :return: dict {status: count}
+        """
+        rows = self.connection().execute(
+            'SELECT status, COUNT(*) FROM tasks WHERE run_id = ? GROUP BY status', (run_id,)
+        ).fetchall()
+        return dict((row[0], row[1]) for row in rows)
+
+    def tasks(self, run_id, status=None):
+        """
+        :param run_id: string
+        :param status: string, optional filter
+        :return: list of dicts (key, status, attempts, error, result)
+        """
+        query = 'SELECT key, status, attempts, error, result FROM tasks WHERE run_id = ?'
+        params = [run_id]
+        if status is not None:
+            query += ' AND status = ?'
+            params.append(status)
+        return [
+            dict(key=row['key'], status=row['status'], attempts=row['attempts'],
+                 error=row['error'], result=json.loads(row['result']) if row['result'] else None)
+            for row in self.connection().execute(query + ' ORDER BY id', params)
+        ]
+
+    def budget_take(self, limit, leak_rate, cost=1):
+        """
+        Take a call from the shared bucket if it fits
+        :param limit: int, calls the bucket may hold (capacity - reserve)
+        :param leak_rate: float, calls per second drained
+        :param cost: number, units the call takes
+        :return: float, 0 if taken, otherwise seconds to wait before trying again
+        """
+        now = time.time()
+        with self.transaction() as db:
+            row = db.execute('SELECT * FROM budget WHERE id = 1').fetchone()
+            if row is None:
+                level, blocked_until, capacity = 0.0, 0.0, None
+            else:
+                level = max(row['level'] - (now - row['updated']) * leak_rate, 0.0)
+                blocked_until, capacity = row['blocked_until'], row['capacity']
+            if capacity is not None:
+                limit = min(limit, capacity)
+            units = min(cost, limit)
+            wait = 0.0
+            if now < blocked_until or level + units > limit:
+                wait = max(blocked_until - now, (level + units - limit) / leak_rate, 0.01)
+            else:
+                level += units
+            db.execute(
+                'INSERT OR REPLACE INTO budget (id, level, updated, blocked_until, capacity)'
+                ' VALUES (1, ?, ?, ?, ?)', (level, now, blocked_until, capacity)
+            )
+        return wait
+
+    def budget_sync(self, used, capacity, leak_rate):
+        """
+        Raise the shared level to what the shop reports
+        :param used: int
+        :param capacity: int
+        :param leak_rate: float
+        :return: void
+        """
+        now = time.time()
+        with self.transaction() as db:
+            row = db.execute('SELECT * FROM budget WHERE id = 1').fetchone()
+            level, blocked_until = 0.0, 0.0
+            if row is not None:
+                level = max(row['level'] - (now - row['updated']) * leak_rate, 0.0)
+                blocked_until = row['blocked_until']
+            db.execute(
+                'INSERT OR REPLACE INTO budget (id, level, updated, blocked_until, capacity)'
+                ' VALUES (1, ?, ?, ?, ?)', (max(level, float(used)), now, blocked_until, capacity)
+            )
+
+    def budget_block(self, until):
+        """
+        Hold every worker until a time (429 Retry-After)
+        :param until: float, epoch seconds
+        :return: void
+        """
+        now = time.time()
+        with self.transaction() as db:
+            row = db.execute('SELECT * FROM budget WHERE id = 1').fetchone()
+            if row is None:
+                db.execute(
+                    'INSERT INTO budget (id, level, updated, blocked_until, capacity)'
+                    ' VALUES (1, 0, ?, ?, NULL)', (now, until)
+                )
+            else:
+                db.execute(
+                    'UPDATE budget SET blocked_until = ? WHERE id = 1',
+                    (max(row['blocked_until'], until),)
+                )
+
+
+class Transaction(object):
+
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK on an autocommit connection"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, *exc):
+        self.db.execute('ROLLBACK' if exc_type is not None else 'COMMIT')
+        return False
+
+
+# ------------------------------------------------------------------
+# Redis scripts, each runs atomically on the server                |
+# KEYS[1] is the key prefix, tasks live in <prefix>task:<id> hashes |
+# ------------------------------------------------------------------
+REDIS_PUT = """
+local id = redis.call('HGET', KEYS[1] .. 'keys:' .. ARGV[1], ARGV[2])
+if id then return 0 end
+id = redis.call('INCR', KEYS[1] .. 'next_id')
+redis.call('HSET', KEYS[1] .. 'keys:' .. ARGV[1], ARGV[2], id)
+redis.call('HSET', KEYS[1] .. 'task:' .. id, 'run_id', ARGV[1], 'key', ARGV[2],
+           'payload', ARGV[3], 'status', 'pending', 'attempts', 0)
+redis.call('SADD', KEYS[1] .. 'run:' .. ARGV[1], id)
+redis.call('ZADD', KEYS[1] .. 'pending:' .. ARGV[1], 0, id)
+redis.call('SADD', KEYS[1] .. 'runs', ARGV[1])
+return 1
+"""
+
+# pending:<run> is scored by the time a task becomes available, leased:<run> by lease end
+# ARGV: now, lease seconds, worker, run id or '', max attempts
+REDIS_CLAIM = """
+local now = tonumber(ARGV[1])
+local runs = {ARGV[4]}
+if ARGV[4] == '' then runs = redis.call('SMEMBERS', KEYS[1] .. 'runs') end
+for _, run in ipairs(runs) do
+  local leased = KEYS[1] .. 'leased:' .. run
+  local pending = KEYS[1] .. 'pending:' .. run
+  for _, id in ipairs(redis.call('ZRANGEBYSCORE', leased, '-inf', now)) do
+    local task = KEYS[1] .. 'task:' .. id
+    redis.call('ZREM', leased, id)
+    if tonumber(redis.call('HGET', task, 'attempts')) >= tonumber(ARGV[5]) then
+      redis.call('HSET', task, 'status', 'failed', 'error', 'lease expired')
+    else
+      redis.call('HSET', task, 'status', 'pending')
+      redis.call('ZADD', pending, 0, id)
+    end
+  end
+  local ids = redis.call('ZRANGEBYSCORE', pending, '-inf', now, 'LIMIT', 0, 1)
+  if ids[1] then
+    local task = KEYS[1] .. 'task:' .. ids[1]
+    redis.call('ZREM', pending, ids[1])
+    redis.call('ZADD', leased, now + tonumber(ARGV[2]), ids[1])
+    redis.call('HINCRBY', task, 'attempts', 1)
+    redis.call('HSET', task, 'status', 'leased', 'worker', ARGV[3])
+    return ids[1]
+  end
+end
+return false
+"""
+
+# ARGV: task id, worker, run id, lease until
+REDIS_EXTEND = """
+local task = KEYS[1] .. 'task:' .. ARGV[1]
+if redis.call('HGET', task, 'worker') ~= ARGV[2] or
+   redis.call('HGET', task, 'status') ~= 'leased' then return 0 end
+redis.call('ZADD', KEYS[1] .. 'leased:' .. ARGV[3], ARGV[4], ARGV[1])
+return 1
+"""
+
+# ARGV: task id, worker, run id, new status, field, value, available at
+REDIS_FINISH = """
+local task = KEYS[1] .. 'task:' .. ARGV[1]
+if redis.call('HGET', task, 'worker') ~= ARGV[2] or
+   redis.call('HGET', task, 'status') ~= 'leased' then return 0 end
+redis.call('ZREM', KEYS[1] .. 'leased:' .. ARGV[3], ARGV[1])
+redis.call('HSET', task, 'status', ARGV[4], ARGV[5], ARGV[6])
+if ARGV[4] == 'pending' then redis.call('ZADD', KEYS[1] .. 'pending:' .. ARGV[3], ARGV[7], ARGV[1]) end
+return 1
+"""
+
+# ARGV: now, limit, leak rate, cost. Returns the wait in seconds as a string, '0' if taken
+REDIS_BUDGET_TAKE = """
+local now = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local rate = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1] .. 'budget', 'level', 'updated', 'blocked_until', 'capacity')
+local level = tonumber(state[1] or 0)
+local updated = tonumber(state[2] or now)
+local blocked = tonumber(state[3] or 0)
+if state[4] then limit = math.min(limit, tonumber(state[4])) end
+local units = math.min(tonumber(ARGV[4]), limit)
+level = math.max(level - (now - updated) * rate, 0)
+local wait = 0
+if now < blocked or level + units > limit then
+  wait = math.max(blocked - now, (level + units - limit) / rate, 0.01)
+else
+  level = level + units
+end
+redis.call('HSET', KEYS[1] .. 'budget', 'level', level, 'updated', now)
+return tostring(wait)
+"""
+
+# ARGV: now, used, capacity, leak rate
+REDIS_BUDGET_SYNC = """
+local now = tonumber(ARGV[1])
+local state = redis.call('HMGET', KEYS[1] .. 'budget', 'level', 'updated')
+local level = math.max(tonumber(state[1] or 0) - (now - tonumber(state[2] or now)) * tonumber(ARGV[4]), 0)
+redis.call('HSET', KEYS[1] .. 'budget', 'level', math.max(level, tonumber(ARGV[2])),
+           'updated', now, 'capacity', ARGV[3])
+return 1
+"""
+
+# ARGV: until
+REDIS_BUDGET_BLOCK = """
+local blocked = tonumber(redis.call('HGET', KEYS[1] .. 'budget', 'blocked_until') or 0)
+redis.call('HSET', KEYS[1] .. 'budget', 'blocked_until', math.max(blocked, tonumber(ARGV[1])))
+return 1
+"""
+
+
+class RedisQueue(object):
+
+    """
+    Same interface as SqliteQueue on a Redis server, for workers on several
+    hosts. Every state change is a Lua script so claims never race.
+    Needs the redis package (pip install redis).
+    """
+
+    def __init__(self, url, lease_seconds=60, max_attempts=5, retry_delay=5.0,
+                 prefix='shopify_etl:'):
+        """
+        :param url: string, required, e.g. 'redis://localhost:6379/0'
+        :param lease_seconds: float, how long a claim holds without extend()
+        :param max_attempts: int, claims per task before it is marked failed
+        :param retry_delay: float, seconds before a failed task is claimable again
+        :param prefix: string, key prefix, several deployments can share a server
+        :return: void
+        """
+        if redis is None:
+            raise ImportError('RedisQueue requires the redis package (pip install redis)')
+        self.client = redis.StrictRedis.from_url(url, decode_responses=True)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.prefix = prefix
+        self.scripts = dict(
+            (name, self.client.register_script(script)) for name, script in (
+                ('put', REDIS_PUT), ('claim', REDIS_CLAIM), ('extend', REDIS_EXTEND),
+                ('finish', REDIS_FINISH), ('budget_take', REDIS_BUDGET_TAKE),
+                ('budget_sync', REDIS_BUDGET_SYNC), ('budget_block', REDIS_BUDGET_BLOCK),
+            )
+        )
+
+    def run_script(self, name, *args):
+        """
+        :param name: string, key of self.scripts
+        :param args: script ARGV
+        :return: script result
+        """
+        return self.scripts[name](keys=[self.prefix], args=list(args))
+
+    def put(self, run_id, key, payload):
+        """See SqliteQueue.put()"""
+        return self.run_script('put', run_id, key, json.dumps(payload)) == 1
+
+    def claim(self, worker, run_id=None):
+        """See SqliteQueue.claim()"""
+        task_id = self.run_script(
+            'claim', time.time(), self.lease_seconds, worker, run_id or '', self.max_attempts
+        )
+        if not task_id:
+            return None
+        task = self.client.hgetall('%stask:%s' % (self.prefix, task_id))
+        return dict(
+            id=int(task_id), run_id=task['run_id'], key=task['key'],
+            payload=json.loads(task['payload']), attempts=int(task['attempts']),
+        )
+
+    def extend(self, task, worker):
+        """See SqliteQueue.extend()"""
+        return self.run_script(
+            'extend', task['id'], worker, task['run_id'], time.time() + self.lease_seconds
+        ) == 1
+
+    def complete(self, task, worker, result=None):
+        """See SqliteQueue.complete()"""
+        return self.run_script(
+            'finish', task['id'], worker, task['run_id'], 'done', 'result', json.dumps(result), 0
+        ) == 1
+
+    def fail(self, task, worker, error):
+        """See SqliteQueue.fail()"""
+        status = 'failed' if task['attempts'] >= self.max_attempts else 'pending'
+        delay = self.retry_delay * 2 ** (task['attempts'] - 1)
+        finished = self.run_script(
+            'finish', task['id'], worker, task['run_id'], status, 'error', error,
+            time.time() + delay
+        )
+        return status if finished == 1 else None
+
+    def run_tasks(self, run_id):
+        """
+        :param run_id: string
+        :return: list of task hashes in id order
+        """
+        ids = sorted(
+            int(task_id) for task_id in self.client.smembers('%srun:%s' % (self.prefix, run_id))
+        )
+        pipe = self.client.pipeline()
+        for task_id in ids:
+            pipe.hgetall('%stask:%s' % (self.prefix, task_id))
+        return pipe.execute()
+
+    def counts(self, run_id):
+        """See SqliteQueue.counts()"""
+        counts = {}
+        for task in self.run_tasks(run_id):
+            counts[task['status']] = counts.get(task['status'], 0) + 1
+        return counts
+
+    def tasks(self, run_id, status=None):
+        """See SqliteQueue.tasks()"""
+        return [
+            dict(key=task['key'], status=task['status'], attempts=int(task['attempts']),
+                 error=task.get('error'),
+                 result=json.loads(task['result']) if task.get('result') else None)
+            for task in self.run_tasks(run_id) if status is None or task['status'] == status
+        ]
+
+    def budget_take(self, limit, leak_rate, cost=1):
+        """See SqliteQueue.budget_take()"""
+        return float(self.run_script('budget_take', time.time(), limit, leak_rate, cost))
+
+    def budget_sync(self, used, capacity, leak_rate):
+        """See SqliteQueue.budget_sync()"""
+        self.run_script('budget_sync', time.time(), used, capacity, leak_rate)
+
+    def budget_block(self, until):
+        """See SqliteQueue.budget_block()"""
+        self.run_script('budget_block', until)